@@ -11,6 +11,11 @@ from cdk_stacks import (
   DMSAuroraMysqlToKinesisStack,
   OpenSearchStack,
   KinesisFirehoseStack,
+  KinesisFirehoseArchiveStack,
+  S3BackupCompactionStack,
+  OpenSearchUpsertStack,
+  OpenSearchRollupStack,
+  PipelineObservabilityStack,
   BastionHostEC2InstanceStack,
 )
 
@@ -48,7 +53,7 @@ dms_stack = DMSAuroraMysqlToKinesisStack(app, 'DMSAuroraMysqlToKinesisStack',
   aurora_mysql_stack.sg_mysql_client,
   aurora_mysql_stack.db_secret,
   aurora_mysql_stack.db_hostname,
-  kds_stack.kinesis_stream_arn,
+  kds_stack.kinesis_stream_arns,
   env=APP_ENV
 )
 dms_stack.add_dependency(dms_iam_permissions)
@@ -62,11 +67,54 @@ ops_stack.add_dependency(dms_stack)
 
 firehose_stack = KinesisFirehoseStack(app, 'FirehoseStack',
   vpc_stack.vpc,
-  kds_stack.kinesis_stream_arn,
+  kds_stack.kinesis_stream_arns,
   ops_stack.ops_domain_arn,
   ops_stack.ops_client_sg_id,
   env=APP_ENV
 )
 firehose_stack.add_dependency(ops_stack)
 
+s3_backup_compaction_stack = S3BackupCompactionStack(app, 'S3BackupCompactionStack',
+  firehose_stack.s3_bucket_name,
+  firehose_stack.s3_backup_prefixes,
+  env=APP_ENV
+)
+s3_backup_compaction_stack.add_dependency(firehose_stack)
+
+firehose_archive_stack = KinesisFirehoseArchiveStack(app, 'FirehoseArchiveStack',
+  kds_stack.kinesis_stream_arns,
+  env=APP_ENV
+)
+firehose_archive_stack.add_dependency(kds_stack)
+
+ops_upsert_stack = OpenSearchUpsertStack(app, 'OpenSearchUpsertStack',
+  vpc_stack.vpc,
+  kds_stack.kinesis_stream_arns,
+  ops_stack.ops_domain_arn,
+  ops_stack.ops_domain_endpoint,
+  ops_stack.ops_client_sg_id,
+  env=APP_ENV
+)
+ops_upsert_stack.add_dependency(ops_stack)
+
+ops_rollup_stack = OpenSearchRollupStack(app, 'OpenSearchRollupStack',
+  vpc_stack.vpc,
+  kds_stack.kinesis_stream_arns,
+  ops_stack.ops_domain_arn,
+  ops_stack.ops_domain_endpoint,
+  ops_stack.ops_client_sg_id,
+  env=APP_ENV
+)
+ops_rollup_stack.add_dependency(ops_stack)
+
+observability_stack = PipelineObservabilityStack(app, 'PipelineObservabilityStack',
+  dms_stack.dms_metric_dimensions,
+  kds_stack.kinesis_stream_names,
+  kds_stack.kinesis_shard_counts,
+  firehose_stack.delivery_stream_names,
+  ops_stack.ops_domain_name,
+  env=APP_ENV
+)
+observability_stack.add_dependency(firehose_stack)
+
 app.synth()
@@ -5,4 +5,9 @@ from .dms_iam_roles import DmsIAMRolesStack
 from .dms_aurora_mysql_to_kinesis import DMSAuroraMysqlToKinesisStack
 from .ops import OpenSearchStack
 from .firehose import KinesisFirehoseStack
+from .firehose_archive import KinesisFirehoseArchiveStack
+from .s3_backup_compaction import S3BackupCompactionStack
+from .ops_upsert import OpenSearchUpsertStack
+from .ops_rollup import OpenSearchRollupStack
+from .observability import PipelineObservabilityStack
 from .bastion_host import BastionHostEC2InstanceStack
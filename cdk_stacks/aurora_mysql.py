@@ -15,6 +15,36 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+#XXX: The engine, instance type and binlog settings of the Aurora MySQL cluster as named profiles.
+# Choose one with the `aurora_mysql_profile` context, and override the instance type with `aurora_instance_type`.
+AURORA_MYSQL_PROFILES = {
+  'default': {
+    'engine_version': aws_rds.AuroraMysqlEngineVersion.VER_3_01_0,
+    'instance_type': 't3.medium',
+    'cluster_parameters': {}
+  },
+  'cdc_optimized': {
+    #XXX: Aurora enhanced binlog requires Aurora MySQL 3.03.1 or higher.
+    # https://docs.aws.amazon.com/AmazonRDS/latest/AuroraUserGuide/AuroraMySQL.Enhanced.binlog.html
+    'engine_version': aws_rds.AuroraMysqlEngineVersion.VER_3_04_0,
+    #XXX: Burstable instances run out of CPU credits under a steady write load with binary logging.
+    'instance_type': 'r6g.large',
+    'cluster_parameters': {
+      # Enhanced binlog writes binary logs to storage in parallel with transactions, instead of on commit.
+      'aurora_enhanced_binlog': '1',
+      # Required to turn on enhanced binlog
+      'binlog_backup': '0',
+      'binlog_replication_globaldb': '0',
+      # AWS DMS needs the full before and after images of rows.
+      'binlog_row_image': 'full',
+      # AWS DMS 3.4.7 and earlier cannot read binlog events with checksums.
+      'binlog_checksum': 'NONE'
+    }
+  }
+}
+
+DEFAULT_AURORA_MYSQL_PROFILE = 'default'
+
 
 class AuroraMysqlStack(Stack):
 
@@ -48,7 +78,13 @@ class AuroraMysqlStack(Stack):
       vpc=vpc
     )
 
-    rds_engine = aws_rds.DatabaseClusterEngine.aurora_mysql(version=aws_rds.AuroraMysqlEngineVersion.VER_3_01_0)
+    profile_name = self.node.try_get_context('aurora_mysql_profile') or DEFAULT_AURORA_MYSQL_PROFILE
+    assert profile_name in AURORA_MYSQL_PROFILES, \
+      'Invalid aurora_mysql_profile: should be one of {}'.format(', '.join(AURORA_MYSQL_PROFILES))
+    aurora_mysql_profile = AURORA_MYSQL_PROFILES[profile_name]
+    instance_type = aws_ec2.InstanceType(self.node.try_get_context('aurora_instance_type') or aurora_mysql_profile['instance_type'])
+
+    rds_engine = aws_rds.DatabaseClusterEngine.aurora_mysql(version=aurora_mysql_profile['engine_version'])
 
     #XXX: https://docs.aws.amazon.com/AmazonRDS/latest/AuroraUserGuide/AuroraMySQL.Reference.html#AuroraMySQL.Reference.Parameters.Cluster
     rds_cluster_param_group = aws_rds.ParameterGroup(self, 'AuroraMySQLClusterParamGroup',
@@ -65,7 +101,10 @@ class AuroraMysqlStack(Stack):
         'character_set_server': 'utf8mb4',
         'collation_server': 'utf8mb4_unicode_ci',
         'init_connect': 'SET NAMES utf8mb4 COLLATE utf8mb4_unicode_ci',
-        'binlog_format': 'ROW'
+        'binlog_format': 'ROW',
+        # Required to seed tables with LOAD DATA LOCAL INFILE (see utils/gen_fake_mysql_data.py --bulk-load-dir)
+        'local_infile': '1',
+        **aurora_mysql_profile['cluster_parameters']
       }
     )
 
@@ -102,13 +141,13 @@ class AuroraMysqlStack(Stack):
       engine=rds_engine,
       credentials=rds_credentials, # A username of 'admin' (or 'postgres' for PostgreSQL) and SecretsManager-generated password
       writer=aws_rds.ClusterInstance.provisioned("writer",
-        instance_type=aws_ec2.InstanceType.of(aws_ec2.InstanceClass.BURSTABLE3, aws_ec2.InstanceSize.MEDIUM),
+        instance_type=instance_type,
         parameter_group=rds_db_param_group,
         auto_minor_version_upgrade=False,
       ),
       readers=[
         aws_rds.ClusterInstance.provisioned("reader",
-          instance_type=aws_ec2.InstanceType.of(aws_ec2.InstanceClass.BURSTABLE3, aws_ec2.InstanceSize.MEDIUM),
+          instance_type=instance_type,
           parameter_group=rds_db_param_group,
           auto_minor_version_upgrade=False
         )
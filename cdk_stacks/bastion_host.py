@@ -73,6 +73,18 @@ class BastionHostEC2InstanceStack(Stack):
       bucket_key=user_data_asset.s3_object_key
     )
 
+    #XXX: The benchmark and the latency probe import gen_fake_mysql_data.py, so they are copied next to it.
+    util_script_local_paths = {}
+    for construct_id, script_name in [('BastionHostAuroraWriteBenchmark', 'aurora_write_benchmark.py'),
+        ('BastionHostHeartbeatLatencyProbe', 'heartbeat_latency_probe.py')]:
+      util_script_asset = aws_s3_assets.Asset(self, construct_id,
+        path=os.path.join(os.path.dirname(__file__), f'../utils/{script_name}'))
+      util_script_asset.grant_read(bastion_host.role)
+      util_script_local_paths[script_name] = bastion_host.user_data.add_s3_download_command(
+        bucket=util_script_asset.bucket,
+        bucket_key=util_script_asset.s3_object_key
+      )
+
     commands = '''
 yum update -y
 yum install -y python3.7
@@ -86,8 +98,11 @@ su -c "/home/ec2-user/.local/bin/pip3 install boto3 --user" -s /bin/sh ec2-user
 '''
 
     commands += f'''
-su -c "/home/ec2-user/.local/bin/pip3 install dataset==1.5.2 Faker==13.3.1 PyMySQL==1.0.2 --user" -s /bin/sh ec2-user
+su -c "/home/ec2-user/.local/bin/pip3 install dataset==1.5.2 Faker==13.3.1 PyMySQL==1.0.2 numpy==1.21.6 --user" -s /bin/sh ec2-user
 cp {USER_DATA_LOCAL_PATH} /home/ec2-user/gen_fake_mysql_data.py & chown -R ec2-user /home/ec2-user/gen_fake_mysql_data.py
+'''
+    for script_name, local_path in util_script_local_paths.items():
+      commands += f'''cp {local_path} /home/ec2-user/{script_name} & chown -R ec2-user /home/ec2-user/{script_name}
 '''
 
     bastion_host.user_data.add_commands(commands)
@@ -14,10 +14,97 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from .pipeline_profile import get_pipeline_settings
+from .routing_groups import get_routing_groups
+
+#XXX: vCPUs of DMS replication instance classes, to size the full load threads
+# https://docs.aws.amazon.com/dms/latest/userguide/CHAP_ReplicationInstance.Types.html
+DMS_INSTANCE_VCPUS = {
+  'small': 1, 'medium': 2, 'large': 2, 'xlarge': 4, '2xlarge': 8, '4xlarge': 16,
+  '8xlarge': 32, '9xlarge': 36, '12xlarge': 48, '16xlarge': 64, '18xlarge': 72, '24xlarge': 96
+}
+
+#XXX: The initial write capacity of an ON_DEMAND Kinesis Data Stream is 4 MB/s, i.e. 4 shards.
+KINESIS_ON_DEMAND_INITIAL_SHARDS = 4
+
+#XXX: DMS capacity units (DCU) of DMS Serverless, 1 DCU = 2 GB of RAM
+# https://docs.aws.amazon.com/dms/latest/userguide/CHAP_Serverless.html
+DMS_SERVERLESS_CAPACITY_UNITS = (1, 2, 4, 8, 16, 32, 64, 128, 192, 256, 384)
+
+
+def full_load_settings(replication_instance_class, kinesis_shard_count, parallel_load):
+  '''Sizes the multithreaded full load task settings for a Kinesis Data Streams target.
+
+  One load thread per shard spreads writes across the stream, but at least one per vCPU keeps all the cores of
+  the replication instance busy. A buffer of 500 records fills a single PutRecords request.'''
+
+  vcpus = DMS_INSTANCE_VCPUS.get(replication_instance_class.split('.')[-1], 2)
+  max_segments = max([len(rule.get('boundaries', [])) + 1 for rule in parallel_load.values()] or [1])
+  return {
+    "MaxFullLoadSubTasks": min(49, max(8, max_segments)),
+    "ParallelLoadThreads": min(32, max(vcpus, kinesis_shard_count or KINESIS_ON_DEMAND_INITIAL_SHARDS)),
+    "ParallelLoadBufferSize": 500,
+    "ParallelLoadQueuesPerThread": 4
+  }
+
+
+def build_table_mappings(database_name, routing_group, parallel_load=None):
+  rules = []
+  for table_name in routing_group['tables']:
+    rules.append({
+      "rule-type": "selection",
+      "rule-id": str(len(rules) + 1),
+      "rule-name": str(len(rules) + 1),
+      "object-locator": {
+        "schema-name": database_name,
+        "table-name": table_name
+      },
+      "rule-action": "include",
+      "filters": []
+    })
+  for table_name in routing_group['excluded_tables']:
+    rules.append({
+      "rule-type": "selection",
+      "rule-id": str(len(rules) + 1),
+      "rule-name": str(len(rules) + 1),
+      "object-locator": {
+        "schema-name": database_name,
+        "table-name": table_name
+      },
+      "rule-action": "exclude"
+    })
+  for table_name in routing_group['tables']:
+    rules.append({
+      "rule-type": "object-mapping",
+      "rule-id": str(len(rules) + 1),
+      "rule-name": "DefaultMapToKinesis" if len(routing_group['tables']) == 1 else f"MapToKinesis{len(rules) + 1}",
+      "rule-action": "map-record-to-record",
+      "object-locator": {
+        "schema-name": database_name,
+        "table-name": table_name
+      }
+    })
+  #XXX: Segments of a table are loaded in parallel by the subtasks of a full load.
+  for table_name, parallel_load_rule in (parallel_load or {}).items():
+    if table_name not in routing_group['tables']:
+      continue
+    rules.append({
+      "rule-type": "table-settings",
+      "rule-id": str(len(rules) + 1),
+      "rule-name": f"ParallelLoad{len(rules) + 1}",
+      "object-locator": {
+        "schema-name": database_name,
+        "table-name": table_name
+      },
+      "parallel-load": parallel_load_rule
+    })
+  return {"rules": rules}
+
+
 class DMSAuroraMysqlToKinesisStack(Stack):
 
   def __init__(self, scope: Construct, construct_id: str,
-              vpc, db_client_sg, db_secret, source_database_hostname, target_kinesis_stream_arn,
+              vpc, db_client_sg, db_secret, source_database_hostname, target_kinesis_stream_arns,
               **kwargs) -> None:
 
     super().__init__(scope, construct_id, **kwargs)
@@ -25,26 +112,57 @@ class DMSAuroraMysqlToKinesisStack(Stack):
     db_cluster_name = self.node.try_get_context('db_cluster_name')
     dms_data_source = self.node.try_get_context('dms_data_source')
     database_name = dms_data_source['database_name']
-    table_name = dms_data_source['table_name']
+    pipeline_settings = get_pipeline_settings(self)
+
+    #XXX: Use utils/dms_parallel_load_ranges.py to compute `dms_parallel_load` from the source tables.
+    migration_type = self.node.try_get_context('dms_migration_type') or 'cdc'
+    assert migration_type in ('cdc', 'full-load', 'full-load-and-cdc'), 'Invalid dms_migration_type'
+    routing_groups = get_routing_groups(self)
+    parallel_load = self.node.try_get_context('dms_parallel_load') or {}
+    for table_name, parallel_load_rule in parallel_load.items():
+      assert parallel_load_rule.get('type') in ('ranges', 'partitions-auto', 'partitions-list', 'none'), \
+        f'Invalid dms_parallel_load type of {table_name}'
+      #XXX: The table settings rule is added to the task of the routing group that lists the table by name.
+      assert sum(1 for routing_group in routing_groups if table_name in routing_group['tables']) == 1, \
+        f'dms_parallel_load.{table_name} should be listed by name in exactly one routing group of dms_data_source'
+
+    #XXX: With DMS Serverless, a replication config per routing group scales its capacity between the bounds
+    # instead of running on a fixed replication instance, e.g.
+    #   "dms_serverless": {"min_capacity_units": 2, "max_capacity_units": 16, "multi_az": false}
+    dms_serverless = self.node.try_get_context('dms_serverless')
+    if dms_serverless:
+      assert dms_serverless.get('max_capacity_units') in DMS_SERVERLESS_CAPACITY_UNITS, \
+        'dms_serverless.max_capacity_units should be one of {}'.format(', '.join(str(e) for e in DMS_SERVERLESS_CAPACITY_UNITS))
+      min_capacity_units = dms_serverless.get('min_capacity_units', DMS_SERVERLESS_CAPACITY_UNITS[0])
+      assert min_capacity_units in DMS_SERVERLESS_CAPACITY_UNITS and min_capacity_units <= dms_serverless['max_capacity_units'], \
+        'dms_serverless.min_capacity_units should be one of the capacity units up to max_capacity_units'
 
     dms_replication_subnet_group = aws_dms.CfnReplicationSubnetGroup(self, 'DMSReplicationSubnetGroup',
       replication_subnet_group_description='DMS Replication Subnet Group',
       subnet_ids=vpc.select_subnets(subnet_type=aws_ec2.SubnetType.PRIVATE_WITH_EGRESS).subnet_ids
     )
 
-    dms_replication_instance = aws_dms.CfnReplicationInstance(self, 'DMSReplicationInstance',
-      replication_instance_class='dms.t3.medium',
-      # the properties below are optional
-      allocated_storage=50,
-      allow_major_version_upgrade=False,
-      auto_minor_version_upgrade=False,
-      engine_version='3.4.6',
-      multi_az=False,
-      preferred_maintenance_window='sat:03:17-sat:03:47',
-      publicly_accessible=False,
-      replication_subnet_group_identifier=dms_replication_subnet_group.ref,
-      vpc_security_group_ids=[db_client_sg.security_group_id]
-    )
+    if not dms_serverless:
+      #XXX: An explicit identifier is the ReplicationInstanceIdentifier dimension of the DMS CloudWatch metrics.
+      # DMS stores it in lowercase.
+      replication_instance_identifier = f"{db_cluster_name}-replication".lower()
+      dms_replication_instance = aws_dms.CfnReplicationInstance(self, 'DMSReplicationInstance',
+        replication_instance_identifier=replication_instance_identifier,
+        replication_instance_class=pipeline_settings['dms_replication_instance_class'],
+        # the properties below are optional
+        allocated_storage=50,
+        allow_major_version_upgrade=False,
+        auto_minor_version_upgrade=False,
+        engine_version='3.4.6',
+        multi_az=False,
+        preferred_maintenance_window='sat:03:17-sat:03:47',
+        publicly_accessible=False,
+        replication_subnet_group_identifier=dms_replication_subnet_group.ref,
+        vpc_security_group_ids=[db_client_sg.security_group_id]
+      )
+
+    #XXX: The dimensions of the DMS CloudWatch metrics of each routing group, for PipelineObservabilityStack
+    self.dms_metric_dimensions = {}
 
     source_endpoint_id = db_cluster_name
     dms_source_endpoint = aws_dms.CfnEndpoint(self, 'DMSSourceEndpoint',
@@ -76,89 +194,127 @@ class DMSAuroraMysqlToKinesisStack(Stack):
       }
     )
 
-    target_endpoint_id = f"{source_endpoint_id}-cdc-to-kinesis"
-    dms_target_endpoint = aws_dms.CfnEndpoint(self, 'DMSTargetEndpoint',
-      endpoint_identifier=target_endpoint_id,
-      endpoint_type='target',
-      engine_name='kinesis',
-      kinesis_settings=aws_dms.CfnEndpoint.KinesisSettingsProperty(
-        # MessageFormat
-        #  L json-unformatted: a single line JSON string with new line format
-        #  L json: an attribute-value pair in JSON format
-        # Link: https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-properties-dms-endpoint-kinesissettings.html
-        message_format="json-unformatted",
-        service_access_role_arn=dms_target_kinesis_access_role.role_arn,
-        stream_arn=target_kinesis_stream_arn
-      )
-    )
-
-    table_mappings_json = {
-      "rules": [
-        {
-          "rule-type": "selection",
-          "rule-id": "1",
-          "rule-name": "1",
-          "object-locator": {
-            "schema-name": database_name,
-            "table-name": table_name
-          },
-          "rule-action": "include",
-          "filters": []
-        },
-        {
-          "rule-type": "object-mapping",
-          "rule-id": "2",
-          "rule-name": "DefaultMapToKinesis",
-          "rule-action": "map-record-to-record",
-          "object-locator": {
-            "schema-name": database_name,
-            "table-name": table_name
-          }
-        }
-      ]
-    }
-
     #XXX: AWS DMS - Using Amazon Kinesis Data Streams as a target for AWS Database Migration Service
     # https://docs.aws.amazon.com/dms/latest/userguide/CHAP_Target.Kinesis.html
     # When using "ParallelApply*" task settings, the "partition-key-type" default is the primary-key of the table, not "schema-name.table-name".
-    task_settings_json = {
-      # Multithreaded full load task settings
-      "FullLoadSettings": {
+    for routing_group in routing_groups:
+      construct_id_suffix = routing_group['construct_id_suffix']
+
+      target_endpoint_id = f"{source_endpoint_id}-cdc-to-kinesis{routing_group['name_suffix']}"
+      dms_target_endpoint = aws_dms.CfnEndpoint(self, f'DMSTargetEndpoint{construct_id_suffix}',
+        endpoint_identifier=target_endpoint_id,
+        endpoint_type='target',
+        engine_name='kinesis',
+        kinesis_settings=aws_dms.CfnEndpoint.KinesisSettingsProperty(
+          # MessageFormat
+          #  L json-unformatted: a single line JSON string with new line format
+          #  L json: an attribute-value pair in JSON format
+          # Link: https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-properties-dms-endpoint-kinesissettings.html
+          message_format="json-unformatted",
+          service_access_role_arn=dms_target_kinesis_access_role.role_arn,
+          stream_arn=target_kinesis_stream_arns[routing_group['name']]
+        )
+      )
+
+      #XXX: Full load threads are sized to the shards of the stream of each routing group.
+      group_kinesis_stream_mode = routing_group['kinesis_stream_mode'] or pipeline_settings['kinesis_stream_mode']
+      group_kinesis_shard_count = (routing_group['kinesis_shard_count'] or pipeline_settings['kinesis_shard_count']) \
+        if group_kinesis_stream_mode == 'PROVISIONED' else None
+      load_settings = full_load_settings(pipeline_settings['dms_replication_instance_class'],
+        group_kinesis_shard_count, parallel_load) if migration_type != 'cdc' else {
         "MaxFullLoadSubTasks": 8,
-      },
-      "TargetMetadata": {
-        # Multithreaded full load task settings
         "ParallelLoadQueuesPerThread": 0,
         "ParallelLoadThreads": 0,
-        "ParallelLoadBufferSize": 0,
+        "ParallelLoadBufferSize": 0
+      }
+      load_settings.update(self.node.try_get_context('dms_full_load_settings') or {})
+
+      task_settings_json = {
+        # Multithreaded full load task settings
+        "FullLoadSettings": {
+          "MaxFullLoadSubTasks": load_settings['MaxFullLoadSubTasks'],
+        },
+        "TargetMetadata": {
+          # Multithreaded full load task settings
+          "ParallelLoadQueuesPerThread": load_settings['ParallelLoadQueuesPerThread'],
+          "ParallelLoadThreads": load_settings['ParallelLoadThreads'],
+          "ParallelLoadBufferSize": load_settings['ParallelLoadBufferSize'],
 
-        # Multithreaded CDC load task settings
-        "ParallelApplyBufferSize": 1000,
-        "ParallelApplyQueuesPerThread": 16,
-        "ParallelApplyThreads": 8,
+          # Multithreaded CDC load task settings
+          "ParallelApplyBufferSize": pipeline_settings['dms_parallel_apply_buffer_size'],
+          "ParallelApplyQueuesPerThread": pipeline_settings['dms_parallel_apply_queues_per_thread'],
+          "ParallelApplyThreads": pipeline_settings['dms_parallel_apply_threads'],
+        }
       }
-    }
-
-    dms_replication_task = aws_dms.CfnReplicationTask(self, 'DMSReplicationTask',
-      replication_task_identifier='CDC-MySQLToKinesisTask',
-      replication_instance_arn=dms_replication_instance.ref,
-      migration_type='cdc', # [ full-load | cdc | full-load-and-cdc ]
-      source_endpoint_arn=dms_source_endpoint.ref,
-      target_endpoint_arn=dms_target_endpoint.ref,
-      table_mappings=json.dumps(table_mappings_json),
-      replication_task_settings=json.dumps(task_settings_json)
-    )
 
+      #XXX: With `"dms_before_image": true`, update records carry the previous values of the row in `before-image`,
+      # which the rollup stage (OpenSearchRollupStack) subtracts from its aggregates, so it requires them.
+      if self.node.try_get_context('dms_before_image'):
+        task_settings_json["BeforeImageSettings"] = {
+          "EnableBeforeImage": True,
+          "FieldName": "before-image",
+          "ColumnFilter": "non-lob"
+        }
+
+      table_mappings = build_table_mappings(database_name, routing_group, parallel_load)
+
+      if dms_serverless:
+        #XXX: A replication config takes the same table mappings and task settings as a replication task.
+        replication_config_identifier = f"{source_endpoint_id}-cdc-to-kinesis{routing_group['name_suffix']}".lower()
+        dms_replication_config = aws_dms.CfnReplicationConfig(self, f'DMSReplicationConfig{construct_id_suffix}',
+          replication_config_identifier=replication_config_identifier,
+          compute_config=aws_dms.CfnReplicationConfig.ComputeConfigProperty(
+            max_capacity_units=dms_serverless['max_capacity_units'],
+            min_capacity_units=min_capacity_units,
+            multi_az=dms_serverless.get('multi_az', False),
+            preferred_maintenance_window='sat:03:17-sat:03:47',
+            replication_subnet_group_id=dms_replication_subnet_group.ref,
+            vpc_security_group_ids=[db_client_sg.security_group_id]
+          ),
+          replication_type=migration_type, # [ full-load | cdc | full-load-and-cdc ]
+          source_endpoint_arn=dms_source_endpoint.ref,
+          target_endpoint_arn=dms_target_endpoint.ref,
+          table_mappings=table_mappings,
+          replication_settings=task_settings_json
+        )
+
+        #XXX: DMS Serverless publishes the metrics of a replication by the identifier of its replication config.
+        self.dms_metric_dimensions[routing_group['name']] = {
+          "ReplicationConfigIdentifier": replication_config_identifier
+        }
+
+        cdk.CfnOutput(self, f'DMSReplicationConfigArn{construct_id_suffix}',
+          value=dms_replication_config.ref,
+          export_name=f'{self.stack_name}-DMSReplicationConfigArn{construct_id_suffix}')
+      else:
+        dms_replication_task = aws_dms.CfnReplicationTask(self, f'DMSReplicationTask{construct_id_suffix}',
+          replication_task_identifier=f"CDC-MySQLToKinesisTask{routing_group['name_suffix']}",
+          replication_instance_arn=dms_replication_instance.ref,
+          migration_type=migration_type, # [ full-load | cdc | full-load-and-cdc ]
+          source_endpoint_arn=dms_source_endpoint.ref,
+          target_endpoint_arn=dms_target_endpoint.ref,
+          table_mappings=json.dumps(table_mappings),
+          replication_task_settings=json.dumps(task_settings_json)
+        )
+
+        #XXX: DMS publishes task metrics with the resource id at the end of the task ARN as the ReplicationTaskIdentifier dimension.
+        # https://docs.aws.amazon.com/dms/latest/userguide/CHAP_Monitoring.html
+        self.dms_metric_dimensions[routing_group['name']] = {
+          "ReplicationInstanceIdentifier": replication_instance_identifier,
+          "ReplicationTaskIdentifier": cdk.Fn.select(6, cdk.Fn.split(':', dms_replication_task.ref))
+        }
+
+        cdk.CfnOutput(self, f'DMSReplicationTaskArn{construct_id_suffix}',
+          value=dms_replication_task.ref,
+          export_name=f'{self.stack_name}-DMSReplicationTaskArn{construct_id_suffix}')
+        cdk.CfnOutput(self, f'DMSReplicationTaskId{construct_id_suffix}',
+          value=dms_replication_task.replication_task_identifier,
+          export_name=f'{self.stack_name}-ReplicationTaskId{construct_id_suffix}')
+
+      cdk.CfnOutput(self, f'DMSTargetEndpointId{construct_id_suffix}',
+        value=dms_target_endpoint.endpoint_identifier,
+        export_name=f'{self.stack_name}-TargetEndpointId{construct_id_suffix}')
 
-    cdk.CfnOutput(self, 'DMSReplicationTaskArn',
-      value=dms_replication_task.ref,
-      export_name=f'{self.stack_name}-DMSReplicationTaskArn')
-    cdk.CfnOutput(self, 'DMSReplicationTaskId',
-      value=dms_replication_task.replication_task_identifier,
-      export_name=f'{self.stack_name}-ReplicationTaskId')
     cdk.CfnOutput(self, 'DMSSourceEndpointId',
       value=dms_source_endpoint.endpoint_identifier,
       export_name=f'{self.stack_name}-SourceEndpointId')
-    cdk.CfnOutput(self, 'DMSTargetEndpointId',
-      value=dms_target_endpoint.endpoint_identifier,
-      export_name=f'{self.stack_name}-TargetEndpointId')
@@ -2,6 +2,7 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import os
 import re
 
 import aws_cdk as cdk
@@ -10,15 +11,20 @@ from aws_cdk import (
   Stack,
   aws_ec2,
   aws_iam,
+  aws_lambda,
+  aws_logs,
   aws_s3 as s3,
   aws_kinesisfirehose
 )
 from constructs import Construct
 
+from .pipeline_profile import get_pipeline_settings
+from .routing_groups import get_routing_groups
+
 
 class KinesisFirehoseStack(Stack):
 
-  def __init__(self, scope: Construct, construct_id: str, vpc, kinesis_stream_arn, ops_domain_arn, ops_client_sg_id, **kwargs) -> None:
+  def __init__(self, scope: Construct, construct_id: str, vpc, kinesis_stream_arns, ops_domain_arn, ops_client_sg_id, **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
     #XXX: OpenSearch Index naming restrictions
@@ -26,10 +32,25 @@ class KinesisFirehoseStack(Stack):
     OPENSEARCH_INDEX_NAME = self.node.try_get_context('opensearch_index_name')
     assert re.fullmatch(r'[a-z][a-z0-9\-_]+', OPENSEARCH_INDEX_NAME), 'Invalid domain name'
 
+    #XXX: With a rotation period, Kinesis Data Firehose appends a timestamp to the index name (e.g. retail-trans-2023-01-01),
+    # so that each index stays small and old ones can be shrunk or deleted by the ISM policy of OpenSearchStack.
+    index_rotation_period = self.node.try_get_context('opensearch_index_rotation_period') or 'NoRotation'
+    assert index_rotation_period in ('NoRotation', 'OneHour', 'OneDay', 'OneWeek', 'OneMonth'), 'Invalid opensearch_index_rotation_period'
+
+    pipeline_settings = get_pipeline_settings(self)
+    buffering_hints = {
+      "intervalInSeconds": pipeline_settings['firehose_buffer_interval_sec'],
+      "sizeInMBs": pipeline_settings['firehose_buffer_size_mb']
+    }
+
     s3_bucket = s3.Bucket(self, "s3bucket",
       removal_policy=cdk.RemovalPolicy.DESTROY, #XXX: Default: core.RemovalPolicy.RETAIN - The bucket will be orphaned
       bucket_name="firehose-to-ops-{region}-{suffix}".format(
-        region=cdk.Aws.REGION, suffix=cdk.Aws.ACCOUNT_ID))
+        region=cdk.Aws.REGION, suffix=cdk.Aws.ACCOUNT_ID),
+      #XXX: A compaction run killed by the Lambda timeout leaves its multipart uploads (up to 1 GB each) behind,
+      # and their parts are billed until they are aborted.
+      lifecycle_rules=[s3.LifecycleRule(abort_incomplete_multipart_upload_after=cdk.Duration.days(1))])
+    self.s3_bucket_name = s3_bucket.bucket_name
 
     firehose_role_policy_doc = aws_iam.PolicyDocument()
     firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(**{
@@ -83,16 +104,46 @@ class KinesisFirehoseStack(Stack):
       actions=["es:ESHttpGet"]
     ))
 
-    firehose_log_group_name = f"/aws/kinesisfirehose/{OPENSEARCH_INDEX_NAME}"
+    #XXX: Each routing group is delivered to its own index (e.g. retail-trans-orders) by its own delivery stream.
+    routing_groups = get_routing_groups(self)
+    index_names = {g['name']: f"{OPENSEARCH_INDEX_NAME}{g['name_suffix']}" for g in routing_groups}
+    #XXX: Delivery streams are named after their indices, and so are the prefixes of their S3 backup.
+    self.delivery_stream_names = dict(index_names)
+    self.s3_backup_prefixes = [f"{index_name}/" for index_name in index_names.values()]
+
     firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(
       effect=aws_iam.Effect.ALLOW,
       #XXX: The ARN will be formatted as follows:
       # arn:{partition}:{service}:{region}:{account}:{resource}{sep}}{resource-name}
       resources=[self.format_arn(service="logs", resource="log-group",
-        resource_name="{}:log-stream:*".format(firehose_log_group_name), arn_format=cdk.ArnFormat.COLON_RESOURCE_NAME)],
+        resource_name="/aws/kinesisfirehose/{}:log-stream:*".format(index_name), arn_format=cdk.ArnFormat.COLON_RESOURCE_NAME)
+        for index_name in index_names.values()],
       actions=["logs:PutLogEvents"]
     ))
 
+    #XXX: Optionally flatten DMS records, drop control records and turn deletes into tombstones
+    # before they are delivered to OpenSearch
+    enable_data_transformation = self.node.try_get_context('firehose_data_transformation') or False
+    if enable_data_transformation:
+      transform_lambda_fn = aws_lambda.Function(self, "FirehoseTransformFunction",
+        runtime=aws_lambda.Runtime.PYTHON_3_11,
+        function_name=f"FirehoseTransform-{OPENSEARCH_INDEX_NAME}",
+        handler="index.lambda_handler",
+        description="Flatten AWS DMS records delivered by Kinesis Data Firehose",
+        code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/FirehoseTransform')),
+        #XXX: Kinesis Data Firehose invokes a transformation Lambda function for up to 5 minutes
+        timeout=cdk.Duration.minutes(5),
+        memory_size=512,
+        log_retention=aws_logs.RetentionDays.THREE_DAYS
+      )
+
+      firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=[transform_lambda_fn.function_arn, f"{transform_lambda_fn.function_arn}:*"],
+        actions=["lambda:InvokeFunction",
+          "lambda:GetFunctionConfiguration"]
+      ))
+
     firehose_role = aws_iam.Role(self, "KinesisFirehoseServiceRole",
       role_name=f"KinesisFirehoseServiceRole-{OPENSEARCH_INDEX_NAME}-{cdk.Aws.REGION}",
       assumed_by=aws_iam.ServicePrincipal("firehose.amazonaws.com"),
@@ -111,59 +162,70 @@ class KinesisFirehoseStack(Stack):
       subnet_ids=vpc.select_subnets(subnet_type=aws_ec2.SubnetType.PRIVATE_WITH_EGRESS).subnet_ids
     )
 
-    opensearch_dest_config = aws_kinesisfirehose.CfnDeliveryStream.AmazonopensearchserviceDestinationConfigurationProperty(
-      index_name=OPENSEARCH_INDEX_NAME,
-      role_arn=firehose_role.role_arn,
-      s3_configuration={
-        "bucketArn": s3_bucket.bucket_arn,
-        "roleArn": firehose_role.role_arn,
+    for routing_group in routing_groups:
+      index_name = index_names[routing_group['name']]
+      firehose_log_group_name = f"/aws/kinesisfirehose/{index_name}"
+
+      opensearch_dest_config = aws_kinesisfirehose.CfnDeliveryStream.AmazonopensearchserviceDestinationConfigurationProperty(
+        index_name=index_name,
+        role_arn=firehose_role.role_arn,
+        s3_configuration={
+          "bucketArn": s3_bucket.bucket_arn,
+          "roleArn": firehose_role.role_arn,
+
+          # the properties below are optional
+          "bufferingHints": buffering_hints,
+          "cloudWatchLoggingOptions": {
+            "enabled": True,
+            "logGroupName": firehose_log_group_name,
+            "logStreamName": "S3Backup"
+          },
+          "compressionFormat": "UNCOMPRESSED", # [GZIP | HADOOP_SNAPPY | Snappy | UNCOMPRESSED | ZIP]
+          # Kinesis Data Firehose automatically appends the “YYYY/MM/dd/HH/” UTC prefix to delivered S3 files. You can also specify
+          # an extra prefix in front of the time format and add "/" to the end to have it appear as a folder in the S3 console.
+          "errorOutputPrefix": "error/",
+          "prefix": f"{index_name}/"
+        },
 
         # the properties below are optional
-        "bufferingHints": {
-          "intervalInSeconds": 60,
-          "sizeInMBs": 1
-        },
-        "cloudWatchLoggingOptions": {
+        buffering_hints=buffering_hints,
+        cloud_watch_logging_options={
           "enabled": True,
           "logGroupName": firehose_log_group_name,
-          "logStreamName": "S3Backup"
+          "logStreamName": "ElasticsearchDelivery"
         },
-        "compressionFormat": "UNCOMPRESSED", # [GZIP | HADOOP_SNAPPY | Snappy | UNCOMPRESSED | ZIP]
-        # Kinesis Data Firehose automatically appends the “YYYY/MM/dd/HH/” UTC prefix to delivered S3 files. You can also specify
-        # an extra prefix in front of the time format and add "/" to the end to have it appear as a folder in the S3 console.
-        "errorOutputPrefix": "error/",
-        "prefix": f"{OPENSEARCH_INDEX_NAME}/"
-      },
-
-      # the properties below are optional
-      buffering_hints={
-        "intervalInSeconds": 60,
-        "sizeInMBs": 1
-      },
-      cloud_watch_logging_options={
-        "enabled": True,
-        "logGroupName": firehose_log_group_name,
-        "logStreamName": "ElasticsearchDelivery"
-      },
-      domain_arn=ops_domain_arn,
-      index_rotation_period="NoRotation", # [NoRotation | OneDay | OneHour | OneMonth | OneWeek]
-      retry_options={
-        "durationInSeconds": 60
-      },
-      s3_backup_mode="AllDocuments", # [AllDocuments | FailedDocumentsOnly]
-      vpc_configuration=opensearch_dest_vpc_config
-    )
-
-    firehose_to_ops_delivery_stream = aws_kinesisfirehose.CfnDeliveryStream(self, "KinesisFirehoseToOPS",
-      delivery_stream_name=OPENSEARCH_INDEX_NAME,
-      delivery_stream_type="KinesisStreamAsSource",
-      kinesis_stream_source_configuration=aws_kinesisfirehose.CfnDeliveryStream.KinesisStreamSourceConfigurationProperty(
-        kinesis_stream_arn=kinesis_stream_arn,
-        role_arn=firehose_role.role_arn
-      ),
-      amazonopensearchservice_destination_configuration=opensearch_dest_config,
-      tags=[{"key": "Name", "value": OPENSEARCH_INDEX_NAME}]
-    )
+        domain_arn=ops_domain_arn,
+        index_rotation_period=index_rotation_period, # [NoRotation | OneDay | OneHour | OneMonth | OneWeek]
+        retry_options={
+          "durationInSeconds": 60
+        },
+        processing_configuration={
+          "enabled": True,
+          "processors": [{
+            "type": "Lambda",
+            "parameters": [
+              {"parameterName": "LambdaArn", "parameterValue": transform_lambda_fn.function_arn},
+              {"parameterName": "NumberOfRetries", "parameterValue": "3"},
+              #XXX: The payload of a Lambda invocation is up to 6 MB
+              {"parameterName": "BufferSizeInMBs", "parameterValue": str(min(3, buffering_hints["sizeInMBs"]))},
+              {"parameterName": "BufferIntervalInSeconds", "parameterValue": str(buffering_hints["intervalInSeconds"])}
+            ]
+          }]
+        } if enable_data_transformation else None,
+        s3_backup_mode="AllDocuments", # [AllDocuments | FailedDocumentsOnly]
+        vpc_configuration=opensearch_dest_vpc_config
+      )
+
+      firehose_to_ops_delivery_stream = aws_kinesisfirehose.CfnDeliveryStream(self, f"KinesisFirehoseToOPS{routing_group['construct_id_suffix']}",
+        delivery_stream_name=index_name,
+        delivery_stream_type="KinesisStreamAsSource",
+        kinesis_stream_source_configuration=aws_kinesisfirehose.CfnDeliveryStream.KinesisStreamSourceConfigurationProperty(
+          kinesis_stream_arn=kinesis_stream_arns[routing_group['name']],
+          role_arn=firehose_role.role_arn
+        ),
+        amazonopensearchservice_destination_configuration=opensearch_dest_config,
+        tags=[{"key": "Name", "value": index_name}]
+      )
 
     cdk.CfnOutput(self, 'FirehoseS3DestBucket', value=s3_bucket.bucket_name, export_name=f'{self.stack_name}-S3DestBucket')
     cdk.CfnOutput(self, 'FirehoseRoleArn', value=firehose_role.role_arn, export_name=f'{self.stack_name}-FirehoseRoleArn')
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+
+import aws_cdk as cdk
+
+from aws_cdk import (
+  Stack,
+  aws_glue,
+  aws_iam,
+  aws_lambda,
+  aws_logs,
+  aws_s3 as s3,
+  aws_kinesisfirehose
+)
+from constructs import Construct
+
+from .routing_groups import get_routing_groups, is_wildcard
+
+#XXX: Columns of testdb.retail_trans (see `CREATE TABLE` in README.md) and the metadata fields
+# flattened by src/main/python/FirehoseTransform, as (column name, Glue type, JSON key)
+RETAIL_TRANS_COLUMNS = [
+  ("trans_id", "bigint", "trans_id"),
+  ("customer_id", "string", "customer_id"),
+  ("event", "string", "event"),
+  ("sku", "string", "sku"),
+  ("amount", "int", "amount"),
+  ("device", "string", "device"),
+  ("trans_datetime", "timestamp", "trans_datetime")
+]
+DMS_METADATA_COLUMNS = [
+  ("dms_timestamp", "timestamp", "_timestamp"),
+  ("transaction_id", "bigint", "_transaction-id"),
+  ("deleted", "boolean", "_deleted")
+]
+
+OUTPUT_FORMATS = {
+  "parquet": {
+    "input_format": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+    "output_format": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+    "serialization_library": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+  },
+  "orc": {
+    "input_format": "org.apache.hadoop.hive.ql.io.orc.OrcInputFormat",
+    "output_format": "org.apache.hadoop.hive.ql.io.orc.OrcOutputFormat",
+    "serialization_library": "org.apache.hadoop.hive.ql.io.orc.OrcSerde"
+  }
+}
+
+
+class KinesisFirehoseArchiveStack(Stack):
+
+  def __init__(self, scope: Construct, construct_id: str, kinesis_stream_arns, **kwargs) -> None:
+    super().__init__(scope, construct_id, **kwargs)
+
+    DATABASE_NAME = self.node.try_get_context('dms_data_source')['database_name']
+    routing_groups = get_routing_groups(self)
+
+    archive_config = {
+      "format": "parquet",
+      "glue_database_name": "dms_cdc_archive",
+      #XXX: The Glue table schema describes the columns of retail_trans,
+      # so the archive reads the stream of the routing group of that table.
+      "table_name": next(t for g in routing_groups for t in g['tables'] if not is_wildcard(t)),
+      #XXX: Record format conversion requires a buffer size of at least 64 MiB.
+      "buffer_size_mb": 128,
+      "buffer_interval_sec": 300,
+      **(self.node.try_get_context('firehose_archive') or {})
+    }
+    TABLE_NAME = archive_config['table_name']
+    routing_group = next((g for g in routing_groups if TABLE_NAME in g['tables']), None)
+    assert routing_group, f'firehose_archive.table_name {TABLE_NAME} is not listed in dms_data_source'
+    OUTPUT_FORMAT = archive_config['format'].lower()
+    assert OUTPUT_FORMAT in OUTPUT_FORMATS, 'Invalid firehose_archive.format'
+    assert 64 <= archive_config['buffer_size_mb'] <= 128, 'firehose_archive.buffer_size_mb should be between 64 and 128'
+    assert 60 <= archive_config['buffer_interval_sec'] <= 900, 'firehose_archive.buffer_interval_sec should be between 60 and 900'
+
+    s3_bucket = s3.Bucket(self, "s3bucket",
+      removal_policy=cdk.RemovalPolicy.DESTROY, #XXX: Default: core.RemovalPolicy.RETAIN - The bucket will be orphaned
+      bucket_name="firehose-cdc-archive-{region}-{suffix}".format(
+        region=cdk.Aws.REGION, suffix=cdk.Aws.ACCOUNT_ID))
+
+    #XXX: Objects are written under cdc/schema_name=<schema>/table_name=<table>/operation=<operation>/dt=<yyyy-MM-dd>/,
+    # so that a Glue table of each source table can prune by operation and date.
+    S3_PREFIX = "cdc"
+    table_location = f"s3://{s3_bucket.bucket_name}/{S3_PREFIX}/schema_name={DATABASE_NAME}/table_name={TABLE_NAME}"
+
+    glue_database = aws_glue.CfnDatabase(self, "GlueDatabase",
+      catalog_id=cdk.Aws.ACCOUNT_ID,
+      database_input=aws_glue.CfnDatabase.DatabaseInputProperty(name=archive_config['glue_database_name'])
+    )
+
+    glue_table = aws_glue.CfnTable(self, "GlueTable",
+      catalog_id=cdk.Aws.ACCOUNT_ID,
+      database_name=archive_config['glue_database_name'],
+      table_input=aws_glue.CfnTable.TableInputProperty(
+        name=TABLE_NAME,
+        table_type="EXTERNAL_TABLE",
+        partition_keys=[
+          aws_glue.CfnTable.ColumnProperty(name="operation", type="string"),
+          aws_glue.CfnTable.ColumnProperty(name="dt", type="string")
+        ],
+        parameters={
+          "classification": OUTPUT_FORMAT,
+          #XXX: Partition projection lets Athena prune partitions without crawlers or MSCK REPAIR TABLE
+          "projection.enabled": "true",
+          "projection.operation.type": "enum",
+          "projection.operation.values": "insert,update,delete",
+          "projection.dt.type": "date",
+          "projection.dt.format": "yyyy-MM-dd",
+          "projection.dt.range": "2020-01-01,NOW",
+          "projection.dt.interval": "1",
+          "projection.dt.interval.unit": "DAYS",
+          "storage.location.template": table_location + "/operation=${operation}/dt=${dt}/"
+        },
+        storage_descriptor=aws_glue.CfnTable.StorageDescriptorProperty(
+          columns=[aws_glue.CfnTable.ColumnProperty(name=name, type=type_)
+            for name, type_, _ in RETAIL_TRANS_COLUMNS + DMS_METADATA_COLUMNS],
+          location=table_location + "/",
+          input_format=OUTPUT_FORMATS[OUTPUT_FORMAT]["input_format"],
+          output_format=OUTPUT_FORMATS[OUTPUT_FORMAT]["output_format"],
+          serde_info=aws_glue.CfnTable.SerdeInfoProperty(
+            serialization_library=OUTPUT_FORMATS[OUTPUT_FORMAT]["serialization_library"]
+          )
+        )
+      )
+    )
+    glue_table.add_dependency(glue_database)
+
+    #XXX: Records are flattened and their partition keys are extracted by the same function as the data transformation of FirehoseStack.
+    transform_lambda_fn = aws_lambda.Function(self, "FirehoseArchiveTransformFunction",
+      runtime=aws_lambda.Runtime.PYTHON_3_11,
+      function_name=f"FirehoseArchiveTransform-{TABLE_NAME}",
+      handler="index.lambda_handler",
+      description="Flatten AWS DMS records and extract their partition keys for Kinesis Data Firehose",
+      code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/FirehoseTransform')),
+      environment={
+        'DYNAMIC_PARTITIONING': 'true'
+      },
+      timeout=cdk.Duration.minutes(5),
+      memory_size=512,
+      log_retention=aws_logs.RetentionDays.THREE_DAYS
+    )
+
+    firehose_log_group_name = f"/aws/kinesisfirehose/cdc-archive-{TABLE_NAME}"
+
+    firehose_role_policy_doc = aws_iam.PolicyDocument()
+    firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(**{
+      "effect": aws_iam.Effect.ALLOW,
+      "resources": [s3_bucket.bucket_arn, "{}/*".format(s3_bucket.bucket_arn)],
+      "actions": ["s3:AbortMultipartUpload",
+        "s3:GetBucketLocation",
+        "s3:GetObject",
+        "s3:ListBucket",
+        "s3:ListBucketMultipartUploads",
+        "s3:PutObject"]
+    }))
+
+    firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[
+        self.format_arn(service="glue", resource="catalog"),
+        self.format_arn(service="glue", resource="database", resource_name=archive_config['glue_database_name']),
+        self.format_arn(service="glue", resource="table", resource_name=f"{archive_config['glue_database_name']}/{TABLE_NAME}")
+      ],
+      actions=["glue:GetTable",
+        "glue:GetTableVersion",
+        "glue:GetTableVersions"]
+    ))
+
+    firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[transform_lambda_fn.function_arn, f"{transform_lambda_fn.function_arn}:*"],
+      actions=["lambda:InvokeFunction",
+        "lambda:GetFunctionConfiguration"]
+    ))
+
+    firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[self.format_arn(service="logs", resource="log-group",
+        resource_name="{}:log-stream:*".format(firehose_log_group_name), arn_format=cdk.ArnFormat.COLON_RESOURCE_NAME)],
+      actions=["logs:PutLogEvents"]
+    ))
+
+    firehose_role = aws_iam.Role(self, "KinesisFirehoseArchiveServiceRole",
+      role_name=f"KinesisFirehoseArchiveServiceRole-{TABLE_NAME}-{cdk.Aws.REGION}",
+      assumed_by=aws_iam.ServicePrincipal("firehose.amazonaws.com"),
+      #XXX: use inline_policies to work around https://github.com/aws/aws-cdk/issues/5221
+      inline_policies={
+        "firehose_role_policy": firehose_role_policy_doc
+      },
+      managed_policies=[
+        aws_iam.ManagedPolicy.from_aws_managed_policy_name('AmazonKinesisReadOnlyAccess'),
+      ]
+    )
+
+    output_serializer = {"parquetSerDe": {"compression": "SNAPPY"}} if OUTPUT_FORMAT == "parquet" \
+      else {"orcSerDe": {"compression": "SNAPPY"}}
+
+    s3_dest_config = aws_kinesisfirehose.CfnDeliveryStream.ExtendedS3DestinationConfigurationProperty(
+      bucket_arn=s3_bucket.bucket_arn,
+      role_arn=firehose_role.role_arn,
+      #XXX: Large buffers make fewer and larger objects, which Athena scans much faster.
+      buffering_hints={
+        "intervalInSeconds": archive_config['buffer_interval_sec'],
+        "sizeInMBs": archive_config['buffer_size_mb']
+      },
+      cloud_watch_logging_options={
+        "enabled": True,
+        "logGroupName": firehose_log_group_name,
+        "logStreamName": "DestinationDelivery"
+      },
+      compression_format="UNCOMPRESSED", # the output format is compressed by its serializer
+      data_format_conversion_configuration={
+        "enabled": True,
+        "inputFormatConfiguration": {
+          "deserializer": {
+            "openXJsonSerDe": {
+              "caseInsensitive": True,
+              #XXX: Glue column names cannot contain hyphens
+              "columnToJsonKeyMappings": {name: key for name, _, key in RETAIL_TRANS_COLUMNS + DMS_METADATA_COLUMNS if name != key},
+              "convertDotsInJsonKeysToUnderscores": False
+            }
+          }
+        },
+        "outputFormatConfiguration": {
+          "serializer": output_serializer
+        },
+        "schemaConfiguration": {
+          "databaseName": archive_config['glue_database_name'],
+          "tableName": TABLE_NAME,
+          "region": cdk.Aws.REGION,
+          "roleArn": firehose_role.role_arn,
+          "versionId": "LATEST"
+        }
+      },
+      dynamic_partitioning_configuration={
+        "enabled": True,
+        "retryOptions": {
+          "durationInSeconds": 300
+        }
+      },
+      processing_configuration={
+        "enabled": True,
+        "processors": [{
+          "type": "Lambda",
+          "parameters": [
+            {"parameterName": "LambdaArn", "parameterValue": transform_lambda_fn.function_arn},
+            {"parameterName": "NumberOfRetries", "parameterValue": "3"},
+            {"parameterName": "BufferSizeInMBs", "parameterValue": "3"},
+            {"parameterName": "BufferIntervalInSeconds", "parameterValue": "60"}
+          ]
+        }]
+      },
+      prefix=S3_PREFIX + "/schema_name=!{partitionKeyFromLambda:schema_name}/table_name=!{partitionKeyFromLambda:table_name}"
+        "/operation=!{partitionKeyFromLambda:operation}/dt=!{partitionKeyFromLambda:dt}/",
+      error_output_prefix="error/!{firehose:error-output-type}/dt=!{timestamp:yyyy-MM-dd}/"
+    )
+
+    firehose_archive_delivery_stream = aws_kinesisfirehose.CfnDeliveryStream(self, "KinesisFirehoseToS3Archive",
+      delivery_stream_name=f"cdc-archive-{TABLE_NAME}",
+      delivery_stream_type="KinesisStreamAsSource",
+      kinesis_stream_source_configuration=aws_kinesisfirehose.CfnDeliveryStream.KinesisStreamSourceConfigurationProperty(
+        kinesis_stream_arn=kinesis_stream_arns[routing_group['name']],
+        role_arn=firehose_role.role_arn
+      ),
+      extended_s3_destination_configuration=s3_dest_config,
+      tags=[{"key": "Name", "value": f"cdc-archive-{TABLE_NAME}"}]
+    )
+    firehose_archive_delivery_stream.add_dependency(glue_table)
+
+    cdk.CfnOutput(self, 'ArchiveS3Bucket', value=s3_bucket.bucket_name, export_name=f'{self.stack_name}-ArchiveS3Bucket')
+    cdk.CfnOutput(self, 'ArchiveGlueTable', value=f"{archive_config['glue_database_name']}.{TABLE_NAME}",
+      export_name=f'{self.stack_name}-ArchiveGlueTable')
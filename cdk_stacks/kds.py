@@ -11,6 +11,9 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from .pipeline_profile import get_pipeline_settings
+from .routing_groups import get_routing_groups
+
 
 class KinesisDataStreamStack(Stack):
 
@@ -20,17 +23,31 @@ class KinesisDataStreamStack(Stack):
     KINESIS_DEFAULT_STREAM_NAME = f'PUT-{self.stack_name.lower()}'
     kinesis_stream_name = self.node.try_get_context('kinesis_stream_name') or KINESIS_DEFAULT_STREAM_NAME
 
-    kinesis_stream = aws_kinesis.Stream(self, 'DMSTargetKinesisStream',
-      retention_period=Duration.hours(24),
-      stream_mode=aws_kinesis.StreamMode.ON_DEMAND,
-      stream_name=kinesis_stream_name
-    )
-
-    self.kinesis_stream_name = kinesis_stream.stream_name
-    self.kinesis_stream_arn = kinesis_stream.stream_arn
-
-    cdk.CfnOutput(self, 'DMSTargetKinesisStreamName', value=self.kinesis_stream_name,
-      export_name=f'{self.stack_name}-DMSTargetKinesisStreamName')
-    cdk.CfnOutput(self, 'DMSTargetKinesisStreamArn', value=self.kinesis_stream_arn,
-      export_name=f'{self.stack_name}-DMSTargetKinesisStreamArn')
-
+    #XXX: Use utils/kinesis_shard_sizing.py to find out the shard count of a PROVISIONED stream for your workload.
+    pipeline_settings = get_pipeline_settings(self)
+
+    self.kinesis_stream_names = {}
+    self.kinesis_stream_arns = {}
+    self.kinesis_shard_counts = {}
+    for routing_group in get_routing_groups(self):
+      #XXX: A routing group can override the capacity of its own stream, e.g. more shards for a hot table.
+      kinesis_stream_mode = routing_group['kinesis_stream_mode'] or pipeline_settings['kinesis_stream_mode']
+      assert kinesis_stream_mode in ('ON_DEMAND', 'PROVISIONED'), 'Invalid kinesis_stream_mode'
+      kinesis_shard_count = int(routing_group['kinesis_shard_count'] or pipeline_settings['kinesis_shard_count'] or 1) \
+        if kinesis_stream_mode == 'PROVISIONED' else None
+
+      kinesis_stream = aws_kinesis.Stream(self, f"DMSTargetKinesisStream{routing_group['construct_id_suffix']}",
+        retention_period=Duration.hours(24),
+        stream_mode=getattr(aws_kinesis.StreamMode, kinesis_stream_mode),
+        shard_count=kinesis_shard_count,
+        stream_name=f"{kinesis_stream_name}{routing_group['name_suffix']}"
+      )
+
+      self.kinesis_stream_names[routing_group['name']] = kinesis_stream.stream_name
+      self.kinesis_stream_arns[routing_group['name']] = kinesis_stream.stream_arn
+      self.kinesis_shard_counts[routing_group['name']] = kinesis_shard_count
+
+      cdk.CfnOutput(self, f"DMSTargetKinesisStreamName{routing_group['construct_id_suffix']}", value=kinesis_stream.stream_name,
+        export_name=f"{self.stack_name}-DMSTargetKinesisStreamName{routing_group['construct_id_suffix']}")
+      cdk.CfnOutput(self, f"DMSTargetKinesisStreamArn{routing_group['construct_id_suffix']}", value=kinesis_stream.stream_arn,
+        export_name=f"{self.stack_name}-DMSTargetKinesisStreamArn{routing_group['construct_id_suffix']}")
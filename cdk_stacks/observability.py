@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import aws_cdk as cdk
+
+from aws_cdk import (
+  Duration,
+  Stack,
+  aws_cloudwatch as cw,
+  aws_cloudwatch_actions as cw_actions,
+  aws_sns,
+  aws_sns_subscriptions
+)
+from constructs import Construct
+
+from .pipeline_profile import get_pipeline_settings
+from .routing_groups import get_routing_groups
+
+#XXX: The write capacity of a shard of a PROVISIONED Kinesis Data Stream
+# https://docs.aws.amazon.com/streams/latest/dev/service-sizes-and-limits.html
+KINESIS_SHARD_RECORDS_PER_SEC = 1000
+KINESIS_SHARD_BYTES_PER_SEC = 1024 * 1024
+
+PERIOD = Duration.minutes(1)
+
+
+def _alarm_thresholds(scope, pipeline_settings):
+  '''Returns the alarm thresholds of the `pipeline_alarms` context, with defaults derived from the pipeline settings.'''
+
+  return {
+    "dms_cdc_latency_sec": 300,
+    "kinesis_iterator_age_sec": 300,
+    #XXX: Kinesis Data Firehose holds records for up to a buffer interval before it delivers them.
+    "firehose_data_freshness_sec": pipeline_settings['firehose_buffer_interval_sec'] + 300,
+    "kinesis_utilization_percent": 80,
+    "opensearch_jvm_memory_pressure_percent": 80,
+    **(scope.node.try_get_context('pipeline_alarms') or {})
+  }
+
+
+class PipelineObservabilityStack(Stack):
+
+  def __init__(self, scope: Construct, construct_id: str,
+              dms_metric_dimensions, kinesis_stream_names, kinesis_shard_counts,
+              delivery_stream_names, ops_domain_name,
+              **kwargs) -> None:
+
+    super().__init__(scope, construct_id, **kwargs)
+
+    pipeline_settings = get_pipeline_settings(self)
+    thresholds = _alarm_thresholds(self, pipeline_settings)
+    routing_groups = get_routing_groups(self)
+
+    alarm_topic = aws_sns.Topic(self, 'PipelineAlarmTopic',
+      display_name='AWS DMS CDC data pipeline alarms')
+    alarm_email = (self.node.try_get_context('pipeline_alarms') or {}).get('alarm_email')
+    if alarm_email:
+      alarm_topic.add_subscription(aws_sns_subscriptions.EmailSubscription(alarm_email))
+    alarm_action = cw_actions.SnsAction(alarm_topic)
+
+    def add_alarm(construct_id, metric, threshold, description, evaluation_periods=5, datapoints_to_alarm=3,
+                  comparison_operator=cw.ComparisonOperator.GREATER_THAN_THRESHOLD):
+      alarm = cw.Alarm(self, construct_id,
+        metric=metric,
+        threshold=threshold,
+        evaluation_periods=evaluation_periods,
+        datapoints_to_alarm=datapoints_to_alarm,
+        comparison_operator=comparison_operator,
+        treat_missing_data=cw.TreatMissingData.NOT_BREACHING,
+        alarm_description=description
+      )
+      alarm.add_alarm_action(alarm_action)
+      alarm.add_ok_action(alarm_action)
+      return alarm
+
+    #XXX: OpenSearch Service publishes domain metrics with the account id as the ClientId dimension.
+    # https://docs.aws.amazon.com/opensearch-service/latest/developerguide/managedomains-cloudwatchmetrics.html
+    ops_dimensions = {"DomainName": ops_domain_name, "ClientId": cdk.Aws.ACCOUNT_ID}
+
+    def ops_metric(metric_name, statistic='Maximum', label=None):
+      return cw.Metric(namespace='AWS/ES', metric_name=metric_name, dimensions_map=ops_dimensions,
+        statistic=statistic, period=PERIOD, label=label)
+
+    dashboard = cw.Dashboard(self, 'PipelineDashboard',
+      dashboard_name=self.stack_name,
+      default_interval=Duration.hours(3)
+    )
+
+    alarms = []
+    for routing_group in routing_groups:
+      group_name = routing_group['name']
+      construct_id_suffix = routing_group['construct_id_suffix']
+      kinesis_stream_name = kinesis_stream_names[group_name]
+      delivery_stream_name = delivery_stream_names[group_name]
+      kinesis_shard_count = kinesis_shard_counts[group_name]
+
+      dms_dimensions = dms_metric_dimensions[group_name]
+
+      def dms_metric(metric_name, statistic='Maximum', label=None):
+        return cw.Metric(namespace='AWS/DMS', metric_name=metric_name, dimensions_map=dms_dimensions,
+          statistic=statistic, period=PERIOD, label=label)
+
+      def kinesis_metric(metric_name, statistic='Maximum', label=None):
+        return cw.Metric(namespace='AWS/Kinesis', metric_name=metric_name, dimensions_map={"StreamName": kinesis_stream_name},
+          statistic=statistic, period=PERIOD, label=label)
+
+      def firehose_metric(metric_name, statistic='Maximum', label=None):
+        return cw.Metric(namespace='AWS/Firehose', metric_name=metric_name, dimensions_map={"DeliveryStreamName": delivery_stream_name},
+          statistic=statistic, period=PERIOD, label=label)
+
+      cdc_latency_source = dms_metric('CDCLatencySource', label='DMS source latency (sec)')
+      cdc_latency_target = dms_metric('CDCLatencyTarget', label='DMS target latency (sec)')
+      iterator_age = kinesis_metric('GetRecords.IteratorAgeMilliseconds', label='Kinesis iterator age (ms)')
+      millis_behind_latest = firehose_metric('KinesisMillisBehindLatest', label='Firehose behind Kinesis (ms)')
+      data_freshness = firehose_metric('DeliveryToAmazonOpenSearchService.DataFreshness', label='Firehose data freshness (sec)')
+
+      #XXX: Each stage is the difference between the lag at its end and the lag at its start,
+      # so that the stacked stages add up to the end-to-end latency.
+      latency_breakdown = [
+        cw.MathExpression(expression='src', using_metrics={"src": cdc_latency_source},
+          label='Binlog -> DMS', period=PERIOD),
+        cw.MathExpression(expression='IF(tgt > src, tgt - src, 0)', using_metrics={"src": cdc_latency_source, "tgt": cdc_latency_target},
+          label='DMS -> Kinesis', period=PERIOD),
+        cw.MathExpression(expression='behind / 1000', using_metrics={"behind": millis_behind_latest},
+          label='Kinesis -> Firehose', period=PERIOD),
+        cw.MathExpression(expression='IF(fresh > behind / 1000, fresh - behind / 1000, 0)', using_metrics={"fresh": data_freshness, "behind": millis_behind_latest},
+          label='Firehose -> OpenSearch', period=PERIOD)
+      ]
+
+      incoming_records = kinesis_metric('IncomingRecords', statistic='Sum', label='Kinesis incoming records')
+      incoming_bytes = kinesis_metric('IncomingBytes', statistic='Sum', label='Kinesis incoming bytes')
+      write_throttled = kinesis_metric('WriteProvisionedThroughputExceeded', statistic='Sum', label='Kinesis write throttled')
+      if kinesis_shard_count:
+        period_sec = int(PERIOD.to_seconds())
+        kinesis_utilization = cw.MathExpression(
+          expression=f'100 * MAX([records / {period_sec * KINESIS_SHARD_RECORDS_PER_SEC * kinesis_shard_count}, '
+            f'bytes / {period_sec * KINESIS_SHARD_BYTES_PER_SEC * kinesis_shard_count}])',
+          using_metrics={"records": incoming_records, "bytes": incoming_bytes},
+          label=f'Kinesis write utilization of {kinesis_shard_count} shards (%)', period=PERIOD)
+      else:
+        #XXX: ON_DEMAND streams scale their capacity, so throttled writes are the only sign of running out of it.
+        kinesis_utilization = None
+
+      delivery_ratio = cw.MathExpression(
+        expression='IF(read > 0, 100 * delivered / read, 0)',
+        using_metrics={
+          "delivered": firehose_metric('DeliveryToAmazonOpenSearchService.Records', statistic='Sum'),
+          "read": firehose_metric('DataReadFromKinesisStream.Records', statistic='Sum')
+        },
+        label='Firehose delivered / read from Kinesis (%)', period=PERIOD)
+      apply_ratio = cw.MathExpression(
+        expression='IF(incoming > 0, 100 * applied / incoming, 0)',
+        using_metrics={
+          "applied": dms_metric('CDCThroughputRowsTarget', statistic='Average'),
+          "incoming": dms_metric('CDCThroughputRowsSource', statistic='Average')
+        },
+        label='DMS rows applied / captured (%)', period=PERIOD)
+
+      dashboard.add_widgets(cw.TextWidget(
+        markdown=f'## {group_name}: `{kinesis_stream_name}` -> `{delivery_stream_name}`', width=24, height=1))
+      dashboard.add_widgets(
+        cw.GraphWidget(title=f'Latency by stage (sec) - {group_name}', left=latency_breakdown, stacked=True, width=12,
+          left_y_axis=cw.YAxisProps(min=0, show_units=False)),
+        cw.GraphWidget(title=f'Lag - {group_name}', width=12,
+          left=[cdc_latency_source, cdc_latency_target, data_freshness],
+          right=[iterator_age, millis_behind_latest],
+          left_y_axis=cw.YAxisProps(min=0, label='sec', show_units=False),
+          right_y_axis=cw.YAxisProps(min=0, label='ms', show_units=False))
+      )
+      dashboard.add_widgets(
+        cw.GraphWidget(title=f'Throughput vs capacity (%) - {group_name}', width=12,
+          left=[m for m in (kinesis_utilization, delivery_ratio, apply_ratio) if m],
+          right=[write_throttled],
+          left_y_axis=cw.YAxisProps(min=0, show_units=False),
+          left_annotations=[cw.HorizontalAnnotation(value=thresholds['kinesis_utilization_percent'], label='Kinesis utilization alarm')]
+            if kinesis_utilization else None),
+        cw.GraphWidget(title=f'Throughput (records/min) - {group_name}', width=12,
+          left=[
+            dms_metric('CDCIncomingChanges', label='DMS incoming changes'),
+            incoming_records,
+            firehose_metric('DeliveryToAmazonOpenSearchService.Records', statistic='Sum', label='Firehose delivered records')
+          ],
+          right=[firehose_metric('DeliveryToAmazonOpenSearchService.Success', statistic='Average', label='Firehose delivery success')],
+          left_y_axis=cw.YAxisProps(min=0, show_units=False))
+      )
+
+      alarms.append(add_alarm(f'DMSCDCLatencySourceAlarm{construct_id_suffix}', cdc_latency_source,
+        thresholds['dms_cdc_latency_sec'],
+        f'{group_name}: AWS DMS reads the binlog more than {thresholds["dms_cdc_latency_sec"]} seconds behind the source'))
+      alarms.append(add_alarm(f'DMSCDCLatencyTargetAlarm{construct_id_suffix}', cdc_latency_target,
+        thresholds['dms_cdc_latency_sec'],
+        f'{group_name}: AWS DMS writes changes more than {thresholds["dms_cdc_latency_sec"]} seconds after they are committed'))
+      alarms.append(add_alarm(f'KinesisIteratorAgeAlarm{construct_id_suffix}', iterator_age,
+        thresholds['kinesis_iterator_age_sec'] * 1000,
+        f'{group_name}: consumers of {kinesis_stream_name} are more than {thresholds["kinesis_iterator_age_sec"]} seconds behind'))
+      alarms.append(add_alarm(f'KinesisWriteThrottledAlarm{construct_id_suffix}', write_throttled, 0,
+        f'{group_name}: writes to {kinesis_stream_name} are throttled'))
+      if kinesis_utilization:
+        alarms.append(add_alarm(f'KinesisUtilizationAlarm{construct_id_suffix}', kinesis_utilization,
+          thresholds['kinesis_utilization_percent'],
+          f'{group_name}: {kinesis_stream_name} uses more than {thresholds["kinesis_utilization_percent"]}% of the write capacity of its shards'))
+      alarms.append(add_alarm(f'FirehoseDataFreshnessAlarm{construct_id_suffix}', data_freshness,
+        thresholds['firehose_data_freshness_sec'],
+        f'{group_name}: {delivery_stream_name} delivers records older than {thresholds["firehose_data_freshness_sec"]} seconds'))
+
+    write_rejected = ops_metric('ThreadpoolWriteRejected', label='Write threadpool rejected')
+    dashboard.add_widgets(cw.TextWidget(markdown=f'## OpenSearch domain: `{ops_domain_name}`', width=24, height=1))
+    dashboard.add_widgets(
+      cw.GraphWidget(title='OpenSearch indexing', width=12,
+        left=[ops_metric('IndexingRate', statistic='Average', label='Indexing rate (docs/sec)')],
+        right=[ops_metric('IndexingLatency', statistic='Average', label='Indexing latency (ms)')],
+        left_y_axis=cw.YAxisProps(min=0, show_units=False),
+        right_y_axis=cw.YAxisProps(min=0, show_units=False)),
+      cw.GraphWidget(title='OpenSearch indexing rejections', width=12,
+        left=[write_rejected, ops_metric('ThreadpoolWriteQueue', label='Write threadpool queue')],
+        right=[ops_metric('JVMMemoryPressure', label='JVM memory pressure (%)'), ops_metric('CPUUtilization', label='CPU utilization (%)')],
+        left_y_axis=cw.YAxisProps(min=0, show_units=False),
+        right_y_axis=cw.YAxisProps(min=0, max=100, show_units=False))
+    )
+
+    alarms.append(add_alarm('OpenSearchWriteRejectedAlarm', write_rejected, 0,
+      'OpenSearch rejects indexing requests, so that Kinesis Data Firehose retries and falls behind'))
+    alarms.append(add_alarm('OpenSearchJVMMemoryPressureAlarm', ops_metric('JVMMemoryPressure'),
+      thresholds['opensearch_jvm_memory_pressure_percent'],
+      f'OpenSearch JVM memory pressure is above {thresholds["opensearch_jvm_memory_pressure_percent"]}%'))
+    alarms.append(add_alarm('OpenSearchClusterStatusRedAlarm', ops_metric('ClusterStatus.red'), 1,
+      'At least one primary shard of the OpenSearch domain is not allocated',
+      evaluation_periods=1, datapoints_to_alarm=1,
+      comparison_operator=cw.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD))
+
+    dashboard.add_widgets(cw.AlarmStatusWidget(title='Alarms', alarms=alarms, width=24))
+
+    cdk.CfnOutput(self, 'PipelineDashboardName', value=dashboard.dashboard_name,
+      export_name=f'{self.stack_name}-DashboardName')
+    cdk.CfnOutput(self, 'PipelineAlarmTopicArn', value=alarm_topic.topic_arn,
+      export_name=f'{self.stack_name}-AlarmTopicArn')
@@ -3,6 +3,7 @@
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
 import json
+import os
 import re
 
 import aws_cdk as cdk
@@ -10,11 +11,16 @@ import aws_cdk as cdk
 from aws_cdk import (
   Stack,
   aws_ec2,
+  aws_lambda,
+  aws_logs,
   aws_opensearchservice,
-  aws_secretsmanager
+  aws_secretsmanager,
+  custom_resources
 )
 from constructs import Construct
 
+from .pipeline_profile import get_pipeline_settings
+
 
 class OpenSearchStack(Stack):
 
@@ -27,6 +33,8 @@ class OpenSearchStack(Stack):
     opensearch_domain_name = self.node.try_get_context('opensearch_domain_name') or OPENSEARCH_DEFAULT_DOMAIN_NAME
     assert re.fullmatch(r'([a-z][a-z0-9\-]+){3,28}?', opensearch_domain_name), 'Invalid domain name'
 
+    pipeline_settings = get_pipeline_settings(self)
+
     sg_use_opensearch = aws_ec2.SecurityGroup(self, "OpenSearchClientSG",
       vpc=vpc,
       allow_all_outbound=True,
@@ -74,9 +82,9 @@ class OpenSearchStack(Stack):
       # Use graviton instances as data nodes or use non-graviton instances as master nodes.
       capacity={
         "master_nodes": 3,
-        "master_node_instance_type": "r6g.large.search",
-        "data_nodes": 3,
-        "data_node_instance_type": "r6g.large.search"
+        "master_node_instance_type": pipeline_settings['opensearch_master_node_instance_type'],
+        "data_nodes": pipeline_settings['opensearch_data_nodes'],
+        "data_node_instance_type": pipeline_settings['opensearch_data_node_instance_type']
       },
       ebs={
         "volume_size": 10,
@@ -115,6 +123,120 @@ class OpenSearchStack(Stack):
     )
     cdk.Tags.of(opensearch_domain).add('Name', opensearch_domain_name)
     self.ops_domain_arn = opensearch_domain.domain_arn
+    self.ops_domain_endpoint = opensearch_domain.domain_endpoint
+    self.ops_domain_name = opensearch_domain.domain_name
+
+    #XXX: Provision an index template (and an ISM policy for rotated indices) for the indices of the pipeline
+    OPENSEARCH_INDEX_NAME = self.node.try_get_context('opensearch_index_name')
+    index_settings = {
+      "number_of_shards": 3,
+      "number_of_replicas": 1,
+      #XXX: A longer refresh interval makes indexing cheaper at the cost of search freshness.
+      "refresh_interval": pipeline_settings['opensearch_refresh_interval'],
+      **(self.node.try_get_context('opensearch_index_settings') or {})
+    }
+
+    keyword = {"type": "keyword"}
+    date = {"type": "date", "format": "strict_date_optional_time||epoch_millis"}
+    retail_trans_properties = {
+      "trans_id": {"type": "long"},
+      "customer_id": keyword,
+      "event": keyword,
+      "sku": keyword,
+      "amount": {"type": "integer"},
+      "device": keyword,
+      "trans_datetime": date
+    }
+    index_template = {
+      #XXX: The original index, the rotated ones (e.g. retail-trans-2023-01-01) and the upsert one (e.g. retail-trans_current)
+      "index_patterns": [f"{OPENSEARCH_INDEX_NAME}*"],
+      "template": {
+        "settings": {"index": index_settings},
+        "mappings": {
+          "properties": {
+            # records flattened by the Kinesis Data Firehose data transformation or the upsert Lambda function
+            **retail_trans_properties,
+            "_timestamp": date,
+            "_operation": keyword,
+            "_schema-name": keyword,
+            "_table-name": keyword,
+            "_transaction-id": {"type": "long"},
+            "_deleted": {"type": "boolean"},
+            # records as they are delivered by AWS DMS
+            "data": {"properties": retail_trans_properties},
+            "metadata": {
+              "properties": {
+                "timestamp": date,
+                "record-type": keyword,
+                "operation": keyword,
+                "partition-key-type": keyword,
+                "schema-name": keyword,
+                "table-name": keyword,
+                "transaction-id": {"type": "long"}
+              }
+            }
+          }
+        }
+      },
+      "priority": 100
+    }
+
+    #XXX: Rotated indices get fewer replicas once they are no longer written to, and are deleted later.
+    index_lifecycle = {
+      "reduce_replicas_after": "7d",
+      "reduced_number_of_replicas": 0,
+      "delete_after": "30d",
+      **(self.node.try_get_context('opensearch_index_lifecycle') or {})
+    }
+    ism_states = [{"name": "hot", "actions": [], "transitions": []}]
+    if index_lifecycle['reduce_replicas_after']:
+      ism_states[-1]["transitions"].append({"state_name": "warm", "conditions": {"min_index_age": index_lifecycle['reduce_replicas_after']}})
+      ism_states.append({"name": "warm", "actions": [
+        {"replica_count": {"number_of_replicas": index_lifecycle['reduced_number_of_replicas']}},
+        {"force_merge": {"max_num_segments": 1}}
+      ], "transitions": []})
+    if index_lifecycle['delete_after']:
+      ism_states[-1]["transitions"].append({"state_name": "delete", "conditions": {"min_index_age": index_lifecycle['delete_after']}})
+      ism_states.append({"name": "delete", "actions": [{"delete": {}}], "transitions": []})
+    ism_policy = {
+      "description": f"Reduce replicas of and delete rotated {OPENSEARCH_INDEX_NAME} indices",
+      "default_state": "hot",
+      "states": ism_states,
+      #XXX: Only rotated indices (e.g. retail-trans-2023-01-01 or retail-trans-orders-2023-01-01),
+      # not the indices of routing groups (e.g. retail-trans-orders) or the upsert index.
+      "ism_template": [{"index_patterns": [f"{OPENSEARCH_INDEX_NAME}*-20*"], "priority": 100}]
+    }
+
+    index_template_lambda_fn = aws_lambda.Function(self, "OpenSearchIndexTemplateFunction",
+      runtime=aws_lambda.Runtime.PYTHON_3_11,
+      handler="index.on_event",
+      description="Put an index template and an ISM policy into Amazon OpenSearch Service",
+      code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/OpenSearchIndexTemplate')),
+      timeout=cdk.Duration.minutes(5),
+      vpc=vpc,
+      vpc_subnets=aws_ec2.SubnetSelection(subnet_type=aws_ec2.SubnetType.PRIVATE_WITH_EGRESS),
+      security_groups=[sg_use_opensearch],
+      log_retention=aws_logs.RetentionDays.THREE_DAYS
+    )
+    master_user_secret.grant_read(index_template_lambda_fn)
+
+    index_template_provider = custom_resources.Provider(self, "OpenSearchIndexTemplateProvider",
+      on_event_handler=index_template_lambda_fn,
+      log_retention=aws_logs.RetentionDays.THREE_DAYS
+    )
+
+    index_template_resource = cdk.CustomResource(self, "OpenSearchIndexTemplate",
+      service_token=index_template_provider.service_token,
+      properties={
+        "DomainEndpoint": opensearch_domain.domain_endpoint,
+        "MasterUserSecretId": master_user_secret.secret_arn,
+        "TemplateName": OPENSEARCH_INDEX_NAME,
+        "IndexTemplate": json.dumps(index_template),
+        "PolicyId": f"{OPENSEARCH_INDEX_NAME}-lifecycle" if len(ism_states) > 1 else "",
+        "IsmPolicy": json.dumps(ism_policy)
+      }
+    )
+    index_template_resource.node.add_dependency(opensearch_domain)
 
 
     cdk.CfnOutput(self, 'OpenSearchDomainEndpoint',
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+import os
+import re
+
+import aws_cdk as cdk
+
+from aws_cdk import (
+  Stack,
+  aws_ec2,
+  aws_iam,
+  aws_kinesis,
+  aws_lambda,
+  aws_lambda_event_sources,
+  aws_logs
+)
+from constructs import Construct
+
+from .routing_groups import get_routing_groups, is_wildcard, table_primary_keys
+
+
+class OpenSearchRollupStack(Stack):
+
+  def __init__(self, scope: Construct, construct_id: str, vpc, kinesis_stream_arns, ops_domain_arn, ops_domain_endpoint, ops_client_sg_id, **kwargs) -> None:
+    super().__init__(scope, construct_id, **kwargs)
+
+    #XXX: Dashboards query per-minute counts and sums from a small rollup index
+    # instead of aggregating over every change document of the tables.
+    OPENSEARCH_INDEX_NAME = self.node.try_get_context('opensearch_index_name')
+    database_name = self.node.try_get_context('dms_data_source')['database_name']
+    routing_groups = get_routing_groups(self)
+    #XXX: The default dimensions and measure are columns of `retail_trans`, i.e. the first table listed by name,
+    # and not of the other tables like `pipeline_heartbeat`.
+    rollup_settings = {
+      "index_name": f'{OPENSEARCH_INDEX_NAME}_rollup',
+      "tables": [t for g in routing_groups for t in g['tables'] if not is_wildcard(t)][:1],
+      "dimensions": ["event", "device", "sku"],
+      "measure_field": "amount",
+      "time_field": "trans_datetime",
+      "window_minutes": 1,
+      "tumbling_window_sec": 60,
+      "batch_size": 1000,
+      **(self.node.try_get_context('opensearch_rollup') or {})
+    }
+    assert re.fullmatch(r'[a-z][a-z0-9\-_]+', rollup_settings['index_name']), 'Invalid index name'
+    assert rollup_settings['dimensions'], 'opensearch_rollup.dimensions should not be empty'
+    assert 60 % rollup_settings['window_minutes'] == 0, 'opensearch_rollup.window_minutes should be a divisor of 60'
+    #XXX: Lambda keeps the state of a tumbling window for up to 15 minutes.
+    # https://docs.aws.amazon.com/lambda/latest/dg/with-kinesis-windows.html
+    assert 1 <= rollup_settings['tumbling_window_sec'] <= 900, 'opensearch_rollup.tumbling_window_sec should be between 1 and 900'
+    assert 1 <= rollup_settings['batch_size'] <= 10000, 'opensearch_rollup.batch_size should be between 1 and 10000'
+
+    #XXX: Deletes and updates are subtracted by primary key, so the tables to roll up cannot be `%` patterns.
+    if not isinstance(rollup_settings['tables'], list):
+      rollup_settings['tables'] = [rollup_settings['tables']]
+    primary_keys = {f'{database_name}.{table_name}': columns
+      for routing_group in routing_groups for table_name, columns in table_primary_keys(routing_group).items()
+      if table_name in rollup_settings['tables']}
+    rollup_routing_groups = [routing_group for routing_group in routing_groups
+      if any(table_name in rollup_settings['tables'] for table_name in routing_group['tables'])]
+    for table_name in rollup_settings['tables']:
+      if f'{database_name}.{table_name}' not in primary_keys:
+        cdk.Annotations.of(self).add_warning(
+          f'opensearch_rollup.tables: {table_name} is not listed by name in dms_data_source, so it is not rolled up')
+    if not primary_keys:
+      #XXX: The rollup stage is optional, so the other stacks of the app are still synthesized without it.
+      cdk.Annotations.of(self).add_warning('No table to roll up, so OpenSearchRollupStack is left empty')
+      return
+    #XXX: Updates are subtracted by the previous values of the row, which only the DMS task can tell reliably.
+    if not self.node.try_get_context('dms_before_image'):
+      cdk.Annotations.of(self).add_warning(
+        'dms_before_image should be true for the updates to be rolled up, so OpenSearchRollupStack is left empty')
+      return
+
+    bulk_writer_layer = aws_lambda.LayerVersion(self, "OpenSearchBulkWriterLayer",
+      code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/OpenSearchBulkWriter')),
+      compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_11],
+      description="Adaptive bulk writer for Amazon OpenSearch Service"
+    )
+
+    rollup_lambda_fn = aws_lambda.Function(self, "OpenSearchRollupFunction",
+      runtime=aws_lambda.Runtime.PYTHON_3_11,
+      function_name=f"OpenSearchRollup-{rollup_settings['index_name']}",
+      handler="index.lambda_handler",
+      description="Roll up AWS DMS records into per-minute aggregates in Amazon OpenSearch Service",
+      code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/OpenSearchRollup')),
+      environment={
+        'OPENSEARCH_ENDPOINT': ops_domain_endpoint,
+        'INDEX_NAME': rollup_settings['index_name'],
+        'PRIMARY_KEYS': json.dumps(primary_keys),
+        'DIMENSIONS': ','.join(rollup_settings['dimensions']),
+        'MEASURE_FIELD': rollup_settings['measure_field'],
+        'TIME_FIELD': rollup_settings['time_field'],
+        'ROLLUP_WINDOW_MINUTES': str(rollup_settings['window_minutes'])
+      },
+      layers=[bulk_writer_layer],
+      timeout=cdk.Duration.minutes(5),
+      memory_size=512,
+      vpc=vpc,
+      vpc_subnets=aws_ec2.SubnetSelection(subnet_type=aws_ec2.SubnetType.PRIVATE_WITH_EGRESS),
+      security_groups=[aws_ec2.SecurityGroup.from_security_group_id(self, "OpenSearchClientSG", ops_client_sg_id)],
+      log_retention=aws_logs.RetentionDays.THREE_DAYS
+    )
+
+    rollup_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[ops_domain_arn, "{}/*".format(ops_domain_arn)],
+      actions=["es:ESHttpPost",
+        "es:ESHttpPut"]
+    ))
+
+    for routing_group in rollup_routing_groups:
+      construct_id_suffix = routing_group['construct_id_suffix']
+      kinesis_stream = aws_kinesis.Stream.from_stream_arn(self, f"KinesisStream{construct_id_suffix}",
+        kinesis_stream_arns[routing_group['name']])
+      rollup_lambda_fn.add_event_source(aws_lambda_event_sources.KinesisEventSource(kinesis_stream,
+        starting_position=aws_lambda.StartingPosition.LATEST,
+        batch_size=rollup_settings['batch_size'],
+        max_batching_window=cdk.Duration.seconds(1),
+        #XXX: Lambda passes the aggregates of a shard from one invocation to the next within a window,
+        # and a failed window is retried from its start with an empty state, which writes the same documents.
+        tumbling_window=cdk.Duration.seconds(rollup_settings['tumbling_window_sec']),
+        retry_attempts=10
+      ))
+
+    cdk.CfnOutput(self, 'RollupIndexName', value=rollup_settings['index_name'], export_name=f'{self.stack_name}-RollupIndexName')
+    cdk.CfnOutput(self, 'RollupFunctionRoleArn', value=rollup_lambda_fn.role.role_arn, export_name=f'{self.stack_name}-RollupFunctionRoleArn')
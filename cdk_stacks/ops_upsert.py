@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+import os
+import re
+
+import aws_cdk as cdk
+
+from aws_cdk import (
+  Stack,
+  aws_ec2,
+  aws_iam,
+  aws_kinesis,
+  aws_lambda,
+  aws_lambda_event_sources,
+  aws_logs
+)
+from constructs import Construct
+
+from .routing_groups import get_routing_groups, table_primary_keys
+
+
+class OpenSearchUpsertStack(Stack):
+
+  def __init__(self, scope: Construct, construct_id: str, vpc, kinesis_stream_arns, ops_domain_arn, ops_domain_endpoint, ops_client_sg_id, **kwargs) -> None:
+    super().__init__(scope, construct_id, **kwargs)
+
+    #XXX: Documents keyed on the primary key hold the current state of each row,
+    # so they go to another index than the one Kinesis Data Firehose appends every change to.
+    OPENSEARCH_INDEX_NAME = self.node.try_get_context('opensearch_index_name')
+    upsert_index_name = self.node.try_get_context('opensearch_upsert_index_name') or f'{OPENSEARCH_INDEX_NAME}_current'
+    assert re.fullmatch(r'[a-z][a-z0-9\-_]+', upsert_index_name), 'Invalid index name'
+
+    #XXX: Documents of every routing group are upserted into the same index, as their ids start with <schema>.<table>.
+    # Tables matched only by `%` patterns have no known primary key, so their documents get auto-generated ids.
+    database_name = self.node.try_get_context('dms_data_source')['database_name']
+    routing_groups = get_routing_groups(self)
+    primary_keys = {f'{database_name}.{table_name}': columns
+      for routing_group in routing_groups for table_name, columns in table_primary_keys(routing_group).items()}
+
+    delete_mode = self.node.try_get_context('opensearch_upsert_delete_mode') or 'tombstone'
+    assert delete_mode in ('tombstone', 'delete'), 'Invalid opensearch_upsert_delete_mode'
+
+    #XXX: With enhanced fan-out, the function gets its own 2 MB/s per shard pushed over HTTP/2 as soon as records arrive,
+    # instead of polling once per second and sharing the read throughput of the stream with Kinesis Data Firehose.
+    # https://docs.aws.amazon.com/lambda/latest/dg/with-kinesis.html#services-kinesis-configure
+    consumer_settings = {
+      "enhanced_fan_out": False,
+      "batch_size": 500,
+      "max_batching_window_sec": 1,
+      "parallelization_factor": None,
+      **(self.node.try_get_context('opensearch_upsert_consumer') or {})
+    }
+    assert 1 <= consumer_settings['batch_size'] <= 10000, 'opensearch_upsert_consumer.batch_size should be between 1 and 10000'
+    assert 0 <= consumer_settings['max_batching_window_sec'] <= 300, \
+      'opensearch_upsert_consumer.max_batching_window_sec should be between 0 and 300'
+    assert consumer_settings['parallelization_factor'] is None or 1 <= consumer_settings['parallelization_factor'] <= 10, \
+      'opensearch_upsert_consumer.parallelization_factor should be between 1 and 10'
+
+    #XXX: The adaptive `_bulk` writer is a layer, so that other consumers of the streams can share it.
+    bulk_writer_layer = aws_lambda.LayerVersion(self, "OpenSearchBulkWriterLayer",
+      code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/OpenSearchBulkWriter')),
+      compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_11],
+      description="Adaptive bulk writer for Amazon OpenSearch Service"
+    )
+
+    upsert_lambda_fn = aws_lambda.Function(self, "OpenSearchUpsertFunction",
+      runtime=aws_lambda.Runtime.PYTHON_3_11,
+      function_name=f"OpenSearchUpsert-{upsert_index_name}",
+      handler="index.lambda_handler",
+      description="Upsert AWS DMS records into Amazon OpenSearch Service by primary key",
+      code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/OpenSearchUpsert')),
+      environment={
+        'OPENSEARCH_ENDPOINT': ops_domain_endpoint,
+        'INDEX_NAME': upsert_index_name,
+        'PRIMARY_KEYS': json.dumps(primary_keys),
+        'DELETE_MODE': delete_mode
+      },
+      layers=[bulk_writer_layer],
+      timeout=cdk.Duration.minutes(5),
+      memory_size=512,
+      vpc=vpc,
+      vpc_subnets=aws_ec2.SubnetSelection(subnet_type=aws_ec2.SubnetType.PRIVATE_WITH_EGRESS),
+      security_groups=[aws_ec2.SecurityGroup.from_security_group_id(self, "OpenSearchClientSG", ops_client_sg_id)],
+      log_retention=aws_logs.RetentionDays.THREE_DAYS
+    )
+
+    upsert_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[ops_domain_arn, "{}/*".format(ops_domain_arn)],
+      actions=["es:ESHttpPost",
+        "es:ESHttpPut"]
+    ))
+
+    event_source_settings = dict(
+      starting_position=aws_lambda.StartingPosition.LATEST,
+      batch_size=consumer_settings['batch_size'],
+      max_batching_window=cdk.Duration.seconds(consumer_settings['max_batching_window_sec']),
+      #XXX: Shards are processed by up to this many concurrent invocations, each in order of partition keys,
+      # which keeps the changes of a row in order since DMS uses the primary key as the partition key.
+      parallelization_factor=consumer_settings['parallelization_factor'],
+      #XXX: Every write is versioned, so retrying a whole batch is safe.
+      bisect_batch_on_error=True,
+      retry_attempts=10
+    )
+
+    for routing_group in routing_groups:
+      construct_id_suffix = routing_group['construct_id_suffix']
+      kinesis_stream_arn = kinesis_stream_arns[routing_group['name']]
+
+      if not consumer_settings['enhanced_fan_out']:
+        kinesis_stream = aws_kinesis.Stream.from_stream_arn(self, f"KinesisStream{construct_id_suffix}", kinesis_stream_arn)
+        upsert_lambda_fn.add_event_source(aws_lambda_event_sources.KinesisEventSource(kinesis_stream, **event_source_settings))
+        continue
+
+      stream_consumer = aws_kinesis.CfnStreamConsumer(self, f"KinesisStreamConsumer{construct_id_suffix}",
+        consumer_name=f"{upsert_lambda_fn.function_name}{routing_group['name_suffix']}",
+        stream_arn=kinesis_stream_arn
+      )
+
+      upsert_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=[kinesis_stream_arn],
+        actions=["kinesis:DescribeStream",
+          "kinesis:DescribeStreamSummary",
+          "kinesis:GetRecords",
+          "kinesis:GetShardIterator",
+          "kinesis:ListShards"]
+      ))
+      upsert_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=[stream_consumer.attr_consumer_arn],
+        actions=["kinesis:DescribeStreamConsumer",
+          "kinesis:SubscribeToShard"]
+      ))
+
+      event_source_mapping = aws_lambda.EventSourceMapping(self, f"KinesisConsumerEventSource{construct_id_suffix}",
+        target=upsert_lambda_fn,
+        event_source_arn=stream_consumer.attr_consumer_arn,
+        **event_source_settings
+      )
+      #XXX: The event source mapping cannot be created until the role of the function can read from the consumer.
+      event_source_mapping.node.add_dependency(upsert_lambda_fn.role)
+
+      cdk.CfnOutput(self, f'KinesisStreamConsumerArn{construct_id_suffix}', value=stream_consumer.attr_consumer_arn,
+        export_name=f'{self.stack_name}-KinesisStreamConsumerArn{construct_id_suffix}')
+
+    cdk.CfnOutput(self, 'UpsertIndexName', value=upsert_index_name, export_name=f'{self.stack_name}-UpsertIndexName')
+    cdk.CfnOutput(self, 'UpsertFunctionRoleArn', value=upsert_lambda_fn.role.role_arn, export_name=f'{self.stack_name}-UpsertFunctionRoleArn')
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: The settings that trade latency for throughput across the pipeline, as named profiles.
+# Choose one with the `pipeline_profile` context, and override any setting with a context of the same name,
+# e.g. `cdk deploy -c pipeline_profile=bulk-throughput -c kinesis_shard_count=16 ...`
+PIPELINE_PROFILES = {
+  'low-latency': {
+    'dms_replication_instance_class': 'dms.c5.large',
+    'dms_parallel_apply_threads': 16,
+    'dms_parallel_apply_buffer_size': 100,
+    'dms_parallel_apply_queues_per_thread': 4,
+    'kinesis_stream_mode': 'ON_DEMAND',
+    'kinesis_shard_count': None,
+    'firehose_buffer_interval_sec': 10,
+    'firehose_buffer_size_mb': 1,
+    'opensearch_master_node_instance_type': 'r6g.large.search',
+    'opensearch_data_node_instance_type': 'r6g.large.search',
+    'opensearch_data_nodes': 3,
+    'opensearch_refresh_interval': '1s'
+  },
+  'balanced': {
+    'dms_replication_instance_class': 'dms.t3.medium',
+    'dms_parallel_apply_threads': 8,
+    'dms_parallel_apply_buffer_size': 1000,
+    'dms_parallel_apply_queues_per_thread': 16,
+    'kinesis_stream_mode': 'ON_DEMAND',
+    'kinesis_shard_count': None,
+    'firehose_buffer_interval_sec': 60,
+    'firehose_buffer_size_mb': 1,
+    'opensearch_master_node_instance_type': 'r6g.large.search',
+    'opensearch_data_node_instance_type': 'r6g.large.search',
+    'opensearch_data_nodes': 3,
+    'opensearch_refresh_interval': '30s'
+  },
+  'bulk-throughput': {
+    'dms_replication_instance_class': 'dms.c5.xlarge',
+    'dms_parallel_apply_threads': 32,
+    'dms_parallel_apply_buffer_size': 1000,
+    'dms_parallel_apply_queues_per_thread': 64,
+    'kinesis_stream_mode': 'PROVISIONED',
+    'kinesis_shard_count': 8,
+    'firehose_buffer_interval_sec': 300,
+    'firehose_buffer_size_mb': 20,
+    'opensearch_master_node_instance_type': 'r6g.large.search',
+    'opensearch_data_node_instance_type': 'r6g.xlarge.search',
+    'opensearch_data_nodes': 3,
+    'opensearch_refresh_interval': '60s'
+  }
+}
+
+DEFAULT_PIPELINE_PROFILE = 'balanced'
+
+#XXX: Contexts given on the command line with `-c key=value` are strings.
+INTEGER_SETTINGS = ('dms_parallel_apply_threads', 'dms_parallel_apply_buffer_size', 'dms_parallel_apply_queues_per_thread',
+  'kinesis_shard_count', 'firehose_buffer_interval_sec', 'firehose_buffer_size_mb', 'opensearch_data_nodes')
+
+#XXX: The OpenSearch domain spreads data nodes over 3 availability zones (see `zone_awareness` of OpenSearchStack).
+OPENSEARCH_AZ_COUNT = 3
+
+
+def _is_graviton(instance_type):
+  return instance_type.split('.')[0][-1] == 'g'
+
+
+def validate_pipeline_settings(settings):
+  '''Raises AssertionError on a setting out of range or a combination of settings known to be bad.'''
+
+  assert 0 <= settings['dms_parallel_apply_threads'] <= 32, 'dms_parallel_apply_threads should be between 0 and 32'
+  assert 0 <= settings['dms_parallel_apply_buffer_size'] <= 1000, 'dms_parallel_apply_buffer_size should be between 0 and 1000'
+  assert 0 <= settings['dms_parallel_apply_queues_per_thread'] <= 512, 'dms_parallel_apply_queues_per_thread should be between 0 and 512'
+  #XXX: Burstable instances run out of CPU credits under many apply threads, and replication lag grows without bound.
+  assert not (settings['dms_replication_instance_class'].startswith('dms.t') and settings['dms_parallel_apply_threads'] > 8), \
+    'Use a dms.c5 or dms.r5 replication instance for more than 8 dms_parallel_apply_threads'
+
+  assert settings['kinesis_stream_mode'] in ('ON_DEMAND', 'PROVISIONED'), 'Invalid kinesis_stream_mode'
+  if settings['kinesis_stream_mode'] == 'PROVISIONED':
+    assert settings['kinesis_shard_count'] and settings['kinesis_shard_count'] >= 1, \
+      'kinesis_shard_count is required for a PROVISIONED kinesis_stream_mode'
+  else:
+    assert not settings['kinesis_shard_count'], 'kinesis_shard_count is only for a PROVISIONED kinesis_stream_mode'
+
+  assert 0 <= settings['firehose_buffer_interval_sec'] <= 900, 'firehose_buffer_interval_sec should be between 0 and 900'
+  assert 1 <= settings['firehose_buffer_size_mb'] <= 100, 'firehose_buffer_size_mb should be between 1 and 100'
+
+  #XXX: You cannot use graviton instances with non-graviton instances.
+  assert _is_graviton(settings['opensearch_master_node_instance_type']) == _is_graviton(settings['opensearch_data_node_instance_type']), \
+    'opensearch_master_node_instance_type and opensearch_data_node_instance_type should be both graviton or both non-graviton'
+  assert settings['opensearch_data_nodes'] % OPENSEARCH_AZ_COUNT == 0, \
+    f'opensearch_data_nodes should be a multiple of {OPENSEARCH_AZ_COUNT} (availability zones)'
+
+
+def get_pipeline_settings(scope):
+  '''Returns the settings of the `pipeline_profile` context, overridden by contexts of the same names.'''
+
+  profile_name = scope.node.try_get_context('pipeline_profile') or DEFAULT_PIPELINE_PROFILE
+  assert profile_name in PIPELINE_PROFILES, 'Invalid pipeline_profile: should be one of {}'.format(', '.join(PIPELINE_PROFILES))
+
+  settings = dict(PIPELINE_PROFILES[profile_name])
+  for key in settings:
+    value = scope.node.try_get_context(key)
+    if value is not None:
+      settings[key] = int(value) if key in INTEGER_SETTINGS else value
+
+  #XXX: An ON_DEMAND override of a PROVISIONED profile drops the shard count of the profile.
+  if settings['kinesis_stream_mode'] == 'ON_DEMAND' and scope.node.try_get_context('kinesis_shard_count') is None:
+    settings['kinesis_shard_count'] = None
+
+  validate_pipeline_settings(settings)
+  return settings
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import re
+
+#XXX: Source tables are replicated in routing groups, each with its own DMS replication task,
+# Kinesis Data Stream and Kinesis Data Firehose/OpenSearch index, so that a hot table cannot throttle the others.
+#
+# A single group (the default) keeps the names of a single table pipeline:
+#   "dms_data_source": {"database_name": "testdb", "table_name": "retail_trans" | ["retail_trans", "order%"]}
+#
+# Tables whose primary key is not `primary_key` list theirs in `primary_keys`, in dms_data_source or in a group:
+#   "dms_data_source": {..., "primary_key": "trans_id", "primary_keys": {"pipeline_heartbeat": "heartbeat_id"}}
+#
+# Named groups get the group name appended to the Kinesis Data Stream, index and replication task names:
+#   "dms_data_source": {
+#     "database_name": "testdb",
+#     "routing_groups": [
+#       {"name": "retail", "tables": ["retail_trans"], "primary_key": "trans_id", "kinesis_shard_count": 4},
+#       {"name": "orders", "tables": ["order%", "payment%"]}
+#     ]
+#   }
+
+DEFAULT_REPLICATION_TASK_ID = 'CDC-MySQLToKinesisTask'
+
+
+def _as_list(value):
+  return value if isinstance(value, list) else [value]
+
+
+def _construct_id_suffix(name):
+  return ''.join(e.capitalize() for e in re.split(r'[^A-Za-z0-9]', name) if e)
+
+
+def is_wildcard(table_pattern):
+  return '%' in table_pattern
+
+
+def matches(table_pattern, table_name):
+  '''Whether a table name matches a DMS table name pattern with `%` wildcards'''
+  return re.fullmatch('.*'.join(re.escape(e) for e in table_pattern.split('%')), table_name) is not None
+
+
+def table_primary_keys(routing_group):
+  '''Returns the primary key columns of each table listed by name in the routing group'''
+  return {table: routing_group['primary_keys'].get(table, routing_group['primary_key'])
+    for table in routing_group['tables'] if not is_wildcard(table)}
+
+
+def get_routing_groups(scope):
+  '''Returns the routing groups of the `dms_data_source` context as dicts of
+    name - the name of the group
+    tables - table names or `%` patterns
+    excluded_tables - tables matched by a pattern of this group, but listed explicitly in another group
+    primary_key - primary key columns of the tables of the group
+    primary_keys - primary key columns of the tables of the group with a key of their own, by table name
+    name_suffix - to append to the Kinesis Data Stream, index and replication task names ('' for the default group)
+    construct_id_suffix - to append to construct ids ('' for the default group)
+    kinesis_stream_mode, kinesis_shard_count - overrides of the pipeline profile for the stream of the group (or None)
+  '''
+
+  dms_data_source = scope.node.try_get_context('dms_data_source')
+  routing_groups = dms_data_source.get('routing_groups')
+  primary_keys = {table: _as_list(columns) for table, columns in (dms_data_source.get('primary_keys') or {}).items()}
+
+  if not routing_groups:
+    return [{
+      'name': 'default',
+      'tables': _as_list(dms_data_source['table_name']),
+      'excluded_tables': [],
+      'primary_key': _as_list(dms_data_source.get('primary_key', 'trans_id')),
+      'primary_keys': primary_keys,
+      'name_suffix': '',
+      'construct_id_suffix': '',
+      'kinesis_stream_mode': None,
+      'kinesis_shard_count': None
+    }]
+
+  groups = []
+  for routing_group in routing_groups:
+    name = routing_group['name']
+    assert re.fullmatch(r'[a-z][a-z0-9\-]{0,15}', name), f'Invalid routing group name: {name}'
+    groups.append({
+      'name': name,
+      'tables': _as_list(routing_group['tables']),
+      'excluded_tables': [],
+      'primary_key': _as_list(routing_group.get('primary_key', dms_data_source.get('primary_key', 'trans_id'))),
+      'primary_keys': {**primary_keys,
+        **{table: _as_list(columns) for table, columns in (routing_group.get('primary_keys') or {}).items()}},
+      'name_suffix': f'-{name}',
+      'construct_id_suffix': _construct_id_suffix(name),
+      'kinesis_stream_mode': routing_group.get('kinesis_stream_mode'),
+      'kinesis_shard_count': routing_group.get('kinesis_shard_count')
+    })
+
+  names = [g['name'] for g in groups]
+  assert len(set(names)) == len(names), 'Routing group names should be unique'
+
+  explicit_tables = {}
+  for group in groups:
+    for table in group['tables']:
+      if not is_wildcard(table):
+        assert table not in explicit_tables, f'{table} is in both {explicit_tables.get(table)} and {group["name"]} routing groups'
+        explicit_tables[table] = group['name']
+
+  #XXX: A table listed explicitly in a group is excluded from the wildcard patterns of the other groups,
+  # so that each table is replicated by exactly one task.
+  for group in groups:
+    group['excluded_tables'] = sorted(table for table, group_name in explicit_tables.items()
+      if group_name != group['name'] and any(matches(p, table) for p in group['tables'] if is_wildcard(p)))
+
+  return groups
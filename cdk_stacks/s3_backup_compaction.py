@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+
+import aws_cdk as cdk
+
+from aws_cdk import (
+  Stack,
+  aws_events,
+  aws_events_targets,
+  aws_lambda,
+  aws_logs,
+  aws_s3 as s3
+)
+from constructs import Construct
+
+
+class S3BackupCompactionStack(Stack):
+
+  def __init__(self, scope: Construct, construct_id: str, s3_bucket_name, s3_backup_prefixes, **kwargs) -> None:
+    super().__init__(scope, construct_id, **kwargs)
+
+    #XXX: Kinesis Data Firehose delivers an object every buffer interval, i.e. thousands of small objects a day,
+    # so each closed hour is merged into a few large gzip JSON lines objects under `output_prefix`.
+    compaction_settings = {
+      "output_prefix": "compacted/",
+      "max_output_mb": 1024,
+      "close_grace_minutes": 30,
+      "lookback_hours": 24,
+      "delete_sources": True,
+      **(self.node.try_get_context('s3_backup_compaction') or {})
+    }
+    assert compaction_settings['output_prefix'].endswith('/'), 's3_backup_compaction.output_prefix should end with /'
+    assert not any(prefix.startswith(compaction_settings['output_prefix']) for prefix in s3_backup_prefixes), \
+      's3_backup_compaction.output_prefix should not be a prefix of the S3 backup'
+    assert compaction_settings['max_output_mb'] >= 16, 's3_backup_compaction.max_output_mb should be at least 16'
+    #XXX: Kinesis Data Firehose buffers records for up to 15 minutes before it delivers an object.
+    assert compaction_settings['close_grace_minutes'] >= 15, 's3_backup_compaction.close_grace_minutes should be at least 15'
+    assert 1 <= compaction_settings['lookback_hours'] <= 168, 's3_backup_compaction.lookback_hours should be between 1 and 168'
+
+    s3_bucket = s3.Bucket.from_bucket_name(self, "FirehoseS3Bucket", s3_bucket_name)
+
+    compaction_lambda_fn = aws_lambda.Function(self, "S3BackupCompactionFunction",
+      runtime=aws_lambda.Runtime.PYTHON_3_11,
+      function_name=f"S3BackupCompaction-{self.stack_name}",
+      handler="index.lambda_handler",
+      description="Compact the objects of the Kinesis Data Firehose S3 backup by hour",
+      code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/S3BackupCompaction')),
+      environment={
+        'BUCKET_NAME': s3_bucket_name,
+        'SOURCE_PREFIXES': ','.join(s3_backup_prefixes),
+        'OUTPUT_PREFIX': compaction_settings['output_prefix'],
+        'COMPRESSION': 'gzip',
+        'MAX_OUTPUT_BYTES': str(compaction_settings['max_output_mb'] * 1024 * 1024),
+        'CLOSE_GRACE_MINUTES': str(compaction_settings['close_grace_minutes']),
+        'LOOKBACK_HOURS': str(compaction_settings['lookback_hours']),
+        'DELETE_SOURCES': str(compaction_settings['delete_sources']).lower()
+      },
+      timeout=cdk.Duration.minutes(15),
+      #XXX: Lambda allocates CPU in proportion to memory, and compression is CPU bound. Memory use itself stays flat.
+      memory_size=1024,
+      #XXX: Runs of the same hour must not overlap, and a failed run is caught up by the next one.
+      reserved_concurrent_executions=1,
+      retry_attempts=0,
+      log_retention=aws_logs.RetentionDays.THREE_DAYS
+    )
+    s3_bucket.grant_read_write(compaction_lambda_fn)
+
+    schedule_rule = aws_events.Rule(self, "S3BackupCompactionSchedule",
+      schedule=aws_events.Schedule.rate(cdk.Duration.hours(1)),
+      targets=[aws_events_targets.LambdaFunction(compaction_lambda_fn)]
+    )
+
+    cdk.CfnOutput(self, 'S3BackupCompactionFunctionName', value=compaction_lambda_fn.function_name,
+      export_name=f'{self.stack_name}-S3BackupCompactionFunctionName')
+    cdk.CfnOutput(self, 'S3BackupCompactionOutputPrefix',
+      value=f"s3://{s3_bucket_name}/{compaction_settings['output_prefix']}",
+      export_name=f'{self.stack_name}-S3BackupCompactionOutputPrefix')
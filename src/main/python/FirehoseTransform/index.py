@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Kinesis Data Firehose data transformation for AWS DMS records
+
+Flattens `data` of each DMS `json-unformatted` record together with a small set of `metadata` fields,
+drops control records, and turns deletes into tombstone documents (`_deleted: true`).
+With `DYNAMIC_PARTITIONING=true`, it also returns the partition keys of each record
+(`schema_name`, `table_name`, `operation` and `dt`) for a delivery stream with dynamic partitioning.
+
+To try it locally with captured records:
+  $ python3 index.py sample_event.json
+'''
+
+import binascii
+import json
+import os
+import sys
+
+METADATA_FIELDS = [e.strip() for e in os.getenv('METADATA_FIELDS',
+  'timestamp,operation,schema-name,table-name,transaction-id').split(',') if e.strip()]
+METADATA_FIELD_PREFIX = os.getenv('METADATA_FIELD_PREFIX', '_')
+DELETED_FIELD = '{}deleted'.format(METADATA_FIELD_PREFIX)
+#XXX: Set for a delivery stream with dynamic partitioning by schema, table, operation and date
+DYNAMIC_PARTITIONING = os.getenv('DYNAMIC_PARTITIONING', 'false').lower() == 'true'
+
+_encode_json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+def decode_batch(payloads):
+  '''Parses all the payloads of a batch with a single json.loads over a JSON array,
+  and falls back to parsing them one by one if any of them is malformed (None for a malformed one).'''
+
+  try:
+    records = json.loads(b'[' + b','.join(payloads) + b']')
+    if len(records) == len(payloads):
+      return records
+  except ValueError:
+    pass
+
+  records = []
+  for payload in payloads:
+    try:
+      records.append(json.loads(payload))
+    except ValueError:
+      records.append(None)
+  return records
+
+
+def flatten(dms_record):
+  doc = dms_record['data']
+  metadata = dms_record['metadata']
+  for field in METADATA_FIELDS:
+    doc[METADATA_FIELD_PREFIX + field] = metadata.get(field)
+  doc[DELETED_FIELD] = metadata.get('operation') == 'delete'
+  return doc
+
+
+def partition_keys(metadata):
+  return {
+    'schema_name': metadata.get('schema-name'),
+    'table_name': metadata.get('table-name'),
+    'operation': metadata.get('operation'),
+    'dt': metadata.get('timestamp', '')[:10]
+  }
+
+
+def transform_records(records):
+  payloads = [binascii.a2b_base64(record['data']) for record in records]
+  dms_records = decode_batch(payloads)
+
+  output = []
+  for record, dms_record in zip(records, dms_records):
+    metadata = dms_record.get('metadata') if isinstance(dms_record, dict) else None
+    #XXX: Records that are dropped or failed are passed through as they are, without re-encoding.
+    if isinstance(metadata, dict) and metadata.get('record-type') != 'data':
+      output.append({'recordId': record['recordId'], 'result': 'Dropped', 'data': record['data']})
+    elif not isinstance(metadata, dict) or not isinstance(dms_record.get('data'), dict):
+      output.append({'recordId': record['recordId'], 'result': 'ProcessingFailed', 'data': record['data']})
+    else:
+      #XXX: A trailing newline keeps the S3 backup of the delivery stream in JSON lines format.
+      data = (_encode_json(flatten(dms_record)) + '\n').encode('utf-8')
+      transformed = {'recordId': record['recordId'], 'result': 'Ok',
+        'data': binascii.b2a_base64(data, newline=False).decode('ascii')}
+      if DYNAMIC_PARTITIONING:
+        transformed['metadata'] = {'partitionKeys': partition_keys(metadata)}
+      output.append(transformed)
+  return output
+
+
+def lambda_handler(event, context):
+  output = transform_records(event['records'])
+
+  results = {}
+  for record in output:
+    results[record['result']] = results.get(record['result'], 0) + 1
+  print('[INFO] {}'.format(json.dumps(results)), file=sys.stderr)
+
+  return {'records': output}
+
+
+if __name__ == '__main__':
+  with open(sys.argv[1]) as event_file:
+    event = json.load(event_file)
+  for record in lambda_handler(event, None)['records']:
+    print(record['recordId'], record['result'], binascii.a2b_base64(record['data']).decode('utf-8').rstrip())
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Adaptive `_bulk` writer for Amazon OpenSearch Service
+
+Turns AWS DMS records into `_bulk` actions and writes them with concurrent requests over a pool of keep-alive connections.
+
+  - Each action is encoded once into the bytes of its action and source lines,
+    and a request body is a single join of the actions of a batch.
+  - Batches are sized by both document count and bytes. They shrink by half when OpenSearch rejects a request
+    or an item with 429 (`es_rejected_execution_exception`), and grow back by a tenth of the limits on success.
+  - Only the items that failed with a retryable error are sent again, with jittered exponential backoff.
+
+Requests in flight may complete in any order, so the actions of a single `write` should be independent,
+e.g. one action per document id (see `dms_bulk_actions`) or versioned writes.
+
+This is the `python/` directory of a Lambda layer, so it is imported as `opensearch_bulk_writer` in Lambda functions.
+'''
+
+import concurrent.futures
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+
+import urllib3
+
+DMS_TIMESTAMP_FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+DEFAULT_METADATA_FIELDS = ('timestamp', 'operation', 'schema-name', 'table-name', 'transaction-id')
+
+#XXX: A version conflict means that a newer version of the document is already indexed,
+# and a missing document cannot be deleted twice.
+IGNORED_STATUS = {'index': (409,), 'delete': (404, 409)}
+
+#XXX: 429 is returned when the write thread pool queue of a node is full (es_rejected_execution_exception).
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+REJECTED_STATUS = (429,)
+
+_encode_json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+class BulkAction:
+  '''An action of a `_bulk` request, as the bytes of its action line and optional source line.'''
+
+  __slots__ = ('doc_id', 'op_type', 'payload')
+
+  def __init__(self, doc_id, op_type, payload):
+    self.doc_id = doc_id
+    self.op_type = op_type
+    self.payload = payload
+
+
+def index_action(index_name, source, doc_id=None, version=None):
+  meta = {'_index': index_name}
+  if doc_id is not None:
+    meta['_id'] = doc_id
+  if version is not None:
+    meta.update(version=version, version_type='external_gte')
+  return BulkAction(doc_id, 'index', '{}\n{}\n'.format(_encode_json({'index': meta}), _encode_json(source)).encode('utf-8'))
+
+
+def delete_action(index_name, doc_id, version=None):
+  meta = {'_index': index_name, '_id': doc_id}
+  if version is not None:
+    meta.update(version=version, version_type='external_gte')
+  return BulkAction(doc_id, 'delete', '{}\n'.format(_encode_json({'delete': meta})).encode('utf-8'))
+
+
+def dms_document_id(dms_record, primary_keys):
+  '''Returns `<schema>.<table>.<primary key>`, or None for a table without a known primary key
+  or a record without one of the primary key columns.'''
+
+  metadata = dms_record['metadata']
+  schema_name, table_name = metadata.get('schema-name'), metadata.get('table-name')
+  columns = primary_keys.get('{}.{}'.format(schema_name, table_name))
+  if not columns:
+    return None
+  data = dms_record['data']
+  if any(c not in data for c in columns):
+    #XXX: A misconfigured primary key must not fail the whole batch, which would be retried until the shard stalls.
+    print('[WARNING] {}.{} has no primary key column {}, so its document gets an auto-generated id'.format(
+      schema_name, table_name, ', '.join(c for c in columns if c not in data)), file=sys.stderr)
+    return None
+  return '.'.join([schema_name, table_name] + [str(data[c]) for c in columns])
+
+
+def dms_document_version(dms_record):
+  '''Returns the DMS `metadata.timestamp` in microseconds since the epoch.'''
+
+  timestamp = datetime.datetime.strptime(dms_record['metadata']['timestamp'], DMS_TIMESTAMP_FMT)
+  delta = timestamp - EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def flatten_dms_record(dms_record, metadata_fields=DEFAULT_METADATA_FIELDS, prefix='_'):
+  '''Returns the `data` of a DMS record with `metadata` fields and `<prefix>deleted` added in place.'''
+
+  doc = dms_record['data']
+  metadata = dms_record['metadata']
+  for field in metadata_fields:
+    doc[prefix + field] = metadata.get(field)
+  doc[prefix + 'deleted'] = metadata.get('operation') == 'delete'
+  return doc
+
+
+def dms_bulk_actions(dms_records, index_name, primary_keys, delete_mode='tombstone',
+    metadata_fields=DEFAULT_METADATA_FIELDS, prefix='_'):
+  '''Returns the actions of the DMS data records, keeping only the last version of each document.
+
+  Documents of tables in `primary_keys` ({"<schema>.<table>": [columns]}) are versioned by the DMS timestamp.
+  Deleted rows are indexed as tombstones, or deleted with `delete_mode` of `delete`.
+  Rows of other tables are appended with auto-generated ids.'''
+
+  actions = {}
+  unkeyed = []
+  for dms_record in dms_records:
+    if dms_record.get('metadata', {}).get('record-type') != 'data':
+      continue
+    doc_id = dms_document_id(dms_record, primary_keys)
+    if doc_id is None:
+      unkeyed.append(index_action(index_name, flatten_dms_record(dms_record, metadata_fields, prefix)))
+      continue
+
+    version = dms_document_version(dms_record)
+    #XXX: Re-insert the document so that it keeps the position of its last version in the batch.
+    actions.pop(doc_id, None)
+    if delete_mode == 'delete' and dms_record['metadata'].get('operation') == 'delete':
+      actions[doc_id] = delete_action(index_name, doc_id, version)
+    else:
+      actions[doc_id] = index_action(index_name, flatten_dms_record(dms_record, metadata_fields, prefix), doc_id, version)
+  return list(actions.values()) + unkeyed
+
+
+def bulk_body(actions):
+  return b''.join(action.payload for action in actions)
+
+
+class BulkTransport:
+  '''POSTs `_bulk` bodies over a pool of keep-alive connections, signed with SigV4 if `region` is given.'''
+
+  def __init__(self, endpoint, region=None, basic_auth=None, pool_size=4, insecure=False, timeout_sec=60):
+    base_url = endpoint if '://' in endpoint else 'https://{}'.format(endpoint)
+    self.url = '{}/_bulk'.format(base_url.rstrip('/'))
+    self.region = region
+    self.headers = {'Content-Type': 'application/x-ndjson'}
+    if basic_auth:
+      self.headers.update(urllib3.make_headers(basic_auth=basic_auth))
+    if region:
+      import boto3
+      self.credentials = boto3.Session().get_credentials()
+    #XXX: block=True keeps the number of connections at pool_size, so requests in flight wait for a free one.
+    self.http = urllib3.PoolManager(maxsize=pool_size, block=True, retries=False,
+      cert_reqs='CERT_NONE' if insecure else 'CERT_REQUIRED',
+      timeout=urllib3.Timeout(connect=5, read=timeout_sec))
+
+  def _signed_headers(self, body):
+    from botocore.auth import SigV4Auth
+    from botocore.awsrequest import AWSRequest
+
+    request = AWSRequest(method='POST', url=self.url, data=body, headers=self.headers)
+    SigV4Auth(self.credentials, 'es', self.region).add_auth(request)
+    return dict(request.headers.items())
+
+  def post(self, body):
+    '''Returns (HTTP status, the parsed response or None).'''
+
+    headers = self._signed_headers(body) if self.region else self.headers
+    response = self.http.request('POST', self.url, body=body, headers=headers)
+    if response.status >= 300:
+      return response.status, None
+    return response.status, json.loads(response.data)
+
+
+class AdaptiveBatchSize:
+  '''Limits of a batch in documents and bytes, halved on rejection and grown by a tenth of the maximum on success.'''
+
+  def __init__(self, max_docs, max_bytes, min_docs=1, min_bytes=64 * 1024):
+    self.max_docs, self.max_bytes = max_docs, max_bytes
+    self.min_docs, self.min_bytes = min(min_docs, max_docs), min(min_bytes, max_bytes)
+    self.docs, self.bytes = max_docs, max_bytes
+    self.lock = threading.Lock()
+
+  def shrink(self):
+    with self.lock:
+      self.docs = max(self.min_docs, self.docs // 2)
+      self.bytes = max(self.min_bytes, self.bytes // 2)
+
+  def grow(self):
+    with self.lock:
+      self.docs = min(self.max_docs, self.docs + max(1, self.max_docs // 10))
+      self.bytes = min(self.max_bytes, self.bytes + max(1, self.max_bytes // 10))
+
+  def split(self, actions):
+    with self.lock:
+      max_docs, max_bytes = self.docs, self.bytes
+    batch, batch_bytes = [], 0
+    for action in actions:
+      if batch and (len(batch) >= max_docs or batch_bytes + len(action.payload) > max_bytes):
+        yield batch
+        batch, batch_bytes = [], 0
+      batch.append(action)
+      batch_bytes += len(action.payload)
+    if batch:
+      yield batch
+
+
+class BulkWriter:
+  '''Writes actions with up to `concurrency` `_bulk` requests in flight, retrying only the failed items.'''
+
+  def __init__(self, transport, max_docs=1000, max_bytes=5 * 1024 * 1024, concurrency=4, max_retries=5,
+      backoff_base_sec=0.1, backoff_max_sec=5, sleep=time.sleep):
+    self.transport = transport
+    self.batch_size = AdaptiveBatchSize(max_docs, max_bytes)
+    self.concurrency = concurrency
+    self.max_retries = max_retries
+    self.backoff_base_sec = backoff_base_sec
+    self.backoff_max_sec = backoff_max_sec
+    self.sleep = sleep
+    #XXX: The threads outlive a single write, e.g. across warm Lambda invocations.
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+
+  def _send(self, batch):
+    '''Returns (actions to retry, stats) of a batch.'''
+
+    status, response = self.transport.post(bulk_body(batch))
+    if response is None:
+      if status in RETRYABLE_STATUS:
+        return batch, {'requests': 1, 'rejected_requests': 1 if status in REJECTED_STATUS else 0}
+      raise RuntimeError('bulk request failed: {}'.format(status))
+
+    stats = {'requests': 1, 'rejected_requests': 0, 'rejected_items': 0, 'dropped_items': 0}
+    if not response.get('errors'):
+      return [], stats
+
+    retry = []
+    for action, item in zip(batch, response['items']):
+      op_type, result = next(iter(item.items()))
+      item_status = result['status']
+      if item_status < 300 or item_status in IGNORED_STATUS.get(op_type, ()):
+        continue
+      if item_status in RETRYABLE_STATUS:
+        stats['rejected_items'] += 1 if item_status in REJECTED_STATUS else 0
+        retry.append(action)
+        continue
+      #XXX: A mapping error will not succeed on retry, so log it and move on.
+      print('[ERROR] {}'.format(json.dumps(result)), file=sys.stderr)
+      stats['dropped_items'] += 1
+    return retry, stats
+
+  def write(self, actions):
+    '''Writes the actions and returns the stats, or raises RuntimeError if some are still failing after `max_retries`.'''
+
+    totals = {'actions': len(actions), 'requests': 0, 'rejected_requests': 0, 'rejected_items': 0,
+      'retried_items': 0, 'dropped_items': 0}
+    pending = actions
+    for attempt in range(self.max_retries + 1):
+      if attempt > 0:
+        totals['retried_items'] += len(pending)
+        backoff = min(self.backoff_max_sec, self.backoff_base_sec * 2 ** (attempt - 1))
+        self.sleep(backoff * random.uniform(0.5, 1.0))
+
+      batches = list(self.batch_size.split(pending))
+      if self.executor and len(batches) > 1:
+        results = list(self.executor.map(self._send, batches))
+      else:
+        results = [self._send(batch) for batch in batches]
+
+      pending = []
+      for retry, stats in results:
+        pending.extend(retry)
+        for key, value in stats.items():
+          totals[key] += value
+        if stats.get('rejected_requests') or stats.get('rejected_items'):
+          self.batch_size.shrink()
+        else:
+          self.batch_size.grow()
+      if not pending:
+        totals['batch_docs'], totals['batch_bytes'] = self.batch_size.docs, self.batch_size.bytes
+        return totals
+    raise RuntimeError('{} bulk items failed after {} retries'.format(len(pending), self.max_retries))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''CloudFormation custom resource that puts an index template and an ISM policy into an OpenSearch domain
+
+It signs in as the master user of fine-grained access control, whose credentials are read from AWS Secrets Manager.
+'''
+
+import json
+import sys
+
+import boto3
+import urllib3
+
+http = urllib3.PoolManager(retries=urllib3.Retry(total=5, backoff_factor=1, status_forcelist=(429, 502, 503, 504)),
+  timeout=urllib3.Timeout(connect=10, read=60))
+
+
+class OpenSearchClient:
+
+  def __init__(self, endpoint, secret_id):
+    secret = json.loads(boto3.client('secretsmanager').get_secret_value(SecretId=secret_id)['SecretString'])
+    self.url = 'https://{}'.format(endpoint)
+    self.headers = urllib3.make_headers(basic_auth='{username}:{password}'.format(**secret))
+    self.headers['Content-Type'] = 'application/json'
+
+  def request(self, method, path, body=None, ignore=()):
+    response = http.request(method, self.url + path, headers=self.headers,
+      body=json.dumps(body) if body is not None else None)
+    print('[INFO] {} {} {}'.format(method, path, response.status), file=sys.stderr)
+    if response.status in ignore:
+      return None
+    if response.status >= 300:
+      raise RuntimeError('{} {} failed: {} {}'.format(method, path, response.status, response.data[:1024]))
+    return json.loads(response.data)
+
+
+def put_index_template(client, name, template):
+  client.request('PUT', '/_index_template/{}'.format(name), template)
+
+
+def put_ism_policy(client, policy_id, policy):
+  #XXX: Updating an ISM policy requires the sequence number and the primary term of the current one.
+  current = client.request('GET', '/_plugins/_ism/policies/{}'.format(policy_id), ignore=(404,))
+  path = '/_plugins/_ism/policies/{}'.format(policy_id)
+  if current:
+    path += '?if_seq_no={_seq_no}&if_primary_term={_primary_term}'.format(**current)
+  client.request('PUT', path, {'policy': policy})
+
+
+def on_event(event, context):
+  props = event['ResourceProperties']
+  client = OpenSearchClient(props['DomainEndpoint'], props['MasterUserSecretId'])
+  template_name = props['TemplateName']
+  policy_id = props.get('PolicyId')
+
+  if event['RequestType'] in ('Create', 'Update'):
+    put_index_template(client, template_name, json.loads(props['IndexTemplate']))
+    if policy_id:
+      put_ism_policy(client, policy_id, json.loads(props['IsmPolicy']))
+    old_policy_id = event.get('OldResourceProperties', {}).get('PolicyId')
+    if old_policy_id and old_policy_id != policy_id:
+      client.request('DELETE', '/_plugins/_ism/policies/{}'.format(old_policy_id), ignore=(404,))
+  elif event['RequestType'] == 'Delete':
+    client.request('DELETE', '/_index_template/{}'.format(template_name), ignore=(404,))
+    if policy_id:
+      client.request('DELETE', '/_plugins/_ism/policies/{}'.format(policy_id), ignore=(404,))
+
+  return {'PhysicalResourceId': template_name}
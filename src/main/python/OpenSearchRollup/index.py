@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Rolls up AWS DMS records from a Kinesis Data Stream into per-minute aggregates in OpenSearch
+
+The function runs on the tumbling windows of its Kinesis event source. Each invocation adds the changes of its batch
+to the aggregates in `state`, which Lambda passes on to the next invocation for the same shard and window,
+and the final invocation of a window writes them into the rollup index.
+
+  - Rows are grouped by ROLLUP_WINDOW_MINUTES of TIME_FIELD and by each of DIMENSIONS (`event+device` for a combination),
+    with the number of rows (`count`) and the sum of MEASURE_FIELD.
+  - Inserts add a row, deletes subtract it, and updates subtract the before image of the row and add its new values.
+    The before image is the `before-image` of DMS `BeforeImageSettings`, which the stack requires.
+    Updates without a before image are counted as unmatched and skipped.
+  - A rollup document holds the aggregates of a group for a shard and a Lambda window, and its id is derived from all three,
+    so a retried window overwrites its own documents. Dashboards sum `count` and the measure over the documents of a minute.
+  - Once the state has MAX_STATE_GROUPS groups, it is written out before the window ends,
+    which keeps it under the 1 MB limit of Lambda.
+
+To print the rollup documents of captured DMS records (JSON lines with `before-image`) locally:
+  $ PYTHONPATH=../OpenSearchBulkWriter/python PRIMARY_KEYS='{"testdb.retail_trans": ["trans_id"]}' python3 index.py records.jsonl
+'''
+
+import binascii
+import collections
+import datetime
+import hashlib
+import json
+import os
+import sys
+
+from opensearch_bulk_writer import BulkTransport, BulkWriter, index_action
+
+OPENSEARCH_ENDPOINT = os.getenv('OPENSEARCH_ENDPOINT')
+INDEX_NAME = os.getenv('INDEX_NAME')
+#XXX: {"<schema>.<table>": ["<primary key column>", ...]} of the tables to roll up
+PRIMARY_KEYS = json.loads(os.getenv('PRIMARY_KEYS', '{}'))
+DIMENSIONS = [tuple(e.strip().split('+')) for e in os.getenv('DIMENSIONS', 'event,device,sku').split(',') if e.strip()]
+MEASURE_FIELD = os.getenv('MEASURE_FIELD', 'amount')
+TIME_FIELD = os.getenv('TIME_FIELD', 'trans_datetime')
+ROLLUP_WINDOW_MINUTES = int(os.getenv('ROLLUP_WINDOW_MINUTES', '1'))
+MAX_STATE_GROUPS = int(os.getenv('MAX_STATE_GROUPS', '5000'))
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', '2'))
+
+#XXX: The fields of a group key in the state, which has to be a JSON object
+GROUP_KEY_SEP = '\t'
+
+
+def window_start(value):
+  '''Returns the start of the rollup window of a `YYYY-MM-DD HH:MM:SS` or `YYYY-MM-DDTHH:MM:SS...` time.'''
+
+  minute = datetime.datetime.strptime(value[:16].replace(' ', 'T'), '%Y-%m-%dT%H:%M')
+  minute -= datetime.timedelta(minutes=minute.minute % ROLLUP_WINDOW_MINUTES)
+  return minute.strftime('%Y-%m-%dT%H:%M:00Z')
+
+
+def group_keys(row):
+  start = window_start(row[TIME_FIELD])
+  for dimension in DIMENSIONS:
+    yield GROUP_KEY_SEP.join([start, '+'.join(dimension)] + [str(row.get(column)) for column in dimension])
+
+
+def add_row(groups, row, sign):
+  measure = row.get(MEASURE_FIELD) or 0
+  for key in group_keys(row):
+    aggregate = groups.setdefault(key, [0, 0])
+    aggregate[0] += sign
+    aggregate[1] += sign * measure
+
+
+def apply_records(groups, dms_records):
+  '''Adds the changes of the DMS records to the aggregates of `groups` and returns the stats.
+  The changes are only applied to `groups`, so a retried batch starts over from the state it was given.'''
+
+  stats = collections.Counter()
+  for dms_record in dms_records:
+    metadata = dms_record.get('metadata', {})
+    table = '{}.{}'.format(metadata.get('schema-name'), metadata.get('table-name'))
+    if metadata.get('record-type') != 'data' or table not in PRIMARY_KEYS:
+      stats['skipped'] += 1
+      continue
+
+    row = dms_record['data']
+    operation = metadata.get('operation')
+    if operation == 'delete':
+      add_row(groups, row, -1)
+    elif operation == 'update':
+      before = dms_record.get('before-image')
+      if before is None:
+        #XXX: Adding the new values without subtracting the old ones would count the row twice.
+        stats['unmatched_updates'] += 1
+        continue
+      #XXX: A before image of DMS has only the columns of its ColumnFilter.
+      add_row(groups, dict(row, **before), -1)
+      add_row(groups, row, 1)
+    else:
+      #XXX: insert, or load of a full load task
+      add_row(groups, row, 1)
+    stats[operation] += 1
+  return stats
+
+
+def rollup_actions(groups, id_prefix):
+  '''Returns the index actions of the rollup documents of `groups`, with ids prefixed by the shard and window.'''
+
+  actions = []
+  for key, (count, measure) in groups.items():
+    #XXX: Changes that cancel each other out within a window, e.g. an insert and a delete, leave nothing to write.
+    if count == 0 and measure == 0:
+      continue
+    start, dimension, *values = key.split(GROUP_KEY_SEP)
+    doc = {'window_start': start, 'window_minutes': ROLLUP_WINDOW_MINUTES, 'dimension': dimension}
+    doc.update(zip(dimension.split('+'), values))
+    doc.update({'count': count, MEASURE_FIELD: measure})
+    doc_id = hashlib.sha1('{}{}{}'.format(id_prefix, GROUP_KEY_SEP, key).encode('utf-8')).hexdigest()
+    actions.append(index_action(INDEX_NAME, doc, doc_id))
+  return actions
+
+
+_writer = None
+
+
+def lambda_handler(event, context):
+  global _writer
+  if _writer is None:
+    transport = BulkTransport(OPENSEARCH_ENDPOINT, region=os.environ['AWS_REGION'], pool_size=BULK_CONCURRENCY)
+    _writer = BulkWriter(transport, concurrency=BULK_CONCURRENCY)
+
+  state = event.get('state') or {}
+  groups, num_flushes = state.get('groups', {}), state.get('flushes', 0)
+
+  dms_records = [json.loads(binascii.a2b_base64(record['kinesis']['data'])) for record in event.get('Records', [])]
+  stats = apply_records(groups, dms_records)
+
+  if event.get('isFinalInvokeForWindow') or len(groups) >= MAX_STATE_GROUPS:
+    id_prefix = '{}{}{}{}{}'.format(event['shardId'], GROUP_KEY_SEP, event['window']['start'], GROUP_KEY_SEP, num_flushes)
+    actions = rollup_actions(groups, id_prefix)
+    if actions:
+      stats.update(_writer.write(actions))
+    stats['rollups'] += len(actions)
+    groups, num_flushes = {}, num_flushes + 1
+
+  if stats['unmatched_updates']:
+    print('[ERROR] {} updates have no before image, enable BeforeImageSettings of the DMS task'.format(
+      stats['unmatched_updates']), file=sys.stderr)
+  print('[INFO] {}'.format(json.dumps(dict(records=len(dms_records), groups=len(groups), **stats))), file=sys.stderr)
+  return {'state': {'groups': groups, 'flushes': num_flushes}}
+
+
+if __name__ == '__main__':
+  with open(sys.argv[1]) as records_file:
+    records = [json.loads(line) for line in records_file if line.strip()]
+  groups = {}
+  print('[INFO] {}'.format(json.dumps(apply_records(groups, records))), file=sys.stderr)
+  for action in rollup_actions(groups, 'local'):
+    sys.stdout.write(action.payload.decode('utf-8'))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Upserts AWS DMS records from a Kinesis Data Stream into OpenSearch by primary key
+
+Each document is indexed with `_id` of `<schema>.<table>.<primary key>`, so that a later version of a row
+overwrites the earlier one instead of adding another document.
+The DMS `metadata.timestamp` (microseconds since the epoch) is used as an external version,
+so retried or replayed batches never overwrite a newer version with an older one.
+
+`_bulk` requests are sent by `opensearch_bulk_writer` of the OpenSearchBulkWriter Lambda layer.
+To print the `_bulk` request body for captured DMS records (JSON lines) locally:
+  $ PYTHONPATH=../OpenSearchBulkWriter/python PRIMARY_KEYS='{"testdb.retail_trans": ["trans_id"]}' \
+      INDEX_NAME=retail-trans_current python3 index.py records.jsonl
+'''
+
+import binascii
+import json
+import os
+import sys
+
+from opensearch_bulk_writer import BulkTransport, BulkWriter, bulk_body, dms_bulk_actions
+
+OPENSEARCH_ENDPOINT = os.getenv('OPENSEARCH_ENDPOINT')
+INDEX_NAME = os.getenv('INDEX_NAME')
+#XXX: {"<schema>.<table>": ["<primary key column>", ...]}
+PRIMARY_KEYS = json.loads(os.getenv('PRIMARY_KEYS', '{}'))
+#XXX: tombstone - index deleted rows with `_deleted: true`, delete - delete their documents
+DELETE_MODE = os.getenv('DELETE_MODE', 'tombstone')
+METADATA_FIELDS = [e.strip() for e in os.getenv('METADATA_FIELDS',
+  'timestamp,operation,schema-name,table-name,transaction-id').split(',') if e.strip()]
+METADATA_FIELD_PREFIX = os.getenv('METADATA_FIELD_PREFIX', '_')
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', '5'))
+#XXX: The limits of a `_bulk` request, and the number of requests in flight
+BULK_MAX_DOCS = int(os.getenv('BULK_MAX_DOCS', '1000'))
+BULK_MAX_BYTES = int(os.getenv('BULK_MAX_BYTES', str(5 * 1024 * 1024)))
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', '4'))
+
+
+def build_actions(dms_records):
+  return dms_bulk_actions(dms_records, INDEX_NAME, PRIMARY_KEYS, DELETE_MODE, METADATA_FIELDS, METADATA_FIELD_PREFIX)
+
+
+_writer = None
+
+
+def lambda_handler(event, context):
+  global _writer
+  if _writer is None:
+    #XXX: The writer outlives a single invocation, so warm invocations reuse keep-alive connections.
+    transport = BulkTransport(OPENSEARCH_ENDPOINT, region=os.environ['AWS_REGION'], pool_size=BULK_CONCURRENCY)
+    _writer = BulkWriter(transport, max_docs=BULK_MAX_DOCS, max_bytes=BULK_MAX_BYTES,
+      concurrency=BULK_CONCURRENCY, max_retries=MAX_RETRIES)
+
+  dms_records = [json.loads(binascii.a2b_base64(record['kinesis']['data'])) for record in event['Records']]
+  actions = build_actions(dms_records)
+  #XXX: A failed batch is retried as a whole by the event source mapping,
+  # which is safe because every write is versioned.
+  stats = _writer.write(actions) if actions else {}
+
+  print('[INFO] {}'.format(json.dumps(dict(records=len(dms_records), **stats))), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  with open(sys.argv[1]) as records_file:
+    records = [json.loads(line) for line in records_file if line.strip()]
+  sys.stdout.write(bulk_body(build_actions(records)).decode('utf-8'))
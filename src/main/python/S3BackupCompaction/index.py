@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Compacts the small objects of the Kinesis Data Firehose S3 backup
+
+Firehose delivers an object every buffer interval under `<prefix>YYYY/MM/dd/HH/`, with the records concatenated.
+For each closed hour, this merges them into a few large compressed JSON lines objects
+`<OUTPUT_PREFIX><prefix>YYYY/MM/dd/HH/<run id>-part-NNNNN.json.gz` with a `<run id>-manifest.json`.
+
+  - Objects are read in chunks and the output is written with multipart uploads, so memory stays flat however big the hour is.
+  - Each output is read back and checked against the record count and SHA-256 of what was written,
+    and the source objects are deleted only after all the outputs of the hour are verified and the manifest is written.
+  - Source objects listed in an earlier manifest of the hour (e.g. a run that stopped while deleting) are only deleted,
+    and objects delivered late are compacted by the next run.
+
+To compact given hours locally (COMPRESSION=zstd needs the `zstandard` package):
+  $ BUCKET_NAME=firehose-to-ops-<region>-<account> SOURCE_PREFIXES=retail-trans/ python3 index.py 2024-01-01T05
+'''
+
+import codecs
+import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+import uuid
+import zlib
+
+import boto3
+
+BUCKET_NAME = os.getenv('BUCKET_NAME')
+#XXX: The Firehose `prefix` of each delivery stream, e.g. retail-trans/
+SOURCE_PREFIXES = [e.strip() for e in os.getenv('SOURCE_PREFIXES', '').split(',') if e.strip()]
+OUTPUT_PREFIX = os.getenv('OUTPUT_PREFIX', 'compacted/')
+#XXX: gzip or zstd
+COMPRESSION = os.getenv('COMPRESSION', 'gzip')
+#XXX: The uncompressed bytes of an output object before another one is started
+MAX_OUTPUT_BYTES = int(os.getenv('MAX_OUTPUT_BYTES', str(1024 * 1024 * 1024)))
+#XXX: An hour is closed this many minutes after it ends, since Firehose delivers a buffer up to 15 minutes later.
+CLOSE_GRACE_MINUTES = int(os.getenv('CLOSE_GRACE_MINUTES', '30'))
+#XXX: Closed hours are compacted up to this many hours back, so that a missed run is caught up.
+LOOKBACK_HOURS = int(os.getenv('LOOKBACK_HOURS', '24'))
+DELETE_SOURCES = os.getenv('DELETE_SOURCES', 'true').lower() == 'true'
+
+HOUR_FMT = '%Y-%m-%dT%H'
+READ_CHUNK_SIZE = 1024 * 1024
+#XXX: Every part of a multipart upload but the last one should be at least 5 MB.
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+MAX_DELETE_KEYS = 1000
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+
+
+def new_compressor(compression):
+  if compression == 'zstd':
+    import zstandard
+    return zstandard.ZstdCompressor(level=3).compressobj()
+  return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def new_decompressor(compression):
+  if compression == 'zstd':
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+  return zlib.decompressobj(31)
+
+
+def output_suffix(compression):
+  return '.json.zst' if compression == 'zstd' else '.json.gz'
+
+
+def iter_record_lines(chunks):
+  '''Yields each record of a stream of concatenated JSON records as its original text plus a newline.'''
+
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  buf, pos = '', 0
+  for chunk in chunks:
+    buf = buf[pos:] + decoder.decode(chunk)
+    pos = 0
+    while True:
+      pos = _WHITESPACE_RE.match(buf, pos).end()
+      if pos == len(buf):
+        break
+      try:
+        _, end = _json_decoder.raw_decode(buf, pos)
+      except json.JSONDecodeError:
+        #XXX: The record continues in the next chunk.
+        break
+      yield buf[pos:end] + '\n'
+      pos = end
+  tail = buf[pos:] + decoder.decode(b'', final=True)
+  if tail.strip():
+    raise ValueError('truncated or invalid JSON: {}'.format(tail[:200]))
+
+
+def read_chunks(s3, bucket, key):
+  body = s3.get_object(Bucket=bucket, Key=key)['Body']
+  try:
+    for chunk in iter(lambda: body.read(READ_CHUNK_SIZE), b''):
+      yield chunk
+  finally:
+    body.close()
+
+
+class MultipartWriter:
+  '''Compresses and uploads an object in parts, keeping at most one part in memory.'''
+
+  def __init__(self, s3, bucket, key, compression):
+    self.s3, self.bucket, self.key = s3, bucket, key
+    self.compressor = new_compressor(compression)
+    self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    self.parts = []
+    self.buffer = bytearray()
+    self.records = 0
+    self.raw_bytes = 0
+    self.sha256 = hashlib.sha256()
+
+  def write(self, line):
+    data = line.encode('utf-8')
+    self.records += 1
+    self.raw_bytes += len(data)
+    self.sha256.update(data)
+    self.buffer += self.compressor.compress(data)
+    if len(self.buffer) >= UPLOAD_PART_SIZE:
+      self._upload_part()
+
+  def _upload_part(self):
+    part_number = len(self.parts) + 1
+    response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+      PartNumber=part_number, Body=bytes(self.buffer))
+    self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+    self.buffer = bytearray()
+
+  def close(self):
+    '''Completes the upload and returns the entry of the object in the manifest.'''
+
+    self.buffer += self.compressor.flush()
+    self._upload_part()
+    self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+      MultipartUpload={'Parts': self.parts})
+    return {'key': self.key, 'records': self.records, 'raw_bytes': self.raw_bytes, 'sha256': self.sha256.hexdigest()}
+
+  def abort(self):
+    self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def verify_output(s3, bucket, output, compression):
+  '''Reads an output object back and checks its record count and SHA-256 against the manifest entry.'''
+
+  decompressor = new_decompressor(compression)
+  sha256 = hashlib.sha256()
+  records = 0
+  for chunk in read_chunks(s3, bucket, output['key']):
+    data = decompressor.decompress(chunk)
+    sha256.update(data)
+    records += data.count(b'\n')
+  if compression != 'zstd':
+    data = decompressor.flush()
+    sha256.update(data)
+    records += data.count(b'\n')
+  if records != output['records'] or sha256.hexdigest() != output['sha256']:
+    raise RuntimeError('{} does not match what was written ({} records)'.format(output['key'], records))
+
+
+def list_objects(s3, bucket, prefix):
+  paginator = s3.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    yield from page.get('Contents', [])
+
+
+def delete_objects(s3, bucket, keys):
+  for offset in range(0, len(keys), MAX_DELETE_KEYS):
+    response = s3.delete_objects(Bucket=bucket, Delete={
+      'Objects': [{'Key': key} for key in keys[offset:offset + MAX_DELETE_KEYS]], 'Quiet': True})
+    for error in response.get('Errors', []):
+      print('[ERROR] failed to delete {Key}: {Code} {Message}'.format(**error), file=sys.stderr)
+
+
+def compact_hour(s3, bucket, prefix, hour, run_id):
+  '''Compacts the objects of an hour under the prefix and returns its stats.'''
+
+  hour_path = hour.strftime('%Y/%m/%d/%H/')
+  source_prefix = prefix + hour_path
+  output_prefix = OUTPUT_PREFIX + source_prefix
+
+  compacted_keys = set()
+  output_keys = []
+  for obj in list_objects(s3, bucket, output_prefix):
+    if obj['Key'].endswith('-manifest.json'):
+      manifest = json.loads(s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read())
+      compacted_keys.update(source['key'] for source in manifest['sources'])
+      compacted_keys.update(output['key'] for output in manifest['outputs'])
+    else:
+      output_keys.append(obj['Key'])
+
+  #XXX: Outputs without a manifest are left by a run that stopped before verifying them, and their sources are compacted again.
+  orphan_keys = [key for key in output_keys if key not in compacted_keys]
+  if orphan_keys:
+    delete_objects(s3, bucket, orphan_keys)
+
+  sources = [{'key': obj['Key'], 'size': obj['Size'], 'etag': obj['ETag']}
+    for obj in list_objects(s3, bucket, source_prefix)]
+  leftover_keys = [source['key'] for source in sources if source['key'] in compacted_keys]
+  sources = [source for source in sources if source['key'] not in compacted_keys]
+  stats = {'prefix': source_prefix, 'sources': len(sources), 'source_bytes': sum(s['size'] for s in sources),
+    'outputs': 0, 'records': 0, 'deleted': 0}
+
+  if leftover_keys and DELETE_SOURCES:
+    delete_objects(s3, bucket, leftover_keys)
+    stats['deleted'] += len(leftover_keys)
+  if not sources:
+    return stats
+
+  outputs = []
+  writer = None
+  try:
+    for source in sources:
+      for line in iter_record_lines(read_chunks(s3, bucket, source['key'])):
+        if writer is None:
+          writer = MultipartWriter(s3, bucket, '{}{}-part-{:05d}{}'.format(output_prefix, run_id, len(outputs),
+            output_suffix(COMPRESSION)), COMPRESSION)
+        writer.write(line)
+        if writer.raw_bytes >= MAX_OUTPUT_BYTES:
+          outputs.append(writer.close())
+          writer = None
+    if writer is not None:
+      outputs.append(writer.close())
+      writer = None
+  except Exception:
+    if writer is not None:
+      writer.abort()
+    raise
+
+  for output in outputs:
+    verify_output(s3, bucket, output, COMPRESSION)
+
+  manifest = {
+    'run_id': run_id,
+    'hour': hour.strftime(HOUR_FMT),
+    'compression': COMPRESSION,
+    'sources': sources,
+    'outputs': outputs,
+    'records': sum(output['records'] for output in outputs)
+  }
+  #XXX: The manifest is written only after every output is verified, and it marks the sources as safe to delete.
+  s3.put_object(Bucket=bucket, Key='{}{}-manifest.json'.format(output_prefix, run_id),
+    Body=json.dumps(manifest, indent=2).encode('utf-8'), ContentType='application/json')
+
+  if DELETE_SOURCES:
+    delete_objects(s3, bucket, [source['key'] for source in sources])
+    stats['deleted'] += len(sources)
+  stats.update(outputs=len(outputs), records=manifest['records'])
+  return stats
+
+
+def closed_hours(now):
+  last_closed = (now - datetime.timedelta(minutes=CLOSE_GRACE_MINUTES)).replace(minute=0, second=0, microsecond=0) \
+    - datetime.timedelta(hours=1)
+  return [last_closed - datetime.timedelta(hours=i) for i in reversed(range(LOOKBACK_HOURS))]
+
+
+def compact(s3, hours):
+  run_id = '{}-{}'.format(datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+  results = []
+  for prefix in SOURCE_PREFIXES:
+    for hour in hours:
+      stats = compact_hour(s3, BUCKET_NAME, prefix, hour, run_id)
+      if stats['sources'] or stats['deleted']:
+        print('[INFO] {}'.format(json.dumps(stats)), file=sys.stderr)
+      results.append(stats)
+  return results
+
+
+def lambda_handler(event, context):
+  #XXX: {"hours": ["2024-01-01T05", ...]} compacts the given hours instead of the closed hours of the lookback window.
+  if event.get('hours'):
+    hours = [datetime.datetime.strptime(hour, HOUR_FMT) for hour in event['hours']]
+  else:
+    hours = closed_hours(datetime.datetime.utcnow())
+
+  results = compact(boto3.client('s3'), hours)
+  return {
+    'sources': sum(stats['sources'] for stats in results),
+    'outputs': sum(stats['outputs'] for stats in results),
+    'records': sum(stats['records'] for stats in results)
+  }
+
+
+if __name__ == '__main__':
+  print(json.dumps(lambda_handler({'hours': sys.argv[1:]}, None), indent=2))
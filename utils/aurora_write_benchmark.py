@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Aurora MySQL writer benchmark
+
+Runs the workloads of `gen_fake_mysql_data.py` against the writers of one or more Aurora MySQL clusters,
+e.g. one deployed with the default `aurora_mysql_profile` and one with `cdc_optimized`,
+and compares insert throughput, commit latency and binlog bytes per row for each batch size and number of workers.
+
+Example:
+  $ python3 utils/aurora_write_benchmark.py -u admin -p <password> \
+      --target default=<writer-endpoint-1> --target cdc_optimized=<writer-endpoint-2> \
+      --batch-sizes 1,100 --workers 1,8 --max-count 100000
+'''
+
+import argparse
+import datetime
+import json
+import sys
+
+import pymysql
+
+from gen_fake_mysql_data import (
+  CREATE_TABLE_SQL_FMT,
+  DEFAULT_SEED,
+  DROP_TABLE_SQL_FMT,
+  ProgressReporter,
+  np,
+  parse_workload_mix,
+  run_workers,
+  run_workload_worker,
+  workload_worker_args
+)
+
+BINLOG_VARIABLES = ('aurora_version', 'aurora_enhanced_binlog', 'binlog_format', 'binlog_row_image', 'binlog_checksum')
+
+
+def parse_target(value):
+  name, sep, host = value.partition('=')
+  if not sep or not name or not host:
+    raise argparse.ArgumentTypeError('should be <name>=<writer endpoint>: {}'.format(value))
+  return name, host
+
+
+def parse_int_list(value):
+  try:
+    values = [int(e) for e in value.split(',')]
+  except ValueError:
+    raise argparse.ArgumentTypeError('should be comma-separated integers: {}'.format(value))
+  if any(e <= 0 for e in values):
+    raise argparse.ArgumentTypeError('should be greater than 0: {}'.format(value))
+  return values
+
+
+def binlog_settings(conn):
+  with conn.cursor() as cursor:
+    cursor.execute('SHOW GLOBAL VARIABLES WHERE Variable_name IN ({})'.format(', '.join(['%s'] * len(BINLOG_VARIABLES))),
+      BINLOG_VARIABLES)
+    settings = dict(cursor.fetchall())
+    #XXX: AWS DMS needs the binlog files of the writer until it reads them, see `binlog retention hours`.
+    cursor.execute('CALL mysql.rds_show_configuration')
+    for row in cursor.fetchall():
+      if row[0] == 'binlog retention hours':
+        settings['binlog_retention_hours'] = row[1]
+  return settings
+
+
+def binlog_size(conn):
+  with conn.cursor() as cursor:
+    cursor.execute('SHOW BINARY LOGS')
+    return sum(row[1] for row in cursor.fetchall())
+
+
+def run_benchmark(options, host, batch_size, num_workers):
+  '''Loads `options.max_count` rows into a new table and returns the stats of the load generator.'''
+
+  conn = pymysql.connect(host=host, user=options.user, password=options.password, charset='utf8mb4', autocommit=True)
+  db_table = dict(database=options.database, table=options.table)
+  with conn.cursor() as cursor:
+    cursor.execute(DROP_TABLE_SQL_FMT.format(**db_table))
+    cursor.execute(CREATE_TABLE_SQL_FMT.format(**db_table))
+  binlog_size_before = binlog_size(conn)
+
+  workload_options = argparse.Namespace(**vars(options))
+  workload_options.host = host
+  workload_options.batch_size = batch_size
+  workload_options.workers = num_workers
+  workload_options.dry_run = False
+
+  start_datetime = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+  reporter = ProgressReporter(options.report_interval)
+  run_workers(reporter, run_workload_worker, workload_worker_args(workload_options, start_datetime))
+  stats = reporter.stats()
+
+  #XXX: Binary logs are rotated and purged by Aurora, so this is a lower bound when a run spans a purge.
+  stats['binlog_bytes_per_row'] = max(0, binlog_size(conn) - binlog_size_before) / max(stats['rows'], 1)
+
+  if not options.keep_table:
+    with conn.cursor() as cursor:
+      cursor.execute(DROP_TABLE_SQL_FMT.format(**db_table))
+  conn.close()
+  return dict(batch_size=batch_size, workers=num_workers, **stats)
+
+
+def print_comparison(results):
+  '''Prints the runs of each target relative to the same runs of the first target.'''
+
+  baseline_name, baseline = next(iter(results.items()))
+  baseline_runs = {(run['batch_size'], run['workers']): run for run in baseline['runs']}
+  print('{:<16} {:>6} {:>8} {:>12} {:>10} {:>10} {:>14}'.format(
+    'target', 'batch', 'workers', 'rows/sec', 'p50 ms', 'p99 ms', 'binlog B/row'), file=sys.stderr)
+  for name, result in results.items():
+    for run in result['runs']:
+      base = baseline_runs.get((run['batch_size'], run['workers']))
+      delta = ' ({:+.1f}%)'.format((run['rows_per_sec'] / base['rows_per_sec'] - 1) * 100) \
+        if name != baseline_name and base and base['rows_per_sec'] else ''
+      print('{:<16} {:>6} {:>8} {:>12.1f} {:>10.1f} {:>10.1f} {:>14.1f}{}'.format(name, run['batch_size'], run['workers'],
+        run['rows_per_sec'], run['latency_p50_ms'], run['latency_p99_ms'], run['binlog_bytes_per_row'], delta), file=sys.stderr)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--target', action='append', type=parse_target, required=True,
+    help='<name>=<writer endpoint> of a cluster to benchmark (repeat for more clusters; the first one is the baseline)')
+  parser.add_argument('-u', '--user', action='store', help='user name')
+  parser.add_argument('-p', '--password', action='store', help='password')
+  parser.add_argument('--database', action='store', default='testdb',
+    help='database name (default: testdb)')
+  parser.add_argument('--table', action='store', default='bench_trans',
+    help='table name, dropped and created again before each run (default: bench_trans)')
+  parser.add_argument('--keep-table', action='store_true', help='Do not drop the table after each run')
+  parser.add_argument('--max-count', default=100000, type=int, help='The number of rows per run (default: 100000)')
+  parser.add_argument('--batch-sizes', default=[1, 100], type=parse_int_list,
+    help='Comma-separated numbers of rows per transaction to run (default: 1,100)')
+  parser.add_argument('--workers', default=[1, 8], type=parse_int_list,
+    help='Comma-separated numbers of concurrent workers to run (default: 1,8)')
+  parser.add_argument('--target-rate', default=0, type=float,
+    help='The target number of rows per second, 0 for unlimited (default: 0)')
+  parser.add_argument('--mix', default='insert=100', type=parse_workload_mix,
+    help='The weights of operations, e.g. insert=70,update=25,delete=5 (default: insert=100)')
+  parser.add_argument('--key-skew', choices=['uniform', 'zipf'], default='uniform',
+    help='The distribution of keys targeted by update, delete and upsert operations (default: uniform)')
+  parser.add_argument('--zipf-s', default=1.1, type=float,
+    help='The exponent of the zipf distribution with --key-skew zipf (default: 1.1)')
+  parser.add_argument('--key-cache-size', default=100000, type=int,
+    help='The number of recently inserted keys to target with update, delete and upsert operations (default: 100000)')
+  parser.add_argument('--seed', default=DEFAULT_SEED, type=int, help='The random seed (default: {})'.format(DEFAULT_SEED))
+  parser.add_argument('--generator', choices=['numpy', 'faker'], default='numpy' if np is not None else 'faker',
+    help='The record generation engine (default: numpy if it is installed)')
+  parser.add_argument('--report-interval', default=10, type=float,
+    help='Seconds between throughput reports (default: 10)')
+
+  options = parser.parse_args()
+  assert options.max_count > 0, '--max-count should be greater than 0'
+
+  results = {}
+  for name, host in options.target:
+    conn = pymysql.connect(host=host, user=options.user, password=options.password, charset='utf8mb4')
+    settings = binlog_settings(conn)
+    conn.close()
+    print('[INFO] {}: {}'.format(name, json.dumps(settings)), file=sys.stderr)
+
+    runs = []
+    for batch_size in options.batch_sizes:
+      for num_workers in options.workers:
+        print('[INFO] {}: batch size {}, {} workers'.format(name, batch_size, num_workers), file=sys.stderr)
+        runs.append(run_benchmark(options, host, batch_size, num_workers))
+    results[name] = {'host': host, 'settings': settings, 'runs': runs}
+
+  print_comparison(results)
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
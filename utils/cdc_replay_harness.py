@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Local CDC replay harness
+
+Emits DMS `json-unformatted` records of `retail_trans` changes and pushes them through in-memory stand-ins
+for the Kinesis Data Stream (shards, partition keys, per-shard 1 MB/s and 1000 records/s limits)
+and the Kinesis Data Firehose buffering (`intervalInSeconds`/`sizeInMBs`) on a virtual clock,
+so that partitioning, buffering and batching choices can be compared without an AWS account.
+
+Example:
+  $ python3 utils/cdc_replay_harness.py --rate 3000 --duration 60 --shards 2 --buffer-interval 60 --buffer-size-mb 1
+'''
+
+import argparse
+import datetime
+import hashlib
+import itertools
+import json
+import random
+
+from gen_fake_mysql_data import (
+  DEFAULT_SEED,
+  KeyCache,
+  new_record_generator,
+  np,
+  parse_workload_mix,
+  partition_key_of,
+  percentile,
+  to_dms_record
+)
+
+#XXX: Rows are generated in blocks regardless of the transaction size, since a vectorized block is much cheaper per row.
+GENERATE_BLOCK_SIZE = 10000
+
+KINESIS_SHARD_MAX_RECORDS_PER_SEC = 1000
+KINESIS_SHARD_MAX_BYTES_PER_SEC = 1024 * 1024
+KINESIS_MAX_HASH_KEY = 2 ** 128 - 1
+
+
+def hash_key_of(partition_key):
+  #XXX: Kinesis maps a partition key to a shard by the MD5 hash of the key as a 128-bit integer.
+  return int.from_bytes(hashlib.md5(partition_key.encode('utf-8')).digest(), 'big')
+
+
+class CdcEventSource:
+  '''Emits (commit time in seconds, DMS record) of `retail_trans` changes,
+  committed in transactions of `batch_size` rows at `rate` rows per second of virtual time.'''
+
+  def __init__(self, options):
+    self.options = options
+    self.start_datetime = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    self.record_generator = new_record_generator(options, options.seed, self.start_datetime)
+    self.rng = random.Random(options.seed)
+    self.key_cache = KeyCache(options.key_cache_size, self.rng, options.zipf_s if options.key_skew == 'zipf' else 0)
+    self.ops, self.weights = zip(*options.mix.items())
+    #XXX: DMS writes the last values of a deleted row, so they are kept for the keys in the cache.
+    self.last_rows = {}
+
+  def _rows(self, num_records):
+    for offset in range(0, num_records, GENERATE_BLOCK_SIZE):
+      yield from self.record_generator.generate(min(GENERATE_BLOCK_SIZE, num_records - offset))
+
+  def __iter__(self):
+    options = self.options
+    num_records = int(options.rate * options.duration)
+    rows = self._rows(num_records)
+    next_trans_id, transaction_id = 1, 0
+    for offset in range(0, num_records, options.batch_size):
+      num_rows = min(options.batch_size, num_records - offset)
+      commit_time = (offset + num_rows) / options.rate
+      commit_datetime = self.start_datetime + datetime.timedelta(seconds=commit_time)
+      transaction_id += 1
+
+      for row, op in zip(itertools.islice(rows, num_rows), self.rng.choices(self.ops, self.weights, k=num_rows)):
+        if op == 'insert' or not self.key_cache:
+          op, trans_id = 'insert', next_trans_id
+          next_trans_id += 1
+          self.key_cache.add([trans_id])
+        elif op == 'delete':
+          trans_id = self.key_cache.pop()
+          row = self.last_rows.pop(trans_id, row)
+        else:
+          #XXX: DMS writes an upsert of an existing row as an update.
+          op, trans_id = 'update', self.key_cache.pick()
+        before_row = self.last_rows.get(trans_id) if op == 'update' and options.before_image else None
+        if op != 'delete':
+          self.last_rows[trans_id] = row
+          if len(self.last_rows) > 2 * options.key_cache_size:
+            self.last_rows = {key: self.last_rows[key] for key in self.key_cache.keys}
+
+        record = to_dms_record(row, trans_id, op, commit_datetime, transaction_id, options.database, options.table)
+        if before_row is not None:
+          #XXX: Like BeforeImageSettings of the DMS task, with the previous values of every column of the row.
+          record['before-image'] = to_dms_record(before_row, trans_id, op, commit_datetime, transaction_id,
+            options.database, options.table)['data']
+        yield commit_time, record
+
+
+class KinesisShardStandIn:
+  '''Admits records within the per-shard limits of each 1-second window.
+  A record over the limits is throttled and retried in the next window, like the DMS Kinesis target does.'''
+
+  def __init__(self, max_records_per_sec, max_bytes_per_sec):
+    self.max_records_per_sec = max_records_per_sec
+    self.max_bytes_per_sec = max_bytes_per_sec
+    self.window = 0
+    self.window_records = 0
+    self.window_bytes = 0
+    self.num_records = 0
+    self.num_bytes = 0
+    self.num_throttled = 0
+
+  def put(self, t, size):
+    '''Returns the time when the record is accepted.'''
+
+    if int(t) > self.window:
+      self.window, self.window_records, self.window_bytes = int(t), 0, 0
+    while self.window_records + 1 > self.max_records_per_sec or self.window_bytes + size > self.max_bytes_per_sec:
+      self.window, self.window_records, self.window_bytes = self.window + 1, 0, 0
+    #XXX: A record is throttled if it is accepted after it was put, however many windows it waited for.
+    if self.window > t:
+      self.num_throttled += 1
+
+    self.window_records += 1
+    self.window_bytes += size
+    self.num_records += 1
+    self.num_bytes += size
+    return max(t, self.window)
+
+
+class KinesisStreamStandIn:
+
+  def __init__(self, num_shards, max_records_per_sec=KINESIS_SHARD_MAX_RECORDS_PER_SEC,
+      max_bytes_per_sec=KINESIS_SHARD_MAX_BYTES_PER_SEC):
+    #XXX: Shards evenly split the 128-bit hash key range like a newly created (or evenly resharded) stream.
+    self.hash_key_range_size = (KINESIS_MAX_HASH_KEY + 1) // num_shards
+    self.shards = [KinesisShardStandIn(max_records_per_sec, max_bytes_per_sec) for _ in range(num_shards)]
+
+  def shard_index(self, partition_key):
+    return min(hash_key_of(partition_key) // self.hash_key_range_size, len(self.shards) - 1)
+
+  def put_record(self, t, partition_key, data):
+    #XXX: The partition key counts toward the per-shard throughput limit as well as the data blob.
+    size = len(data) + len(partition_key.encode('utf-8'))
+    return self.shards[self.shard_index(partition_key)].put(t, size)
+
+
+class FirehoseStandIn:
+  '''Buffers records and flushes a batch when the buffer reaches `size_mb` or
+  `interval_sec` has passed since the first record in the buffer arrived, whichever comes first.'''
+
+  def __init__(self, interval_sec, size_mb):
+    self.interval_sec = interval_sec
+    self.max_bytes = size_mb * 1024 * 1024
+    self.buffer_start = None
+    self.buffer_records = []
+    self.buffer_bytes = 0
+    self.batches = []
+    self.latencies = []
+
+  def _flush(self, flush_time):
+    self.batches.append((flush_time, len(self.buffer_records), self.buffer_bytes))
+    self.latencies.extend(flush_time - event_time for event_time in self.buffer_records)
+    self.buffer_start, self.buffer_records, self.buffer_bytes = None, [], 0
+
+  def put(self, t, size, event_time):
+    '''Puts records in the order of arrival time `t`.'''
+
+    if self.buffer_start is not None and t >= self.buffer_start + self.interval_sec:
+      self._flush(self.buffer_start + self.interval_sec)
+    if self.buffer_start is None:
+      self.buffer_start = t
+    self.buffer_records.append(event_time)
+    self.buffer_bytes += size
+    if self.buffer_bytes >= self.max_bytes:
+      self._flush(t)
+
+  def close(self):
+    if self.buffer_records:
+      self._flush(self.buffer_start + self.interval_sec)
+
+
+def run(options, dump_file=None):
+  event_source = CdcEventSource(options)
+  kinesis_stream = KinesisStreamStandIn(options.shards)
+
+  arrivals = []
+  put_latencies = []
+  for commit_time, record in event_source:
+    data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+    if dump_file:
+      dump_file.write(data.decode('utf-8') + '\n')
+    accepted_time = kinesis_stream.put_record(commit_time, partition_key_of(record, options.partition_key_type), data)
+    put_latencies.append(accepted_time - commit_time)
+    arrivals.append((accepted_time, len(data), commit_time))
+
+  #XXX: Records from different shards arrive at Firehose in the order of the time they were accepted by Kinesis.
+  arrivals.sort()
+  firehose = FirehoseStandIn(options.buffer_interval, options.buffer_size_mb)
+  for accepted_time, size, commit_time in arrivals:
+    firehose.put(accepted_time, size, commit_time)
+  firehose.close()
+
+  put_latencies.sort()
+  firehose.latencies.sort()
+  duration = max(options.duration, 1)
+  #XXX: A throttled shard keeps accepting records after the simulated duration,
+  # so its rates are averaged up to the last window it accepted records in.
+  shard_durations = [max(duration, shard.window + 1) for shard in kinesis_stream.shards]
+  return {
+    'records': len(arrivals),
+    'kinesis': {
+      'shards': [{
+        'shard_index': idx,
+        'records_per_sec': shard.num_records / shard_duration,
+        'bytes_per_sec': shard.num_bytes / shard_duration,
+        'duration_sec': shard_duration,
+        'throttled': shard.num_throttled
+      } for idx, (shard, shard_duration) in enumerate(zip(kinesis_stream.shards, shard_durations))],
+      'throttled': sum(shard.num_throttled for shard in kinesis_stream.shards),
+      'put_latency_p50_sec': percentile(put_latencies, 0.5),
+      'put_latency_p99_sec': percentile(put_latencies, 0.99)
+    },
+    'firehose': {
+      'batches': len(firehose.batches),
+      'avg_batch_records': sum(b[1] for b in firehose.batches) / max(len(firehose.batches), 1),
+      'avg_batch_bytes': sum(b[2] for b in firehose.batches) / max(len(firehose.batches), 1),
+      'size_triggered_flushes': sum(1 for b in firehose.batches if b[2] >= firehose.max_bytes)
+    },
+    'end_to_end_latency_p50_sec': percentile(firehose.latencies, 0.5),
+    'end_to_end_latency_p99_sec': percentile(firehose.latencies, 0.99)
+  }
+
+
+def add_event_source_arguments(parser):
+  parser.add_argument('--database', action='store', default='testdb',
+    help='database name (default: testdb)')
+  parser.add_argument('--table', action='store', default='retail_trans',
+    help='table name (default: retail_trans)')
+  parser.add_argument('--rate', default=1000, type=float, help='The number of changed rows per second (default: 1000)')
+  parser.add_argument('--duration', default=60, type=int, help='Seconds of virtual time to simulate (default: 60)')
+  parser.add_argument('--batch-size', default=1, type=int, help='The number of rows per transaction (default: 1)')
+  parser.add_argument('--mix', default='insert=100', type=parse_workload_mix,
+    help='The weights of operations, e.g. insert=70,update=25,delete=5 (default: insert=100)')
+  parser.add_argument('--key-skew', choices=['uniform', 'zipf'], default='uniform',
+    help='The distribution of keys targeted by update and delete operations (default: uniform)')
+  parser.add_argument('--zipf-s', default=1.1, type=float,
+    help='The exponent of the zipf distribution with --key-skew zipf (default: 1.1)')
+  parser.add_argument('--key-cache-size', default=100000, type=int,
+    help='The number of recently inserted keys to target with update and delete operations (default: 100000)')
+  parser.add_argument('--seed', default=DEFAULT_SEED, type=int, help='The random seed (default: {})'.format(DEFAULT_SEED))
+  parser.add_argument('--generator', choices=['numpy', 'faker'], default='numpy' if np is not None else 'faker',
+    help='The record generation engine (default: numpy if it is installed)')
+  parser.add_argument('--before-image', action='store_true',
+    help='Add the previous values of the row to updates as `before-image`, like BeforeImageSettings of the DMS task')
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  add_event_source_arguments(parser)
+  parser.add_argument('--shards', default=1, type=int, help='The number of Kinesis shards (default: 1)')
+  parser.add_argument('--partition-key-type', choices=['primary-key', 'schema-table'], default='primary-key',
+    help='The DMS Kinesis target partition key type (default: primary-key)')
+  parser.add_argument('--buffer-interval', default=60, type=int,
+    help='Firehose buffering hints intervalInSeconds (default: 60)')
+  parser.add_argument('--buffer-size-mb', default=1, type=int,
+    help='Firehose buffering hints sizeInMBs (default: 1)')
+  parser.add_argument('--dump-records', action='store', metavar='FILE',
+    help='Write the generated DMS records into FILE as JSON lines')
+
+  options = parser.parse_args()
+  assert options.shards > 0, '--shards should be greater than 0'
+  assert options.batch_size > 0, '--batch-size should be greater than 0'
+
+  if options.dump_records:
+    with open(options.dump_records, 'w') as dump_file:
+      result = run(options, dump_file)
+  else:
+    result = run(options)
+
+  print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+  main()
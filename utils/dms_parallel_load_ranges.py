@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Computes AWS DMS parallel-load segments of source tables
+
+Samples the primary key of each table from the Aurora MySQL reader endpoint and prints the `dms_parallel_load` context
+for `DMSAuroraMysqlToKinesisStack`, so that a full load splits each table into segments that are loaded in parallel.
+
+  - partitions: a partitioned table is loaded partition by partition (`partitions-auto`)
+  - histogram: boundaries at equal row counts from the histogram of the primary key
+    (create one on the writer with `ANALYZE TABLE <table> UPDATE HISTOGRAM ON <column> WITH 1024 BUCKETS`)
+  - minmax: boundaries at equal widths between MIN and MAX of an integer primary key
+
+Example:
+  $ python3 utils/dms_parallel_load_ranges.py --host <reader-endpoint> -u admin -p <password> \
+      --database testdb --table retail_trans --segments 16
+'''
+
+import argparse
+import base64
+import json
+import sys
+
+import pymysql
+
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+
+
+def primary_key_columns(cursor, database, table):
+  cursor.execute('''SELECT k.COLUMN_NAME, c.DATA_TYPE FROM information_schema.KEY_COLUMN_USAGE k
+    JOIN information_schema.COLUMNS c USING (TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME)
+    WHERE k.TABLE_SCHEMA = %s AND k.TABLE_NAME = %s AND k.CONSTRAINT_NAME = 'PRIMARY'
+    ORDER BY k.ORDINAL_POSITION''', (database, table))
+  return cursor.fetchall()
+
+
+def estimated_row_count(cursor, database, table):
+  cursor.execute('SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s',
+    (database, table))
+  row = cursor.fetchone()
+  return int(row[0] or 0) if row else 0
+
+
+def partition_count(cursor, database, table):
+  cursor.execute('''SELECT COUNT(*) FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL''', (database, table))
+  return cursor.fetchone()[0]
+
+
+def read_histogram(cursor, database, table, column):
+  cursor.execute('''SELECT HISTOGRAM FROM information_schema.COLUMN_STATISTICS
+    WHERE SCHEMA_NAME = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s''', (database, table, column))
+  row = cursor.fetchone()
+  return json.loads(row[0]) if row else None
+
+
+def _histogram_value(value):
+  #XXX: String values of a histogram are encoded as "base64:type<N>:<base64>"
+  if isinstance(value, str) and value.startswith('base64:'):
+    return base64.b64decode(value.split(':', 2)[2]).decode('utf-8')
+  return value
+
+
+def histogram_boundaries(histogram, num_segments):
+  '''Returns the upper bounds of the buckets at which the cumulative frequency crosses i/num_segments.'''
+
+  if histogram['histogram-type'] == 'equi-height':
+    bounds = [(b[1], b[2]) for b in histogram['buckets']]
+  else:
+    bounds = [(b[0], b[1]) for b in histogram['buckets']]
+
+  boundaries = []
+  for i in range(1, num_segments):
+    value = next((v for v, cumulative_frequency in bounds if cumulative_frequency >= i / num_segments), None)
+    if value is not None and (not boundaries or boundaries[-1] != value):
+      boundaries.append(value)
+  return [_histogram_value(v) for v in boundaries]
+
+
+def minmax_boundaries(min_value, max_value, num_segments):
+  width = (max_value - min_value + 1) / num_segments
+  return sorted(set(min_value + int(width * i) for i in range(1, num_segments)))
+
+
+def parallel_load_rule(cursor, database, table, num_segments, method):
+  if method in ('auto', 'partitions') and partition_count(cursor, database, table) > 1:
+    return {'type': 'partitions-auto'}
+  assert method != 'partitions', f'{database}.{table} is not partitioned'
+
+  columns = primary_key_columns(cursor, database, table)
+  assert columns, f'{database}.{table} has no primary key'
+  #XXX: Segments are split on the first column of a composite primary key.
+  column, data_type = columns[0]
+
+  boundaries = None
+  if method in ('auto', 'histogram'):
+    histogram = read_histogram(cursor, database, table, column)
+    if histogram:
+      boundaries = histogram_boundaries(histogram, num_segments)
+    else:
+      assert method != 'histogram', f'No histogram on {database}.{table}.{column}: ' \
+        f'run ANALYZE TABLE {database}.{table} UPDATE HISTOGRAM ON {column} WITH 1024 BUCKETS on the writer'
+
+  if boundaries is None:
+    assert data_type in INTEGER_TYPES, f'{database}.{table}.{column} is not an integer, so a histogram is required'
+    cursor.execute(f'SELECT MIN(`{column}`), MAX(`{column}`) FROM `{database}`.`{table}`')
+    min_value, max_value = cursor.fetchone()
+    if min_value is None:
+      return None
+    boundaries = minmax_boundaries(min_value, max_value, num_segments)
+
+  if not boundaries:
+    return None
+  return {
+    'type': 'ranges',
+    'columns': [column],
+    'boundaries': [[str(v)] for v in boundaries]
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--host', action='store', help='database host (the reader endpoint of the Aurora MySQL cluster)')
+  parser.add_argument('-u', '--user', action='store', help='user name')
+  parser.add_argument('-p', '--password', action='store', help='password')
+  parser.add_argument('--database', action='store', default='testdb',
+    help='database name (default: testdb)')
+  parser.add_argument('--table', action='append',
+    help='table name (repeat for more tables, default: retail_trans)')
+  parser.add_argument('--segments', default=16, type=int,
+    help='The number of segments of each table (default: 16)')
+  parser.add_argument('--min-rows-per-segment', default=1000000, type=int,
+    help='Split a table into fewer segments so that each one has at least this many rows (default: 1000000)')
+  parser.add_argument('--method', choices=['auto', 'partitions', 'histogram', 'minmax'], default='auto',
+    help='How to split tables (default: auto - partitions, histogram, or minmax in that order)')
+
+  options = parser.parse_args()
+  tables = options.table or ['retail_trans']
+
+  conn = pymysql.connect(host=options.host, user=options.user, password=options.password, charset='utf8mb4')
+  parallel_load = {}
+  with conn.cursor() as cursor:
+    for table in tables:
+      num_rows = estimated_row_count(cursor, options.database, table)
+      num_segments = max(1, min(options.segments, num_rows // max(1, options.min_rows_per_segment)))
+      rule = parallel_load_rule(cursor, options.database, table, num_segments, options.method) if num_segments > 1 else None
+      print('[INFO] {}.{}: ~{} rows, {}'.format(options.database, table, num_rows,
+        rule['type'] if rule else 'no segments'), file=sys.stderr)
+      if rule:
+        parallel_load[table] = rule
+  conn.close()
+
+  print(json.dumps({'dms_migration_type': 'full-load-and-cdc', 'dms_parallel_load': parallel_load}, indent=2))
+
+
+if __name__ == '__main__':
+  main()
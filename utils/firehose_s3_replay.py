@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Replay the Kinesis Data Firehose S3 backup into OpenSearch
+
+Lists the objects of one or more prefixes of the `firehose-to-ops-*` bucket (or of a local directory with the same layout),
+optionally only those of the UTC hours in [--start, --end), and re-indexes their records into OpenSearch in bulk.
+
+  - The backup of every document (`<index name>/YYYY/MM/dd/HH/...`) holds the records as Firehose delivered them,
+    concatenated without delimiters. Objects ending with `.gz` (or `.zst`, with the `zstandard` package) are decompressed on the fly.
+  - Outputs of the S3BackupCompaction function (`compacted/...`) are replayed only if they are listed in a manifest,
+    i.e. verified, and the manifests themselves are not replayed.
+  - Failed deliveries (`error/...`) are JSON envelopes with the base64 `rawData` of the record,
+    which is indexed with the `esDocumentId` Firehose used, if any.
+
+Objects are read in parallel by `--readers` threads in chunks, and at most `2 x --readers` batches of actions are buffered,
+so memory stays bounded regardless of the size of the objects. The keys of the objects whose documents are all written
+are appended to the `--checkpoint` file, and skipped when the replay is run again with the same file.
+
+In `append` mode, documents are indexed as they are, with ids derived from the object key and the record position,
+so that a replay resumed in the middle of an object does not index a document twice.
+In `upsert` mode, DMS records are indexed by primary key like the OpenSearchUpsert Lambda function does.
+
+Example:
+  $ python3 utils/firehose_s3_replay.py --source s3://firehose-to-ops-<region>-<account> --prefix error/ \
+      --start 2024-01-01T00 --end 2024-01-02T00 --opensearch-endpoint https://<domain endpoint> --region <region> \
+      --index retail-trans --checkpoint replay.checkpoint --max-docs-per-sec 5000
+'''
+
+import argparse
+import base64
+import codecs
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import zlib
+
+from gen_fake_mysql_data import ProgressReporter, RateLimiter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/main/python/OpenSearchBulkWriter/python'))
+from opensearch_bulk_writer import BulkTransport, BulkWriter, dms_bulk_actions, index_action
+
+#XXX: Kinesis Data Firehose appends the `YYYY/MM/dd/HH/` UTC prefix to the keys it delivers.
+HOUR_PATH_RE = re.compile(r'(?:^|/)(\d{4})/(\d{2})/(\d{2})/(\d{2})/')
+HOUR_FMT = '%Y-%m-%dT%H'
+
+READ_CHUNK_SIZE = 1024 * 1024
+MANIFEST_SUFFIX = '-manifest.json'
+#XXX: The outputs of the S3BackupCompaction function, `<run id>-part-NNNNN.json.gz` or `.json.zst`
+COMPACTED_OUTPUT_RE = re.compile(r'(?:^|/)\d{8}T\d{6}-[0-9a-f]+-part-\d{5}\.json\.(?:gz|zst)$')
+#XXX: How often a reader waiting for room in the queue checks whether the replay has stopped
+QUEUE_PUT_TIMEOUT_SEC = 0.5
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+
+
+class LocalObjectStore:
+  '''A directory laid out like a bucket, e.g. for replaying objects downloaded with `aws s3 sync`.'''
+
+  def __init__(self, root_dir):
+    self.root_dir = root_dir
+
+  def list(self, prefix, start_after=''):
+    keys = []
+    for dir_path, _, file_names in os.walk(self.root_dir):
+      for file_name in file_names:
+        key = os.path.relpath(os.path.join(dir_path, file_name), self.root_dir).replace(os.sep, '/')
+        if key.startswith(prefix) and key > start_after:
+          keys.append(key)
+    return sorted(keys)
+
+  def open(self, key):
+    return open(os.path.join(self.root_dir, key), 'rb')
+
+
+class S3ObjectStore:
+
+  def __init__(self, bucket, endpoint_url=None):
+    import boto3
+
+    self.bucket = bucket
+    self.s3 = boto3.client('s3', endpoint_url=endpoint_url)
+
+  def list(self, prefix, start_after=''):
+    paginator = self.s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, StartAfter=start_after):
+      for obj in page.get('Contents', []):
+        yield obj['Key']
+
+  def open(self, key):
+    return self.s3.get_object(Bucket=self.bucket, Key=key)['Body']
+
+
+def open_object_store(source, endpoint_url=None):
+  if source.startswith('s3://'):
+    return S3ObjectStore(source[len('s3://'):].strip('/'), endpoint_url)
+  assert os.path.isdir(source), '--source should be s3://<bucket> or a directory: {}'.format(source)
+  return LocalObjectStore(source)
+
+
+def parse_hour(value):
+  try:
+    return datetime.datetime.strptime(value, HOUR_FMT)
+  except ValueError:
+    raise argparse.ArgumentTypeError('should be a UTC hour like 2024-01-01T00: {}'.format(value))
+
+
+def hour_of_key(key):
+  m = HOUR_PATH_RE.search(key)
+  return datetime.datetime(*[int(e) for e in m.groups()]) if m else None
+
+
+def read_manifest(store, key):
+  body = store.open(key)
+  try:
+    return json.loads(body.read())
+  finally:
+    body.close()
+
+
+def list_keys(store, prefixes, start=None, end=None):
+  '''Returns the keys under the prefixes, only those of the hours in [start, end) if either is given.
+  Compaction manifests and the compacted outputs that are not listed in any of them are left out.'''
+
+  keys = []
+  for prefix in prefixes:
+    #XXX: Keys right under the prefix are listed in time order, so the listing can start at the first hour.
+    start_after = prefix + start.strftime('%Y/%m/%d/%H') if start else ''
+    for key in store.list(prefix, start_after):
+      if start or end:
+        hour = hour_of_key(key[len(prefix):])
+        if hour is None or (start and hour < start) or (end and hour >= end):
+          continue
+      keys.append(key)
+
+  verified_outputs = set()
+  for key in keys:
+    if key.endswith(MANIFEST_SUFFIX):
+      verified_outputs.update(output['key'] for output in read_manifest(store, key)['outputs'])
+  #XXX: Outputs without a manifest are left by a compaction run that stopped before verifying them,
+  # and their records are still in the source objects.
+  unverified_keys = {key for key in keys if COMPACTED_OUTPUT_RE.search(key) and key not in verified_outputs}
+  if unverified_keys:
+    print('[WARNING] {} compacted objects are skipped, since they are not listed in a manifest, e.g. {}'.format(
+      len(unverified_keys), min(unverified_keys)), file=sys.stderr)
+  return [key for key in keys if not key.endswith(MANIFEST_SUFFIX) and key not in unverified_keys]
+
+
+def read_chunks(body, key, chunk_size=READ_CHUNK_SIZE):
+  '''Yields the bytes of an object in chunks, decompressing `.gz` objects of one or more gzip members and `.zst` objects.'''
+
+  if key.endswith('.zst'):
+    import zstandard
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    try:
+      for chunk in iter(lambda: body.read(chunk_size), b''):
+        yield decompressor.decompress(chunk)
+    finally:
+      body.close()
+    return
+
+  decompressor = zlib.decompressobj(wbits=47) if key.endswith('.gz') else None
+  try:
+    while True:
+      chunk = body.read(chunk_size)
+      if not chunk:
+        break
+      while decompressor and chunk:
+        data = decompressor.decompress(chunk)
+        chunk = decompressor.unused_data
+        if chunk:
+          decompressor = zlib.decompressobj(wbits=47)
+        yield data
+      if not decompressor:
+        yield chunk
+    if decompressor:
+      yield decompressor.flush()
+  finally:
+    body.close()
+
+
+def iter_json_values(chunks):
+  '''Yields the JSON values of a stream of concatenated or newline-delimited JSON values.'''
+
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  buf, pos = '', 0
+  for chunk in chunks:
+    buf = buf[pos:] + decoder.decode(chunk)
+    pos = 0
+    while True:
+      pos = _WHITESPACE_RE.match(buf, pos).end()
+      if pos == len(buf):
+        break
+      try:
+        value, pos = _json_decoder.raw_decode(buf, pos)
+      except json.JSONDecodeError:
+        #XXX: The value continues in the next chunk.
+        break
+      yield value
+  tail = buf[pos:] + decoder.decode(b'', final=True)
+  if tail.strip():
+    raise ValueError('truncated or invalid JSON: {}'.format(tail[:200]))
+
+
+def unwrap_records(value):
+  '''Yields (document, document id or None) of a backed up record, or of the `rawData` of a Firehose error envelope.'''
+
+  if isinstance(value, dict) and 'rawData' in value and 'errorCode' in value:
+    doc_id = value.get('esDocumentId') or None
+    for doc in iter_json_values([base64.b64decode(value['rawData'])]):
+      yield doc, doc_id
+  else:
+    yield value, None
+
+
+class ReplayCheckpoint:
+  '''The keys of the objects whose documents are all written, one per line.'''
+
+  def __init__(self, path):
+    self.done = set()
+    self.file = None
+    if path:
+      if os.path.exists(path):
+        with open(path) as checkpoint_file:
+          self.done.update(line.strip() for line in checkpoint_file if line.strip())
+      self.file = open(path, 'a')
+
+  def __contains__(self, key):
+    return key in self.done
+
+  def add(self, key):
+    self.done.add(key)
+    if self.file:
+      self.file.write(key + '\n')
+      self.file.flush()
+
+  def close(self):
+    if self.file:
+      self.file.close()
+
+
+def build_actions(options, key, records):
+  '''Returns (actions, the number of skipped records) of (ordinal, document, document id) of an object.'''
+
+  if options.mode == 'upsert':
+    dms_records = [doc for _, doc, _ in records if isinstance(doc, dict) and 'data' in doc and 'metadata' in doc]
+    actions = dms_bulk_actions(dms_records, options.index, options.primary_keys, options.delete_mode)
+    return actions, len(records) - len(dms_records)
+
+  key_digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+  return [index_action(options.index, doc, doc_id or '{}-{}'.format(key_digest, ordinal))
+    for ordinal, doc, doc_id in records], 0
+
+
+def put_batch(batches, item, stop):
+  '''Puts the item into `batches` once there is room, and returns False instead if the replay stops in the meantime.'''
+
+  while not stop.is_set():
+    try:
+      batches.put(item, timeout=QUEUE_PUT_TIMEOUT_SEC)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+def read_object(store, key, options, batches, stop):
+  '''Puts (key, actions, skipped records, records, final) of an object into `batches`, or (key, exception) if it fails.
+  Returns as soon as `stop` is set, e.g. when writing failed and nobody takes batches out of the queue any more.'''
+
+  if stop.is_set():
+    return
+  try:
+    records = []
+    ordinal = 0
+    for value in iter_json_values(read_chunks(store.open(key), key)):
+      for doc, doc_id in unwrap_records(value):
+        records.append((ordinal, doc, doc_id))
+        ordinal += 1
+      if len(records) >= options.batch_docs:
+        if not put_batch(batches, (key, *build_actions(options, key, records), len(records), False), stop):
+          return
+        records = []
+    put_batch(batches, (key, *build_actions(options, key, records), len(records), True), stop)
+  except Exception as ex:
+    put_batch(batches, (key, ex), stop)
+
+
+def run_replay(options, store, writer):
+  keys = list_keys(store, options.prefix, options.start, options.end)
+  checkpoint = ReplayCheckpoint(options.checkpoint)
+  pending_keys = [key for key in keys if key not in checkpoint]
+  print('[INFO] {} objects to replay ({} already done)'.format(len(pending_keys), len(keys) - len(pending_keys)),
+    file=sys.stderr)
+
+  totals = {'objects': len(pending_keys), 'skipped_objects': len(keys) - len(pending_keys), 'failed_objects': 0,
+    'records': 0, 'skipped_records': 0, 'documents': 0}
+  reporter = ProgressReporter(options.report_interval)
+  rate_limiter = RateLimiter(options.max_docs_per_sec)
+  #XXX: Readers block once this many batches are waiting to be written.
+  batches = queue.Queue(maxsize=options.readers * 2)
+  max_write_docs = options.concurrency * options.max_docs
+  stop = threading.Event()
+
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.readers)
+  try:
+    for key in pending_keys:
+      executor.submit(read_object, store, key, options, batches, stop)
+
+    num_remaining = len(pending_keys)
+    while num_remaining:
+      #XXX: Write batches of several objects together, so that up to --concurrency requests are in flight.
+      items = [batches.get()]
+      num_docs = len(items[0][1]) if len(items[0]) > 2 else 0
+      while num_docs < max_write_docs:
+        try:
+          items.append(batches.get_nowait())
+        except queue.Empty:
+          break
+        num_docs += len(items[-1][1]) if len(items[-1]) > 2 else 0
+
+      actions = [action for item in items if len(item) > 2 for action in item[1]]
+      if actions:
+        rate_limiter.acquire(len(actions))
+        started_at = time.monotonic()
+        if writer:
+          for stat, value in writer.write(actions).items():
+            if stat not in ('batch_docs', 'batch_bytes'):
+              totals[stat] = totals.get(stat, 0) + value
+        reporter.add(len(actions), time.monotonic() - started_at)
+        reporter.maybe_report()
+
+      for item in items:
+        if len(item) == 2:
+          key, ex = item
+          print('[ERROR] {}: {}'.format(key, ex), file=sys.stderr)
+          totals['failed_objects'] += 1
+          num_remaining -= 1
+          continue
+        key, item_actions, skipped, num_records, final = item
+        totals['records'] += num_records
+        totals['skipped_records'] += skipped
+        totals['documents'] += len(item_actions)
+        if final:
+          if writer:
+            checkpoint.add(key)
+          num_remaining -= 1
+  except BaseException:
+    #XXX: Readers blocked on the full queue would keep the executor from shutting down, so they are stopped first.
+    stop.set()
+    raise
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True)
+    checkpoint.close()
+
+  reporter.summary()
+  stats = reporter.stats()
+  totals['elapsed_sec'] = stats['elapsed_sec']
+  totals['documents_per_sec'] = stats['rows_per_sec']
+  return totals
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--source', action='store', required=True,
+    help='s3://<bucket> of the Firehose S3 backup, or a local directory with the same layout')
+  parser.add_argument('--s3-endpoint-url', action='store', help='The endpoint of an S3 compatible stand-in')
+  parser.add_argument('--prefix', action='append', required=True,
+    help='A prefix to replay, e.g. retail-trans/ or error/ (repeat for more prefixes)')
+  parser.add_argument('--start', type=parse_hour, help='The first UTC hour to replay, e.g. 2024-01-01T00')
+  parser.add_argument('--end', type=parse_hour, help='The UTC hour to stop before, e.g. 2024-01-02T00')
+  parser.add_argument('--opensearch-endpoint', action='store', default='https://localhost:9200',
+    help='OpenSearch endpoint (default: https://localhost:9200)')
+  parser.add_argument('--region', action='store', help='Sign requests with SigV4 for the OpenSearch domain in this region')
+  parser.add_argument('--opensearch-user', action='store', help='OpenSearch master user name')
+  parser.add_argument('--opensearch-password', action='store', help='OpenSearch master user password')
+  parser.add_argument('--insecure', action='store_true', help='Do not verify the TLS certificate of OpenSearch')
+  parser.add_argument('--index', action='store', required=True, help='The index to write documents into')
+  parser.add_argument('--mode', choices=['append', 'upsert'], default='append',
+    help='append - index documents as they are, upsert - index DMS records by primary key (default: append)')
+  parser.add_argument('--primary-keys', type=json.loads, default={},
+    help='''The primary keys of tables with --mode upsert, e.g. '{"testdb.retail_trans": ["trans_id"]}' ''')
+  parser.add_argument('--delete-mode', choices=['tombstone', 'delete'], default='tombstone',
+    help='How deleted rows are written with --mode upsert (default: tombstone)')
+  parser.add_argument('--checkpoint', action='store', metavar='FILE',
+    help='Append the keys of replayed objects to FILE, and skip the keys already in it')
+  parser.add_argument('--readers', default=8, type=int, help='The number of objects read at a time (default: 8)')
+  parser.add_argument('--batch-docs', default=1000, type=int,
+    help='The number of records read from an object before they are queued for writing (default: 1000)')
+  parser.add_argument('--max-docs', default=1000, type=int, help='The max documents per `_bulk` request (default: 1000)')
+  parser.add_argument('--max-bytes', default=5 * 1024 * 1024, type=int,
+    help='The max bytes per `_bulk` request (default: 5 MB)')
+  parser.add_argument('--concurrency', default=4, type=int, help='The max `_bulk` requests in flight (default: 4)')
+  parser.add_argument('--max-docs-per-sec', default=0, type=float,
+    help='The max documents written per second, 0 for unlimited (default: 0)')
+  parser.add_argument('--report-interval', default=10, type=float, help='Seconds between progress reports (default: 10)')
+  parser.add_argument('--dry-run', action='store_true', help='Only read and decode the objects, without writing them')
+
+  options = parser.parse_args()
+  assert options.readers > 0, '--readers should be greater than 0'
+  assert options.batch_docs > 0, '--batch-docs should be greater than 0'
+  assert options.mode != 'upsert' or options.primary_keys, '--primary-keys should be given with --mode upsert'
+
+  store = open_object_store(options.source, options.s3_endpoint_url)
+  writer = None
+  if not options.dry_run:
+    basic_auth = '{}:{}'.format(options.opensearch_user, options.opensearch_password) if options.opensearch_user else None
+    transport = BulkTransport(options.opensearch_endpoint, region=options.region, basic_auth=basic_auth,
+      pool_size=options.concurrency, insecure=options.insecure)
+    writer = BulkWriter(transport, max_docs=options.max_docs, max_bytes=options.max_bytes, concurrency=options.concurrency)
+
+  result = run_replay(options, store, writer)
+  print(json.dumps(result, indent=2))
+  if result['failed_objects']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
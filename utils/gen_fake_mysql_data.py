@@ -3,11 +3,22 @@
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import csv
 import datetime
+import gzip
 import itertools
 import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
 import sys
 import string
+import tempfile
 import time
 
 import boto3
@@ -15,7 +26,10 @@ from faker import Faker
 import pymysql
 import dataset
 
-Faker.seed(47)
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 CREATE_TABLE_SQL_FMT = '''
 CREATE TABLE IF NOT EXISTS {database}.{table} (
@@ -32,10 +46,749 @@ CREATE TABLE IF NOT EXISTS {database}.{table} (
 
 DROP_TABLE_SQL_FMT = '''DROP TABLE IF EXISTS {database}.{table};'''
 
-INSERT_SQL_FMT = '''INSERT INTO {database}.{table} (customer_id, event, sku, amount, device, trans_datetime) VALUES("{customer_id}", "{event}", "{sku}", {amount}, "{device}", "{trans_datetime}");'''
+COLUMNS = ('customer_id', 'event', 'sku', 'amount', 'device', 'trans_datetime')
+
+#XXX: A single parameterized multi-row INSERT per batch, i.e. INSERT INTO ... VALUES (...),(...),...
+INSERT_SQL_FMT = '''INSERT INTO {database}.{table} ({columns}) VALUES {values}'''
+
+UPSERT_SQL_FMT = '''INSERT INTO {database}.{table} (trans_id, {columns}) VALUES {values} ON DUPLICATE KEY UPDATE {assignments}'''
+
+UPDATE_SQL_FMT = '''UPDATE {database}.{table} SET {assignments} WHERE trans_id IN ({keys})'''
+
+DELETE_SQL_FMT = '''DELETE FROM {database}.{table} WHERE trans_id IN ({keys})'''
+
+#XXX: The columns changed by UPDATE and upsert operations
+UPDATE_COLUMNS = ('event', 'amount', 'device')
+
+WORKLOAD_OPERATIONS = ('insert', 'update', 'delete', 'upsert')
+
+LOAD_DATA_SQL_FMT = '''LOAD DATA LOCAL INFILE %s INTO TABLE {database}.{table}
+  CHARACTER SET utf8mb4
+  FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+  LINES TERMINATED BY '\\n'
+  ({columns})'''
+
+#XXX: A chunk is recorded in the same transaction as its LOAD DATA, so a chunk is either loaded and recorded or neither.
+# Chunks are recorded by --max-count and --bulk-chunk-size, since the same chunk index holds other rows otherwise.
+BULK_LOAD_PROGRESS_TABLE_SQL_FMT = '''
+CREATE TABLE IF NOT EXISTS {database}.bulk_load_progress (
+  table_name VARCHAR(64) NOT NULL,
+  max_count BIGINT NOT NULL,
+  chunk_size INT NOT NULL,
+  chunk_idx INT NOT NULL,
+  loaded_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY(table_name, max_count, chunk_size, chunk_idx)
+) ENGINE=InnoDB;
+'''
+
+INSERT_BULK_LOAD_PROGRESS_SQL_FMT = '''INSERT INTO {database}.bulk_load_progress (table_name, max_count, chunk_size, chunk_idx)
+  VALUES (%s, %s, %s, %s)'''
+
+SELECT_BULK_LOAD_PROGRESS_SQL_FMT = '''SELECT chunk_idx FROM {database}.bulk_load_progress
+  WHERE table_name = %s AND max_count = %s AND chunk_size = %s'''
+
+DELETE_BULK_LOAD_PROGRESS_SQL_FMT = '''DELETE FROM {database}.bulk_load_progress WHERE table_name = %s'''
 
 DB_URL_FMT = 'mysql+pymysql://{user}:{password}@{host}?autocommit=True'
 
+#XXX: The original generator inserted one record every 3 seconds.
+DEFAULT_TARGET_RATE = 1.0 / 3
+
+DEFAULT_SEED = 47
+
+#XXX: The number of rows generated at once while streaming a chunk file, which bounds memory usage.
+BULK_LOAD_BLOCK_SIZE = 100000
+
+EVENTS = ['visit', 'view', 'cart', 'list', 'like', 'purchase']
+DEVICES = ['pc', 'mobile', 'tablet']
+
+DMS_TIMESTAMP_FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+#XXX: The limits of a Kinesis PutRecords call, and of a record including its partition key
+KINESIS_PUT_RECORDS_MAX_RECORDS = 500
+KINESIS_PUT_RECORDS_MAX_BYTES = 5 * 1024 * 1024
+KINESIS_MAX_RECORD_BYTES = 1024 * 1024
+
+
+class RateLimiter:
+  '''Paces batches so that the number of rows sent per second stays at `rate` (0 means unlimited).'''
+
+  def __init__(self, rate):
+    self.interval = 1.0 / rate if rate > 0 else 0
+    self.next_time = time.monotonic()
+
+  def acquire(self, num_rows):
+    if not self.interval:
+      return
+    now = time.monotonic()
+    if self.next_time > now:
+      time.sleep(self.next_time - now)
+    elif now - self.next_time > 1.0:
+      #XXX: Do not burst to catch up when the database has been slower than the target rate.
+      self.next_time = now
+    self.next_time += num_rows * self.interval
+
+  def wait_time(self):
+    '''Returns the seconds the next `acquire` would sleep for.'''
+
+    return max(0, self.next_time - time.monotonic()) if self.interval else 0
+
+
+class FakerRecordGenerator:
+  '''Generates `retail_trans` rows one by one with Faker.'''
+
+  def __init__(self, seed, start_datetime):
+    self.fake = Faker()
+    self.fake.seed_instance(seed)
+    self.start_datetime = start_datetime
+
+  def generate(self, num_rows):
+    fake = self.fake
+    records = []
+    for _ in range(num_rows):
+      event = fake.random_element(elements=EVENTS)
+      amount = fake.pyint(max_value=100) if event in ['cart', 'purchase'] else 1
+      records.append((
+        fake.pystr_format(string_format='%###########'), # customer_id
+        event,
+        fake.pystr_format(string_format='??%###????', letters=string.ascii_uppercase), # sku
+        amount,
+        fake.random_element(elements=DEVICES), # device
+        fake.date_time_ad(start_datetime=self.start_datetime).strftime('%Y-%m-%d %H:%M:%S') # trans_datetime
+      ))
+    return records
+
+
+class VectorizedRecordGenerator:
+  '''Generates a block of `retail_trans` rows at once with NumPy arrays.
+
+  The distributions are the same as the ones of FakerRecordGenerator:
+    - event, device: uniform over EVENTS, DEVICES
+    - amount: uniform in [0, 100] for 'cart' and 'purchase' events, otherwise 1
+    - sku: '??%###????', i.e. 2 uppercase letters, a non-zero digit, 3 digits and 4 uppercase letters
+    - customer_id: '%###########', i.e. a non-zero digit followed by 11 digits
+    - trans_datetime: uniform in [start_datetime, now]
+  '''
+
+  def __init__(self, seed, start_datetime):
+    self.rng = np.random.default_rng(seed)
+    self.start_datetime = start_datetime
+    self.start_ts = np.datetime64(start_datetime, 's')
+    self.events = np.array(EVENTS)
+    self.devices = np.array(DEVICES)
+    self.event_has_amount = np.isin(self.events, ['cart', 'purchase'])
+
+  def _random_chars(self, num_rows, char_ranges):
+    #XXX: Build fixed-length strings as a 2-D array of UCS4 code points and view it as a 1-D unicode array.
+    codes = np.empty((num_rows, len(char_ranges)), dtype=np.uint32)
+    for i, (first_char, num_chars) in enumerate(char_ranges):
+      codes[:, i] = ord(first_char) + self.rng.integers(0, num_chars, num_rows, dtype=np.uint32)
+    return codes.view('U{}'.format(len(char_ranges))).ravel()
+
+  def generate(self, num_rows):
+    rng = self.rng
+
+    event_idx = rng.integers(0, len(self.events), num_rows)
+    amount = np.where(self.event_has_amount[event_idx], rng.integers(0, 101, num_rows), 1)
+    device_idx = rng.integers(0, len(self.devices), num_rows)
+
+    letter, digit, non_zero_digit = ('A', 26), ('0', 10), ('1', 9)
+    sku = self._random_chars(num_rows, [letter] * 2 + [non_zero_digit] + [digit] * 3 + [letter] * 4)
+    customer_id = self._random_chars(num_rows, [non_zero_digit] + [digit] * 11)
+
+    max_offset = max(0, int((datetime.datetime.utcnow() - self.start_datetime).total_seconds()))
+    trans_ts = self.start_ts + rng.integers(0, max_offset + 1, num_rows).astype('timedelta64[s]')
+    #XXX: 'YYYY-MM-DDTHH:MM:SS' -> 'YYYY-MM-DD HH:MM:SS' without a per-row str.replace
+    trans_datetime = np.datetime_as_string(trans_ts, unit='s')
+    trans_datetime.view(np.uint32).reshape(num_rows, -1)[:, 10] = ord(' ')
+
+    return list(zip(customer_id.tolist(), self.events[event_idx].tolist(), sku.tolist(),
+      amount.tolist(), self.devices[device_idx].tolist(), trans_datetime.tolist()))
+
+
+def new_record_generator(options, seed, start_datetime):
+  if options.generator == 'numpy':
+    return VectorizedRecordGenerator(seed, start_datetime)
+  return FakerRecordGenerator(seed, start_datetime)
+
+
+def build_insert_sql(database, table, num_rows):
+  row_placeholder = '({})'.format(', '.join(['%s'] * len(COLUMNS)))
+  return INSERT_SQL_FMT.format(database=database, table=table,
+    columns=', '.join(COLUMNS), values=', '.join([row_placeholder] * num_rows))
+
+
+def percentile(sorted_values, q):
+  if not sorted_values:
+    return 0
+  return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class ProgressReporter:
+  '''Combines rows/sec, INSERT latency percentiles and the counters of the sink, e.g. throttled records, across all the workers.'''
+
+  #XXX: Latencies for the final summary are kept with reservoir sampling so that memory stays bounded.
+  MAX_LATENCY_SAMPLES = 100000
+
+  def __init__(self, report_interval):
+    self.report_interval = report_interval
+    self.total_rows = 0
+    self.num_batches = 0
+    self.latencies = []
+    self.interval_latencies = []
+    self.counters = collections.Counter()
+    self.start_time = self.last_report_time = time.monotonic()
+    self.last_report_rows = 0
+
+  def add(self, num_rows, latency, counters=None):
+    self.total_rows += num_rows
+    self.num_batches += 1
+    self.counters.update(counters or {})
+    self.interval_latencies.append(latency)
+    if len(self.latencies) < self.MAX_LATENCY_SAMPLES:
+      self.latencies.append(latency)
+    else:
+      idx = random.randrange(self.num_batches)
+      if idx < self.MAX_LATENCY_SAMPLES:
+        self.latencies[idx] = latency
+
+  def maybe_report(self):
+    now = time.monotonic()
+    if now - self.last_report_time < self.report_interval:
+      return
+    latencies = sorted(self.interval_latencies)
+    print('[INFO] {} records are processed ({:.1f} rows/sec, p50: {:.1f} ms, p99: {:.1f} ms)'.format(
+      self.total_rows, (self.total_rows - self.last_report_rows) / (now - self.last_report_time),
+      percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000), file=sys.stderr)
+    self.last_report_time, self.last_report_rows = now, self.total_rows
+    self.interval_latencies = []
+
+  def stats(self):
+    elapsed = time.monotonic() - self.start_time
+    latencies = sorted(self.latencies)
+    return {
+      'rows': self.total_rows,
+      'batches': self.num_batches,
+      'elapsed_sec': elapsed,
+      'rows_per_sec': self.total_rows / elapsed if elapsed > 0 else 0,
+      'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+      'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+      **self.counters
+    }
+
+  def summary(self):
+    counters = ''.join(', {}: {}'.format(k, v) for k, v in sorted(self.counters.items()))
+    print('[INFO] Total {rows} records are processed in {elapsed_sec:.2f} sec ({rows_per_sec:.1f} rows/sec, '
+      'p50: {latency_p50_ms:.1f} ms, p99: {latency_p99_ms:.1f} ms{counters})'.format(counters=counters, **self.stats()),
+      file=sys.stderr)
+
+
+class KeyCache:
+  '''A bounded cache of recently inserted trans_ids which UPDATE, DELETE and upsert operations target,
+  so that they do not need a SELECT round trip per operation.
+
+  With zipf_s > 0, the k-th slot is picked with a probability proportional to 1/k^zipf_s,
+  so that a few hot keys get most of the changes.
+  '''
+
+  def __init__(self, capacity, rng, zipf_s=0):
+    self.capacity = capacity
+    self.rng = rng
+    self.keys = []
+    self.cdf = list(itertools.accumulate(1.0 / k ** zipf_s for k in range(1, capacity + 1))) if zipf_s > 0 else None
+
+  def __len__(self):
+    return len(self.keys)
+
+  def add(self, keys):
+    for key in keys:
+      if len(self.keys) < self.capacity:
+        self.keys.append(key)
+      else:
+        self.keys[self.rng.randrange(self.capacity)] = key
+
+  def _pick_index(self):
+    num_keys = len(self.keys)
+    if self.cdf is None:
+      return self.rng.randrange(num_keys)
+    return bisect.bisect_left(self.cdf, self.rng.random() * self.cdf[num_keys - 1], 0, num_keys - 1)
+
+  def pick(self):
+    return self.keys[self._pick_index()]
+
+  def pop(self):
+    idx = self._pick_index()
+    key = self.keys[idx]
+    self.keys[idx] = self.keys[-1]
+    self.keys.pop()
+    return key
+
+
+def to_dms_record(row, trans_id, operation, commit_datetime, transaction_id, schema_name, table_name):
+  '''Returns a record in the same `data`/`metadata` shape as AWS DMS `json-unformatted` messages.'''
+
+  data = {'trans_id': trans_id}
+  data.update(zip(COLUMNS, row))
+  data['trans_datetime'] = data['trans_datetime'].replace(' ', 'T') + 'Z'
+  return {
+    'data': data,
+    'metadata': {
+      'timestamp': commit_datetime.strftime(DMS_TIMESTAMP_FMT),
+      'record-type': 'data',
+      'operation': operation,
+      'partition-key-type': 'primary-key',
+      'schema-name': schema_name,
+      'table-name': table_name,
+      'transaction-id': transaction_id
+    }
+  }
+
+
+def partition_key_of(record, partition_key_type):
+  metadata = record['metadata']
+  if partition_key_type == 'schema-table':
+    return '{}.{}'.format(metadata['schema-name'], metadata['table-name'])
+  return str(record['data']['trans_id'])
+
+
+def parse_workload_mix(mix):
+  weights = {}
+  for item in mix.split(','):
+    op, _, weight = item.partition('=')
+    op = op.strip()
+    if op not in WORKLOAD_OPERATIONS:
+      raise argparse.ArgumentTypeError('unknown operation: {} (choose from {})'.format(op, ', '.join(WORKLOAD_OPERATIONS)))
+    try:
+      weights[op] = int(weight)
+    except ValueError:
+      raise argparse.ArgumentTypeError('invalid weight: {}'.format(item))
+  if sum(weights.values()) <= 0:
+    raise argparse.ArgumentTypeError('the sum of weights should be greater than 0: {}'.format(mix))
+  return weights
+
+
+def build_workload_statements(options, records, op_counts, key_cache):
+  '''Returns (operation, sql, params) of a batch. UPDATE, DELETE and upsert operations are turned into
+  INSERT while there is no key in the key cache.'''
+
+  num_updates, num_upserts, num_deletes = [op_counts.get(op, 0) for op in ('update', 'upsert', 'delete')]
+  if not key_cache:
+    num_updates = num_upserts = num_deletes = 0
+  num_deletes = min(num_deletes, len(key_cache))
+  num_inserts = len(records) - num_updates - num_upserts - num_deletes
+
+  statements = []
+  records = iter(records)
+  db_table = dict(database=options.database, table=options.table)
+  if num_inserts:
+    statements.append(('insert', build_insert_sql(options.database, options.table, num_inserts),
+      list(itertools.chain.from_iterable(itertools.islice(records, num_inserts)))))
+
+  if num_upserts:
+    row_placeholder = '({})'.format(', '.join(['%s'] * (len(COLUMNS) + 1)))
+    sql_stmt = UPSERT_SQL_FMT.format(columns=', '.join(COLUMNS), values=', '.join([row_placeholder] * num_upserts),
+      assignments=', '.join('{0} = VALUES({0})'.format(col) for col in UPDATE_COLUMNS), **db_table)
+    params = list(itertools.chain.from_iterable((key_cache.pick(),) + record
+      for record in itertools.islice(records, num_upserts)))
+    statements.append(('upsert', sql_stmt, params))
+
+  if num_updates:
+    #XXX: A single UPDATE ... SET col = CASE trans_id WHEN ... END WHERE trans_id IN (...) for all the updates in a batch
+    keys = [key_cache.pick() for _ in range(num_updates)]
+    updates = list(itertools.islice(records, num_updates))
+    case_expr = 'CASE trans_id {} END'.format(' '.join(['WHEN %s THEN %s'] * num_updates))
+    sql_stmt = UPDATE_SQL_FMT.format(assignments=', '.join('{} = {}'.format(col, case_expr) for col in UPDATE_COLUMNS),
+      keys=', '.join(['%s'] * num_updates), **db_table)
+    params = []
+    for col in UPDATE_COLUMNS:
+      col_idx = COLUMNS.index(col)
+      for key, record in zip(keys, updates):
+        params.extend((key, record[col_idx]))
+    params.extend(keys)
+    statements.append(('update', sql_stmt, params))
+
+  if num_deletes:
+    keys = [key_cache.pop() for _ in range(num_deletes)]
+    statements.append(('delete', DELETE_SQL_FMT.format(keys=', '.join(['%s'] * num_deletes), **db_table), keys))
+
+  return statements, num_inserts
+
+
+def format_sql(sql_stmt, params):
+  return sql_stmt % tuple(pymysql.converters.escape_item(e, 'utf8mb4') for e in params)
+
+
+def execute_batch(conn, statements):
+  '''Executes the statements of a batch in one transaction, and returns the first trans_id of the inserted rows.'''
+
+  first_insert_id = None
+  try:
+    with conn.cursor() as cursor:
+      for op, sql_stmt, params in statements:
+        cursor.execute(sql_stmt, params)
+        if op == 'insert':
+          first_insert_id = cursor.lastrowid
+    conn.commit()
+  except Exception:
+    conn.rollback()
+    raise
+  return first_insert_id
+
+
+def run_workload_worker(options, worker_id, max_count, target_rate, start_datetime, report):
+  #XXX: Each worker has its own record generator with a seed derived from --seed,
+  # so the first worker generates the same records as a single worker does.
+  record_generator = new_record_generator(options, options.seed + worker_id, start_datetime)
+
+  rng = random.Random(options.seed + worker_id)
+  key_cache = KeyCache(options.key_cache_size, rng, options.zipf_s if options.key_skew == 'zipf' else 0)
+  ops, weights = zip(*options.mix.items())
+  track_keys = any(op != 'insert' for op in ops)
+
+  if not options.dry_run:
+    #XXX: autocommit is off so that each batch is committed as a single transaction
+    conn = pymysql.connect(host=options.host, user=options.user, password=options.password,
+      charset='utf8mb4', autocommit=False)
+
+  max_count = max_count if max_count >= 0 else float('inf')
+  rate_limiter = RateLimiter(target_rate)
+
+  cnt = 0
+  next_dry_run_key = 1
+  while cnt < max_count:
+    num_rows = int(min(options.batch_size, max_count - cnt))
+    records = record_generator.generate(num_rows)
+    op_counts = collections.Counter(rng.choices(ops, weights, k=num_rows)) if len(ops) > 1 else {ops[0]: num_rows}
+    statements, num_inserts = build_workload_statements(options, records, op_counts, key_cache)
+
+    rate_limiter.acquire(num_rows)
+    started_at = time.monotonic()
+    if options.dry_run:
+      for _, sql_stmt, params in statements:
+        print(format_sql(sql_stmt, params), file=sys.stderr)
+      first_insert_id, next_dry_run_key = next_dry_run_key, next_dry_run_key + num_inserts
+    else:
+      first_insert_id = execute_batch(conn, statements)
+    report(num_rows, time.monotonic() - started_at)
+    cnt += num_rows
+
+    #XXX: A multi-row INSERT gets consecutive AUTO_INCREMENT values starting from LAST_INSERT_ID(),
+    # because it is a "simple insert" whose number of rows is known in advance.
+    if num_inserts and track_keys:
+      key_cache.add(range(first_insert_id, first_insert_id + num_inserts))
+
+  if not options.dry_run:
+    conn.close()
+
+
+class KinesisSender:
+  '''Sends records to a Kinesis Data Stream in PutRecords calls of up to 500 records and 5 MB, with up to `num_senders` calls
+  in flight. Only the failed entries of a partially failed call are sent again, with jittered exponential backoff.'''
+
+  def __init__(self, client, stream_name, num_senders=4, max_retries=8, backoff_base_sec=0.05, backoff_max_sec=5,
+      sleep=time.sleep):
+    self.client = client
+    self.stream_name = stream_name
+    self.max_retries = max_retries
+    self.backoff_base_sec = backoff_base_sec
+    self.backoff_max_sec = backoff_max_sec
+    self.sleep = sleep
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_senders) if num_senders > 1 else None
+
+  @staticmethod
+  def pack(entries):
+    '''Splits `{"Data": bytes, "PartitionKey": str}` entries into the entries of PutRecords calls.'''
+
+    batches, batch, batch_bytes = [], [], 0
+    for entry in entries:
+      size = len(entry['Data']) + len(entry['PartitionKey'].encode('utf-8'))
+      if size > KINESIS_MAX_RECORD_BYTES:
+        raise ValueError('a record is larger than 1 MB: {} bytes'.format(size))
+      if batch and (len(batch) >= KINESIS_PUT_RECORDS_MAX_RECORDS or batch_bytes + size > KINESIS_PUT_RECORDS_MAX_BYTES):
+        batches.append(batch)
+        batch, batch_bytes = [], 0
+      batch.append(entry)
+      batch_bytes += size
+    if batch:
+      batches.append(batch)
+    return batches
+
+  def _put_records(self, entries):
+    stats = collections.Counter()
+    for attempt in range(self.max_retries + 1):
+      if attempt > 0:
+        stats['retried_records'] += len(entries)
+        backoff = min(self.backoff_max_sec, self.backoff_base_sec * 2 ** (attempt - 1))
+        self.sleep(backoff * random.uniform(0.5, 1.0))
+
+      stats['calls'] += 1
+      response = self.client.put_records(StreamName=self.stream_name, Records=entries)
+      if not response.get('FailedRecordCount'):
+        return stats
+      #XXX: Entries of a call succeed or fail on their own, e.g. when one of the shards is over its limits.
+      results = response['Records']
+      stats['throttled_records'] += sum(1 for e in results if e.get('ErrorCode') == 'ProvisionedThroughputExceededException')
+      entries = [entry for entry, result in zip(entries, results) if result.get('ErrorCode')]
+    raise RuntimeError('{} records failed after {} retries'.format(len(entries), self.max_retries))
+
+  def send(self, entries):
+    '''Sends the entries and returns the stats, or raises RuntimeError if some are still failing after `max_retries`.'''
+
+    batches = self.pack(entries)
+    if self.executor and len(batches) > 1:
+      results = self.executor.map(self._put_records, batches)
+    else:
+      results = [self._put_records(batch) for batch in batches]
+    return sum(results, collections.Counter())
+
+
+def run_kinesis_worker(options, worker_id, max_count, target_rate, start_datetime, report):
+  '''Sends DMS records of the workload straight to a Kinesis Data Stream, without Aurora MySQL and AWS DMS.'''
+
+  record_generator = new_record_generator(options, options.seed + worker_id, start_datetime)
+
+  rng = random.Random(options.seed + worker_id)
+  key_cache = KeyCache(options.key_cache_size, rng, options.zipf_s if options.key_skew == 'zipf' else 0)
+  ops, weights = zip(*options.mix.items())
+  track_keys = any(op != 'insert' for op in ops)
+
+  if not options.dry_run:
+    client = boto3.client('kinesis', region_name=options.region_name, endpoint_url=options.kinesis_endpoint_url)
+    sender = KinesisSender(client, options.kinesis_stream_name, options.kinesis_senders)
+
+  max_count = max_count if max_count >= 0 else float('inf')
+  rate_limiter = RateLimiter(target_rate)
+  encode_json = json.JSONEncoder(separators=(',', ':')).encode
+  #XXX: Records are sent once there are enough for every sender to make a full call, or when the worker would sleep anyway.
+  flush_size = options.kinesis_senders * KINESIS_PUT_RECORDS_MAX_RECORDS
+  linger_sec = options.kinesis_linger_ms / 1000
+
+  pending = []
+  pending_since = time.monotonic()
+
+  def flush():
+    started_at = time.monotonic()
+    stats = None
+    if options.dry_run:
+      for entry in pending:
+        print(entry['Data'].decode('utf-8'), file=sys.stderr)
+    else:
+      #XXX: PutRecords calls, throttled and retried records show whether the stream or the generator is the bottleneck.
+      stats = sender.send(pending)
+    report(len(pending), time.monotonic() - started_at, stats)
+    pending.clear()
+
+  cnt = 0
+  #XXX: Keys and transaction ids are interleaved across the workers, since there is no AUTO_INCREMENT to assign them.
+  next_key, transaction_id = worker_id + 1, worker_id
+  while cnt < max_count:
+    num_rows = int(min(options.batch_size, max_count - cnt))
+    records = record_generator.generate(num_rows)
+    rate_limiter.acquire(num_rows)
+
+    commit_datetime = datetime.datetime.utcnow()
+    transaction_id += options.workers
+    if not pending:
+      pending_since = time.monotonic()
+    for row, op in zip(records, rng.choices(ops, weights, k=num_rows)):
+      if op == 'insert' or not key_cache:
+        op, trans_id = 'insert', next_key
+        next_key += options.workers
+        if track_keys:
+          key_cache.add([trans_id])
+      elif op == 'delete':
+        trans_id = key_cache.pop()
+      else:
+        #XXX: DMS writes an upsert of an existing row as an update.
+        op, trans_id = 'update', key_cache.pick()
+      dms_record = to_dms_record(row, trans_id, op, commit_datetime, transaction_id, options.database, options.table)
+      pending.append({'Data': encode_json(dms_record).encode('utf-8'),
+        'PartitionKey': partition_key_of(dms_record, options.partition_key_type)})
+    cnt += num_rows
+
+    if len(pending) >= flush_size or rate_limiter.wait_time() > 0 or time.monotonic() - pending_since >= linger_sec:
+      flush()
+
+  if pending:
+    flush()
+
+
+def chunk_file_path(options, chunk_idx):
+  #XXX: A chunk file of a run with another --max-count or --bulk-chunk-size is not reused, since it holds other rows.
+  ext = '.csv.gz' if options.bulk_compress else '.csv'
+  return os.path.join(options.bulk_load_dir, '{}-{}-{}-{:06d}{}'.format(options.table, options.max_count,
+    options.bulk_chunk_size, chunk_idx, ext))
+
+
+def write_chunk_file(options, chunk_idx, num_rows, start_datetime):
+  path = chunk_file_path(options, chunk_idx)
+  if os.path.exists(path):
+    #XXX: The chunk file was completely written by a previous run.
+    return path
+
+  #XXX: The seed is derived from the chunk index, so that a chunk is generated the same way on resume.
+  record_generator = new_record_generator(options, options.seed + chunk_idx, start_datetime)
+  tmp_path = path + '.tmp'
+  open_file = gzip.open if options.bulk_compress else open
+  with open_file(tmp_path, 'wt', encoding='utf-8', newline='') as out:
+    writer = csv.writer(out, lineterminator='\n')
+    for offset in range(0, num_rows, BULK_LOAD_BLOCK_SIZE):
+      writer.writerows(record_generator.generate(min(BULK_LOAD_BLOCK_SIZE, num_rows - offset)))
+  os.replace(tmp_path, path)
+  return path
+
+
+def load_chunk_file(conn, options, path, chunk_idx):
+  load_path = path
+  if path.endswith('.gz'):
+    #XXX: LOAD DATA cannot read gzip'd files, so decompress the chunk to a temporary file first.
+    with gzip.open(path, 'rb') as src, \
+      tempfile.NamedTemporaryFile(dir=options.bulk_load_dir, suffix='.csv', delete=False) as dst:
+      shutil.copyfileobj(src, dst)
+      load_path = dst.name
+
+  sql_stmt = LOAD_DATA_SQL_FMT.format(database=options.database, table=options.table, columns=', '.join(COLUMNS))
+  try:
+    with conn.cursor() as cursor:
+      cursor.execute(sql_stmt, (load_path,))
+      cursor.execute(INSERT_BULK_LOAD_PROGRESS_SQL_FMT.format(database=options.database),
+        (options.table, options.max_count, options.bulk_chunk_size, chunk_idx))
+    conn.commit()
+  except Exception:
+    conn.rollback()
+    raise
+  finally:
+    if load_path != path:
+      os.remove(load_path)
+
+
+def run_bulk_load_worker(options, chunks, start_datetime, report):
+  if not options.dry_run:
+    conn = pymysql.connect(host=options.host, user=options.user, password=options.password,
+      charset='utf8mb4', autocommit=False, local_infile=True)
+
+  for chunk_idx, num_rows in chunks:
+    started_at = time.monotonic()
+    path = write_chunk_file(options, chunk_idx, num_rows, start_datetime)
+    if options.dry_run:
+      print('[INFO] {} is written'.format(path), file=sys.stderr)
+    else:
+      load_chunk_file(conn, options, path, chunk_idx)
+      if not options.keep_chunks:
+        os.remove(path)
+    report(num_rows, time.monotonic() - started_at)
+
+  if not options.dry_run:
+    conn.close()
+
+
+def _worker_main(target, worker_id, args, stats_queue):
+  try:
+    target(*args, lambda num_rows, latency, counters=None: stats_queue.put(('stats', worker_id, num_rows, (latency, counters))))
+    stats_queue.put(('done', worker_id, 0, 0))
+  except Exception as ex:
+    stats_queue.put(('error', worker_id, 0, repr(ex)))
+    raise
+
+
+def run_workers(reporter, target, worker_args):
+  '''Runs target(*args, report) for each args in worker_args, in worker processes if there are more than one.
+  Workers call report(num_rows, latency) after each batch, optionally with a dict of counters to add up.'''
+
+  if len(worker_args) == 1:
+    target(*worker_args[0], lambda num_rows, latency, counters=None: (reporter.add(num_rows, latency, counters),
+      reporter.maybe_report()))
+    return
+
+  stats_queue = multiprocessing.Queue()
+  workers = [multiprocessing.Process(target=_worker_main, args=(target, i, args, stats_queue), daemon=True)
+    for i, args in enumerate(worker_args)]
+  for worker in workers:
+    worker.start()
+
+  try:
+    running = len(workers)
+    while running > 0:
+      try:
+        msg_type, worker_id, num_rows, value = stats_queue.get(timeout=1)
+      except queue.Empty:
+        if not any(worker.is_alive() for worker in workers):
+          break
+        reporter.maybe_report()
+        continue
+
+      if msg_type == 'stats':
+        reporter.add(num_rows, *value)
+      elif msg_type == 'done':
+        running -= 1
+      else:
+        raise RuntimeError('worker-{} failed: {}'.format(worker_id, value))
+      reporter.maybe_report()
+  finally:
+    for worker in workers:
+      if worker.is_alive():
+        worker.terminate()
+      worker.join()
+
+
+def workload_worker_args(options, start_datetime):
+  #XXX: Each worker gets its share of --max-count and --target-rate.
+  num_workers = options.workers
+  if options.max_count >= 0:
+    max_counts = [options.max_count // num_workers + (1 if i < options.max_count % num_workers else 0)
+      for i in range(num_workers)]
+  else:
+    max_counts = [options.max_count] * num_workers
+  target_rate = options.target_rate / num_workers
+  return [(options, i, max_counts[i], target_rate, start_datetime) for i in range(num_workers)]
+
+
+def loaded_chunk_indexes(options):
+  '''Returns the indexes of the chunks that have already been loaded with the same --max-count and --bulk-chunk-size.'''
+
+  conn = pymysql.connect(host=options.host, user=options.user, password=options.password, charset='utf8mb4')
+  try:
+    with conn.cursor() as cursor:
+      cursor.execute(BULK_LOAD_PROGRESS_TABLE_SQL_FMT.format(database=options.database))
+      cursor.execute(SELECT_BULK_LOAD_PROGRESS_SQL_FMT.format(database=options.database),
+        (options.table, options.max_count, options.bulk_chunk_size))
+      return {chunk_idx for chunk_idx, in cursor.fetchall()}
+  finally:
+    conn.close()
+
+
+def clear_bulk_load_progress(options):
+  '''Forgets the loaded chunks of the table, so that a bulk load into the table after it is dropped loads every chunk.'''
+
+  conn = pymysql.connect(host=options.host, user=options.user, password=options.password, charset='utf8mb4',
+    autocommit=True)
+  try:
+    with conn.cursor() as cursor:
+      cursor.execute("SELECT 1 FROM information_schema.tables WHERE table_schema = %s AND table_name = 'bulk_load_progress'",
+        (options.database,))
+      if cursor.fetchone():
+        cursor.execute(DELETE_BULK_LOAD_PROGRESS_SQL_FMT.format(database=options.database), (options.table,))
+  finally:
+    conn.close()
+
+
+def bulk_load_worker_args(options, start_datetime):
+  assert options.max_count >= 0, '--max-count should not be negative with --bulk-load-dir'
+  os.makedirs(options.bulk_load_dir, exist_ok=True)
+
+  #XXX: A rerun of the same command skips the chunks that have already been loaded.
+  loaded_chunks = loaded_chunk_indexes(options) if not options.dry_run else set()
+  num_chunks = (options.max_count + options.bulk_chunk_size - 1) // options.bulk_chunk_size
+  chunks = [(i, min(options.bulk_chunk_size, options.max_count - i * options.bulk_chunk_size))
+    for i in range(num_chunks) if i not in loaded_chunks]
+  if len(chunks) < num_chunks:
+    print('[INFO] {} of {} chunks are already loaded'.format(num_chunks - len(chunks), num_chunks), file=sys.stderr)
+
+  #XXX: Chunks have the same size, so that they are assigned to the workers in round-robin.
+  num_workers = max(1, min(options.workers, len(chunks)))
+  return [(options, chunks[i::num_workers], start_datetime) for i in range(num_workers)]
+
+
 def main():
   parser = argparse.ArgumentParser()
 
@@ -49,16 +802,65 @@ def main():
   parser.add_argument('--table', action='store', default='retail_trans',
     help='table name (default: retail_trans)')
   parser.add_argument('--max-count', default=10, type=int, help='The max number of records to put.')
+  parser.add_argument('--batch-size', default=1, type=int,
+    help='The number of rows per multi-row INSERT statement, committed in one transaction (default: 1)')
+  parser.add_argument('--target-rate', default=DEFAULT_TARGET_RATE, type=float,
+    help='The target number of rows per second, 0 for unlimited (default: one row every 3 seconds)')
+  parser.add_argument('--workers', default=1, type=int,
+    help='The number of worker processes, each with its own database connection (default: 1)')
+  parser.add_argument('--seed', default=DEFAULT_SEED, type=int,
+    help='The random seed; worker N uses seed + N (default: {})'.format(DEFAULT_SEED))
+  parser.add_argument('--generator', choices=['numpy', 'faker'], default='numpy',
+    help='The record generation engine; numpy generates a block of records at once (default: numpy)')
+  parser.add_argument('--mix', default='insert=100', type=parse_workload_mix,
+    help='The weights of operations, e.g. insert=70,update=25,delete=5 (choose from {}, default: insert=100)'.format(
+      ', '.join(WORKLOAD_OPERATIONS)))
+  parser.add_argument('--key-skew', choices=['uniform', 'zipf'], default='uniform',
+    help='The distribution of keys targeted by update, delete and upsert operations (default: uniform)')
+  parser.add_argument('--zipf-s', default=1.1, type=float,
+    help='The exponent of the zipf distribution with --key-skew zipf (default: 1.1)')
+  parser.add_argument('--key-cache-size', default=100000, type=int,
+    help='The number of recently inserted keys to target with update, delete and upsert operations (default: 100000)')
+  parser.add_argument('--bulk-load-dir', action='store',
+    help='Write records into chunked CSV files in this directory and load them with LOAD DATA LOCAL INFILE')
+  parser.add_argument('--bulk-chunk-size', default=1000000, type=int,
+    help='The number of rows per chunk file with --bulk-load-dir (default: 1000000)')
+  parser.add_argument('--bulk-compress', action='store_true',
+    help='gzip chunk files with --bulk-load-dir')
+  parser.add_argument('--keep-chunks', action='store_true',
+    help='Keep chunk files after they are loaded with --bulk-load-dir')
+  parser.add_argument('--sink', choices=['mysql', 'kinesis'], default='mysql',
+    help='mysql - run the workload on the database, kinesis - send its DMS records straight to --kinesis-stream-name (default: mysql)')
+  parser.add_argument('--kinesis-stream-name', action='store', help='The Kinesis Data Stream to send records to with --sink kinesis')
+  parser.add_argument('--kinesis-endpoint-url', action='store',
+    help='The endpoint of a Kinesis compatible stand-in, e.g. http://localhost:4566')
+  parser.add_argument('--kinesis-senders', default=4, type=int,
+    help='The number of PutRecords calls in flight per worker with --sink kinesis (default: 4)')
+  parser.add_argument('--kinesis-linger-ms', default=100, type=float,
+    help='The max milliseconds records wait to fill up PutRecords calls with --sink kinesis (default: 100)')
+  parser.add_argument('--partition-key-type', choices=['primary-key', 'schema-table'], default='primary-key',
+    help='The partition key of records with --sink kinesis, as the DMS Kinesis target does (default: primary-key)')
+  parser.add_argument('--report-interval', default=10, type=float,
+    help='Seconds between throughput reports (default: 10)')
   parser.add_argument('--dry-run', action='store_true')
   parser.add_argument('--create-table', action='store_true')
   parser.add_argument('--drop-table', action='store_true')
 
   options = parser.parse_args()
-
-  fake = Faker()
+  assert options.batch_size > 0, '--batch-size should be greater than 0'
+  assert options.workers > 0, '--workers should be greater than 0'
+  assert options.bulk_chunk_size > 0, '--bulk-chunk-size should be greater than 0'
+  assert options.key_cache_size > 0, '--key-cache-size should be greater than 0'
+  assert options.kinesis_senders > 0, '--kinesis-senders should be greater than 0'
+  if options.sink == 'kinesis':
+    assert options.dry_run or options.kinesis_stream_name, '--kinesis-stream-name should be given with --sink kinesis'
+    assert not options.bulk_load_dir, '--bulk-load-dir is only for --sink mysql'
+  if options.generator == 'numpy' and np is None:
+    print('[WARNING] numpy is not installed, so records are generated with Faker', file=sys.stderr)
+    options.generator = 'faker'
 
   db_url = DB_URL_FMT.format(user=options.user, password=options.password, host=options.host)
-  if not options.dry_run:
+  if not options.dry_run and (options.create_table or options.drop_table):
     db = dataset.connect(db_url)
 
   if options.create_table:
@@ -73,35 +875,20 @@ def main():
     print(sql_stmt)
     if not options.dry_run:
       db.query(sql_stmt)
+      clear_bulk_load_progress(options)
     return
 
   START_DATETIME = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-  predicate = (lambda x: x < options.max_count) if options.max_count >= 0 else (lambda x: x > options.max_count)
-  for cnt in itertools.takewhile(predicate, itertools.count()):
-    event = fake.random_element(elements=['visit', 'view', 'cart', 'list', 'like', 'purchase'])
-    amount = fake.pyint(max_value=100) if event in ['cart', 'purchase'] else 1
-    json_record = {
-      'device': fake.random_element(elements=['pc', 'mobile', 'tablet']),
-      'event': event,
-      'sku': fake.pystr_format(string_format='??%###????', letters=string.ascii_uppercase),
-      'amount': amount,
-      'customer_id': fake.pystr_format(string_format='%###########'),
-      'trans_datetime': fake.date_time_ad(start_datetime=START_DATETIME).strftime('%Y-%m-%d %H:%M:%S')
-    }
-    record = json.dumps(json_record)
-    sql_stmt = INSERT_SQL_FMT.format(database=options.database, table=options.table, **json_record)
-
-    if options.dry_run:
-      print(sql_stmt, file=sys.stderr)
-    else:
-      db.query(sql_stmt)
+  reporter = ProgressReporter(options.report_interval)
 
-      if (cnt + 1) % 100 == 0:
-        print(sql_stmt)
-        print('[INFO] {} records are processed'.format(cnt+1), file=sys.stderr)
-      time.sleep(3)
+  if options.bulk_load_dir:
+    run_workers(reporter, run_bulk_load_worker, bulk_load_worker_args(options, START_DATETIME))
+  elif options.sink == 'kinesis':
+    run_workers(reporter, run_kinesis_worker, workload_worker_args(options, START_DATETIME))
+  else:
+    run_workers(reporter, run_workload_worker, workload_worker_args(options, START_DATETIME))
 
-  print('[INFO] Total {} records are processed'.format(cnt+1), file=sys.stderr)
+  reporter.summary()
 
 
 if __name__ == '__main__':
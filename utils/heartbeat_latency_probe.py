@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Heartbeat latency probe
+
+Commits a sentinel row into a heartbeat table every `--interval` seconds and polls the OpenSearch index
+until each sentinel is searchable, then reports the p50/p95/p99 commit-to-searchable latency
+every `--report-interval` seconds and as JSON at the end.
+The heartbeat table should be in the DMS table mappings (see `dms_data_source.table_name` in `cdk.context.json`).
+
+With `--dry-run`, sentinels are not written to the database, but to a local HTTP stand-in for the OpenSearch `_search` API
+which makes each sentinel searchable after `--stand-in-delay` (+ up to `--stand-in-jitter`) seconds.
+
+Example:
+  $ python3 utils/heartbeat_latency_probe.py --create-table --host <writer-endpoint> -u admin -p <password>
+  $ python3 utils/heartbeat_latency_probe.py --host <writer-endpoint> -u admin -p <password> \
+      --opensearch-endpoint https://localhost:9200 --opensearch-user admin --opensearch-password <password> --insecure \
+      --index retail-trans --duration 600
+'''
+
+import argparse
+import datetime
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+import pymysql
+import urllib3
+
+from gen_fake_mysql_data import percentile
+
+CREATE_TABLE_SQL_FMT = '''
+CREATE TABLE IF NOT EXISTS {database}.{table} (
+  heartbeat_id BIGINT(20) AUTO_INCREMENT PRIMARY KEY,
+  probe_id VARCHAR(32) NOT NULL,
+  sent_at DATETIME(6) NOT NULL
+) ENGINE=InnoDB AUTO_INCREMENT=0;
+'''
+
+DROP_TABLE_SQL_FMT = '''DROP TABLE IF EXISTS {database}.{table};'''
+
+INSERT_SQL_FMT = '''INSERT INTO {database}.{table} (probe_id, sent_at) VALUES (%s, %s)'''
+
+#XXX: Documents are `{"data": {...}, "metadata": {...}}` as delivered by AWS DMS,
+# or flat ones with the Kinesis Data Firehose data transformation or the upsert Lambda function.
+FIELD_PREFIXES = ('data.', '')
+
+DEFAULT_TABLE = 'pipeline_heartbeat'
+
+
+def build_search_query(probe_id, heartbeat_ids):
+  '''Returns a `_search` request body for the documents of the given sentinels.'''
+
+  return {
+    "size": len(heartbeat_ids),
+    "_source": [f"{prefix}{field}" for prefix in FIELD_PREFIXES for field in ('heartbeat_id', 'probe_id')],
+    "query": {
+      "bool": {
+        "filter": [
+          {"bool": {"should": [{"match": {f"{prefix}probe_id": probe_id}} for prefix in FIELD_PREFIXES], "minimum_should_match": 1}},
+          {"bool": {"should": [{"terms": {f"{prefix}heartbeat_id": heartbeat_ids}} for prefix in FIELD_PREFIXES], "minimum_should_match": 1}}
+        ]
+      }
+    }
+  }
+
+
+def found_heartbeat_ids(response):
+  found = set()
+  for hit in response.get('hits', {}).get('hits', []):
+    source = hit.get('_source', {})
+    heartbeat_id = source.get('data', {}).get('heartbeat_id', source.get('heartbeat_id'))
+    if heartbeat_id is not None:
+      found.add(int(heartbeat_id))
+  return found
+
+
+class OpenSearchClient:
+
+  def __init__(self, endpoint, index, user=None, password=None, insecure=False):
+    self.url = '{}/{}/_search'.format(endpoint.rstrip('/'), index)
+    self.headers = {'Content-Type': 'application/json'}
+    if user:
+      self.headers.update(urllib3.make_headers(basic_auth=f'{user}:{password}'))
+    #XXX: Reuse one keep-alive connection, since the index is polled several times per second.
+    self.http = urllib3.PoolManager(maxsize=1, cert_reqs='CERT_NONE' if insecure else 'CERT_REQUIRED',
+      timeout=urllib3.Timeout(connect=5, read=10))
+    if insecure:
+      urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+  def search(self, query):
+    response = self.http.request('POST', self.url, body=json.dumps(query).encode('utf-8'), headers=self.headers)
+    if response.status == 404:
+      #XXX: The index does not exist until the first record is delivered.
+      return {}
+    if response.status >= 300:
+      raise RuntimeError('search failed: {} {}'.format(response.status, response.data[:200]))
+    return json.loads(response.data)
+
+
+class SearchStandIn(http.server.ThreadingHTTPServer):
+  '''A local stand-in for the OpenSearch `_search` API that makes each sentinel searchable after a delay.'''
+
+  def __init__(self, delay, jitter, seed):
+    super().__init__(('127.0.0.1', 0), SearchStandInHandler)
+    self.delay = delay
+    self.jitter = jitter
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+    self.docs = {}
+
+  @property
+  def endpoint(self):
+    return 'http://{}:{}'.format(*self.server_address)
+
+  def add(self, probe_id, heartbeat_id, sent_at):
+    with self.lock:
+      searchable_at = time.monotonic() + self.delay + self.rng.uniform(0, self.jitter)
+      self.docs[heartbeat_id] = (searchable_at, {'data': {'heartbeat_id': heartbeat_id, 'probe_id': probe_id,
+        'sent_at': sent_at.isoformat()}})
+
+  def search(self, query):
+    filters = query['query']['bool']['filter']
+    probe_id = next(iter(filters[0]['bool']['should'][0]['match'].values()))
+    heartbeat_ids = next(iter(filters[1]['bool']['should'][0]['terms'].values()))
+    now = time.monotonic()
+    with self.lock:
+      hits = [{'_source': doc} for searchable_at, doc in (self.docs.get(e, (None, None)) for e in heartbeat_ids)
+        if doc and searchable_at <= now and doc['data']['probe_id'] == probe_id]
+    return {'hits': {'hits': hits[:query['size']]}}
+
+
+class SearchStandInHandler(http.server.BaseHTTPRequestHandler):
+
+  #XXX: HTTP/1.1 keeps the connection alive like the OpenSearch endpoint does.
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+    body = json.dumps(self.server.search(query)).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class LatencyReporter:
+  '''Reports commit-to-searchable latency percentiles of the sentinels found in each report interval.'''
+
+  def __init__(self, report_interval):
+    self.report_interval = report_interval
+    self.latencies = []
+    self.interval_latencies = []
+    self.interval_lost = 0
+    self.num_lost = 0
+    self.intervals = []
+    self.start_time = self.last_report_time = time.monotonic()
+
+  def add(self, latency):
+    self.latencies.append(latency)
+    self.interval_latencies.append(latency)
+
+  def add_lost(self):
+    self.num_lost += 1
+    self.interval_lost += 1
+
+  @staticmethod
+  def _stats(latencies, num_lost):
+    latencies = sorted(latencies)
+    return {
+      'sentinels': len(latencies),
+      'lost': num_lost,
+      'p50_sec': percentile(latencies, 0.5),
+      'p95_sec': percentile(latencies, 0.95),
+      'p99_sec': percentile(latencies, 0.99),
+      'max_sec': latencies[-1] if latencies else 0
+    }
+
+  def maybe_report(self, force=False):
+    now = time.monotonic()
+    if not force and now - self.last_report_time < self.report_interval:
+      return
+    if not self.interval_latencies and not self.interval_lost:
+      return
+    stats = self._stats(self.interval_latencies, self.interval_lost)
+    stats['elapsed_sec'] = round(now - self.start_time, 1)
+    self.intervals.append(stats)
+    print('[INFO] {sentinels} sentinels are searchable (p50: {p50_sec:.2f} sec, p95: {p95_sec:.2f} sec, '
+      'p99: {p99_sec:.2f} sec, max: {max_sec:.2f} sec, lost: {lost})'.format(**stats), file=sys.stderr)
+    self.last_report_time = now
+    self.interval_latencies, self.interval_lost = [], 0
+
+  def summary(self):
+    return dict(self._stats(self.latencies, self.num_lost), intervals=self.intervals)
+
+
+def run_probe(options, write_sentinel, search):
+  '''Writes a sentinel every `options.interval` seconds and polls for the pending ones every `options.poll_interval`
+  seconds, until `options.duration` seconds have passed and no sentinel is pending.'''
+
+  probe_id = uuid.uuid4().hex[:16]
+  reporter = LatencyReporter(options.report_interval)
+  pending = {} # heartbeat_id -> monotonic time of commit
+
+  start_time = time.monotonic()
+  next_write = next_poll = start_time
+  while True:
+    now = time.monotonic()
+    writing = now - start_time < options.duration
+    if not writing and not pending:
+      break
+
+    if writing and now >= next_write:
+      heartbeat_id = write_sentinel(probe_id, datetime.datetime.utcnow())
+      #XXX: The latency starts when the commit returns, on the same clock as the one the search results are seen on.
+      pending[heartbeat_id] = time.monotonic()
+      next_write += options.interval
+
+    if pending and now >= next_poll:
+      response = search(build_search_query(probe_id, sorted(pending)))
+      found_at = time.monotonic()
+      for heartbeat_id in found_heartbeat_ids(response) & pending.keys():
+        reporter.add(found_at - pending.pop(heartbeat_id))
+      for heartbeat_id in [k for k, committed_at in pending.items() if found_at - committed_at > options.timeout]:
+        print('[WARNING] heartbeat {} is not searchable in {} sec'.format(heartbeat_id, options.timeout), file=sys.stderr)
+        pending.pop(heartbeat_id)
+        reporter.add_lost()
+      next_poll = found_at + options.poll_interval
+
+    reporter.maybe_report()
+    wakeup = min([next_poll] + ([next_write] if writing else []))
+    time.sleep(max(0, min(wakeup - time.monotonic(), options.poll_interval)))
+
+  reporter.maybe_report(force=True)
+  return reporter.summary()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--host', action='store', help='database host (the writer endpoint of the Aurora MySQL cluster)')
+  parser.add_argument('-u', '--user', action='store', help='user name')
+  parser.add_argument('-p', '--password', action='store', help='password')
+  parser.add_argument('--database', action='store', default='testdb',
+    help='database name (default: testdb)')
+  parser.add_argument('--table', action='store', default=DEFAULT_TABLE,
+    help='heartbeat table name (default: {})'.format(DEFAULT_TABLE))
+  parser.add_argument('--opensearch-endpoint', action='store', default='https://localhost:9200',
+    help='OpenSearch endpoint, e.g. through an SSH tunnel (default: https://localhost:9200)')
+  parser.add_argument('--opensearch-user', action='store', help='OpenSearch master user name')
+  parser.add_argument('--opensearch-password', action='store', help='OpenSearch master user password')
+  parser.add_argument('--insecure', action='store_true',
+    help='Do not verify the TLS certificate of the OpenSearch endpoint (e.g. through an SSH tunnel)')
+  parser.add_argument('--index', action='store', default='retail-trans',
+    help='The index (or index pattern, e.g. retail-trans* for rotated indices) to search (default: retail-trans)')
+  parser.add_argument('--interval', default=1, type=float, help='Seconds between sentinels (default: 1)')
+  parser.add_argument('--poll-interval', default=0.5, type=float,
+    help='Seconds between searches, i.e. the resolution of latencies (default: 0.5)')
+  parser.add_argument('--duration', default=300, type=float, help='Seconds to write sentinels for (default: 300)')
+  parser.add_argument('--timeout', default=900, type=float,
+    help='Seconds after which a sentinel that is not searchable is counted as lost (default: 900)')
+  parser.add_argument('--report-interval', default=30, type=float,
+    help='Seconds between latency reports (default: 30)')
+  parser.add_argument('--dry-run', action='store_true',
+    help='Write sentinels into a local stand-in for OpenSearch instead of the database')
+  parser.add_argument('--stand-in-delay', default=2, type=float,
+    help='Seconds before a sentinel is searchable in the stand-in with --dry-run (default: 2)')
+  parser.add_argument('--stand-in-jitter', default=1, type=float,
+    help='Up to this many more seconds before a sentinel is searchable in the stand-in with --dry-run (default: 1)')
+  parser.add_argument('--seed', default=47, type=int, help='The random seed of the stand-in (default: 47)')
+  parser.add_argument('--create-table', action='store_true')
+  parser.add_argument('--drop-table', action='store_true')
+
+  options = parser.parse_args()
+  assert options.interval > 0, '--interval should be greater than 0'
+  assert options.poll_interval > 0, '--poll-interval should be greater than 0'
+
+  if options.create_table or options.drop_table:
+    sql_fmt = CREATE_TABLE_SQL_FMT if options.create_table else DROP_TABLE_SQL_FMT
+    sql_stmt = sql_fmt.format(database=options.database, table=options.table)
+    print(sql_stmt)
+    if not options.dry_run:
+      conn = pymysql.connect(host=options.host, user=options.user, password=options.password, charset='utf8mb4', autocommit=True)
+      with conn.cursor() as cursor:
+        cursor.execute(sql_stmt)
+      conn.close()
+    return
+
+  if options.dry_run:
+    stand_in = SearchStandIn(options.stand_in_delay, options.stand_in_jitter, options.seed)
+    threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+    client = OpenSearchClient(stand_in.endpoint, options.index)
+    heartbeat_ids = iter(range(1, sys.maxsize))
+
+    def write_sentinel(probe_id, sent_at):
+      heartbeat_id = next(heartbeat_ids)
+      stand_in.add(probe_id, heartbeat_id, sent_at)
+      return heartbeat_id
+  else:
+    client = OpenSearchClient(options.opensearch_endpoint, options.index,
+      options.opensearch_user, options.opensearch_password, options.insecure)
+    conn = pymysql.connect(host=options.host, user=options.user, password=options.password, charset='utf8mb4', autocommit=True)
+    sql_stmt = INSERT_SQL_FMT.format(database=options.database, table=options.table)
+
+    def write_sentinel(probe_id, sent_at):
+      with conn.cursor() as cursor:
+        cursor.execute(sql_stmt, (probe_id, sent_at))
+        return cursor.lastrowid
+
+  summary = run_probe(options, write_sentinel, client.search)
+  if options.dry_run:
+    stand_in.shutdown()
+  else:
+    conn.close()
+
+  print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+  main()
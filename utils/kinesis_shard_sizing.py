@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Kinesis Data Stream shard sizing tool
+
+Reads a sample of DMS CDC records (JSON lines, e.g. written by `cdc_replay_harness.py --dump-records`)
+or generates them from a load generator profile, hashes their partition keys the way Kinesis does
+(MD5 into evenly split shard hash key ranges), and reports per-shard records/sec and bytes/sec,
+the probability of throttling and the recommended provisioned shard count for `KinesisDataStreamStack`.
+
+Example:
+  $ python3 utils/kinesis_shard_sizing.py --rate 3000 --mix insert=70,update=25,delete=5 --key-skew zipf
+  $ python3 utils/kinesis_shard_sizing.py --records sample.jsonl --rate 3000
+'''
+
+import argparse
+import bisect
+import collections
+import datetime
+import itertools
+import json
+import math
+
+from cdc_replay_harness import (
+  KINESIS_MAX_HASH_KEY,
+  KINESIS_SHARD_MAX_BYTES_PER_SEC,
+  KINESIS_SHARD_MAX_RECORDS_PER_SEC,
+  CdcEventSource,
+  add_event_source_arguments,
+  hash_key_of,
+  partition_key_of
+)
+from gen_fake_mysql_data import DMS_TIMESTAMP_FMT
+
+
+def read_records(path):
+  with open(path) as records_file:
+    for line in records_file:
+      line = line.strip()
+      if line:
+        yield json.loads(line)
+
+
+def sample_rate(records):
+  '''Returns records/sec of the sample, measured from the span of `metadata.timestamp`.'''
+
+  timestamps = [datetime.datetime.strptime(r['metadata']['timestamp'], DMS_TIMESTAMP_FMT) for r in records]
+  span = (max(timestamps) - min(timestamps)).total_seconds() if timestamps else 0
+  return (len(timestamps) - 1) / span if span > 0 else None
+
+
+def throttle_probability(records_per_sec, bytes_per_sec):
+  '''The probability that a shard is throttled in a given second,
+  modeling the arrivals per second as Poisson (normal approximation) with the mean record size.'''
+
+  if records_per_sec <= 0:
+    return 0.0
+  avg_record_bytes = bytes_per_sec / records_per_sec
+  max_records = min(KINESIS_SHARD_MAX_RECORDS_PER_SEC, KINESIS_SHARD_MAX_BYTES_PER_SEC / avg_record_bytes)
+  z = (max_records + 0.5 - records_per_sec) / math.sqrt(records_per_sec)
+  return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+class PartitionKeyLoad:
+  '''Records and bytes per partition key, sorted by hash key, so that the load of any hash key range
+  is the difference of two prefix sums.'''
+
+  def __init__(self, records, partition_key_type):
+    counts = collections.Counter()
+    sizes = collections.Counter()
+    for record in records:
+      partition_key = partition_key_of(record, partition_key_type)
+      counts[partition_key] += 1
+      sizes[partition_key] += len(json.dumps(record, separators=(',', ':')).encode('utf-8')) + len(partition_key.encode('utf-8'))
+
+    keys = sorted(counts, key=hash_key_of)
+    self.hash_keys = [hash_key_of(k) for k in keys]
+    self.prefix_counts = [0] + list(itertools.accumulate(counts[k] for k in keys))
+    self.prefix_bytes = [0] + list(itertools.accumulate(sizes[k] for k in keys))
+    self.num_records = self.prefix_counts[-1]
+    self.num_bytes = self.prefix_bytes[-1]
+    self.hottest_key = max(counts, key=counts.get) if counts else None
+    self.hottest_key_records = counts[self.hottest_key] if counts else 0
+    self.hottest_key_bytes = sizes[self.hottest_key] if counts else 0
+
+  def shard_loads(self, num_shards):
+    '''Returns (records, bytes) of each shard of the evenly split hash key range.'''
+
+    hash_key_range_size = (KINESIS_MAX_HASH_KEY + 1) // num_shards
+    boundaries = [0] + [bisect.bisect_left(self.hash_keys, i * hash_key_range_size) for i in range(1, num_shards)] \
+      + [len(self.hash_keys)]
+    return [(self.prefix_counts[end] - self.prefix_counts[start], self.prefix_bytes[end] - self.prefix_bytes[start])
+      for start, end in zip(boundaries, boundaries[1:])]
+
+
+def size_shards(load, rate, max_shards, target_utilization, max_throttle_probability):
+  scale = rate / load.num_records
+  candidates = []
+  for num_shards in range(1, max_shards + 1):
+    shards = [{
+      'shard_index': idx,
+      'records_per_sec': records * scale,
+      'bytes_per_sec': size * scale,
+      'utilization': max(records * scale / KINESIS_SHARD_MAX_RECORDS_PER_SEC, size * scale / KINESIS_SHARD_MAX_BYTES_PER_SEC),
+      'throttle_probability': throttle_probability(records * scale, size * scale)
+    } for idx, (records, size) in enumerate(load.shard_loads(num_shards))]
+    candidates.append({
+      'shards': num_shards,
+      'max_shard_records_per_sec': max(s['records_per_sec'] for s in shards),
+      'max_shard_bytes_per_sec': max(s['bytes_per_sec'] for s in shards),
+      'max_utilization': max(s['utilization'] for s in shards),
+      #XXX: The probability that at least one shard is throttled in a given second
+      'throttle_probability': 1 - math.prod(1 - s['throttle_probability'] for s in shards),
+      'per_shard': shards
+    })
+
+  recommended = next((c for c in candidates if c['max_utilization'] <= target_utilization
+    and c['throttle_probability'] <= max_throttle_probability), None)
+
+  hottest_key_records_per_sec = load.hottest_key_records * scale
+  hottest_key_bytes_per_sec = load.hottest_key_bytes * scale
+  warnings = []
+  if hottest_key_records_per_sec > KINESIS_SHARD_MAX_RECORDS_PER_SEC * target_utilization \
+      or hottest_key_bytes_per_sec > KINESIS_SHARD_MAX_BYTES_PER_SEC * target_utilization:
+    warnings.append('The partition key {} alone needs more than {:.0%} of a shard, so adding shards cannot spread its load'.format(
+      load.hottest_key, target_utilization))
+  if recommended is None:
+    warnings.append('No shard count up to {} meets the target utilization and throttle probability'.format(max_shards))
+
+  return {
+    'records_per_sec': rate,
+    'bytes_per_sec': load.num_bytes * scale,
+    'avg_record_bytes': load.num_bytes / load.num_records,
+    'distinct_partition_keys': len(load.hash_keys),
+    'hottest_partition_key': {
+      'partition_key': load.hottest_key,
+      'records_per_sec': hottest_key_records_per_sec,
+      'bytes_per_sec': hottest_key_bytes_per_sec
+    },
+    'candidates': [{k: v for k, v in c.items() if k != 'per_shard'} for c in candidates],
+    'recommended_shard_count': recommended['shards'] if recommended else None,
+    'recommended_shards': recommended['per_shard'] if recommended else None,
+    'cdk_context': {
+      'kinesis_stream_mode': 'PROVISIONED',
+      'kinesis_shard_count': recommended['shards']
+    } if recommended else None,
+    'warnings': warnings
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  add_event_source_arguments(parser)
+  parser.add_argument('--records', action='store', metavar='FILE',
+    help='Read a sample of DMS records from FILE (JSON lines) instead of generating them')
+  parser.add_argument('--partition-key-type', choices=['primary-key', 'schema-table'], default='primary-key',
+    help='The DMS Kinesis target partition key type (default: primary-key)')
+  parser.add_argument('--max-shards', default=64, type=int,
+    help='The max number of shards to consider (default: 64)')
+  parser.add_argument('--target-utilization', default=0.7, type=float,
+    help='The max fraction of the per-shard limits the busiest shard should use (default: 0.7)')
+  parser.add_argument('--max-throttle-probability', default=0.001, type=float,
+    help='The max probability that any shard is throttled in a given second (default: 0.001)')
+
+  #XXX: Unless --rate is given, the rate of a sample is measured from the sample itself.
+  default_rate = parser.get_default('rate')
+  parser.set_defaults(rate=None)
+
+  options = parser.parse_args()
+
+  if options.records:
+    records = list(read_records(options.records))
+    rate = options.rate or sample_rate(records)
+    assert rate, 'Cannot measure the rate of the sample, so --rate is required'
+  else:
+    options.rate = options.rate or default_rate
+    records = (record for _, record in CdcEventSource(options))
+    rate = options.rate
+
+  load = PartitionKeyLoad(records, options.partition_key_type)
+  assert load.num_records > 0, 'There is no record to size shards with'
+
+  result = size_shards(load, rate, options.max_shards, options.target_utilization, options.max_throttle_probability)
+  print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Local stand-in for the OpenSearch `_bulk` API
+
+Serves `_bulk` requests on a local port with a simulated latency, and rejects requests or items with 429
+(`es_rejected_execution_exception`) at given rates, or when more documents are in flight than `--queue-capacity`.
+Documents are kept in memory with `external_gte` versioning.
+
+By default, it writes DMS records of `retail_trans` changes (the same ones as `cdc_replay_harness.py`)
+to itself with `opensearch_bulk_writer.BulkWriter`, checks that every document ends up at its last version,
+and prints the stats as JSON. With `--serve`, it only serves requests until interrupted.
+
+Example:
+  $ python3 utils/opensearch_bulk_stand_in.py --rate 2000 --duration 30 --mix insert=70,update=25,delete=5 \
+      --latency-ms 20 --item-reject-rate 0.05 --queue-capacity 2000 --concurrency 4
+'''
+
+import argparse
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from cdc_replay_harness import CdcEventSource, add_event_source_arguments
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/main/python/OpenSearchBulkWriter/python'))
+from opensearch_bulk_writer import BulkTransport, BulkWriter, dms_bulk_actions, dms_document_id, dms_document_version
+
+REJECTED_ERROR = {'type': 'es_rejected_execution_exception', 'reason': 'rejected execution of coordinating operation'}
+
+
+class BulkStandIn(http.server.ThreadingHTTPServer):
+
+  def __init__(self, port=0, latency_ms=0, latency_per_doc_us=0, request_reject_rate=0, item_reject_rate=0,
+      queue_capacity=0, seed=47):
+    super().__init__(('127.0.0.1', port), BulkStandInHandler)
+    self.latency_ms = latency_ms
+    self.latency_per_doc_us = latency_per_doc_us
+    self.request_reject_rate = request_reject_rate
+    self.item_reject_rate = item_reject_rate
+    self.queue_capacity = queue_capacity
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+    self.docs = {} # (index, _id) -> (version, source or None for a deleted document)
+    self.num_appended = 0
+    self.in_flight_docs = 0
+    self.stats = {'requests': 0, 'rejected_requests': 0, 'items': 0, 'rejected_items': 0, 'version_conflicts': 0}
+
+  @property
+  def endpoint(self):
+    return 'http://{}:{}'.format(*self.server_address)
+
+  def _apply(self, op_type, meta, source):
+    key = (meta['_index'], meta.get('_id'))
+    if key[1] is None:
+      self.num_appended += 1
+      return {'_index': key[0], 'status': 201}
+    version = meta.get('version')
+    current = self.docs.get(key)
+    if version is not None and current is not None and version < current[0]:
+      self.stats['version_conflicts'] += 1
+      return {'_index': key[0], '_id': key[1], 'status': 409, 'error': {'type': 'version_conflict_engine_exception'}}
+    if op_type == 'delete' and (current is None or current[1] is None):
+      return {'_index': key[0], '_id': key[1], 'status': 404}
+    self.docs[key] = (version, source if op_type == 'index' else None)
+    return {'_index': key[0], '_id': key[1], 'status': 200 if current else 201}
+
+  def bulk(self, body):
+    '''Returns (HTTP status, response) of a `_bulk` request body.'''
+
+    lines = body.decode('utf-8').splitlines()
+    operations = []
+    idx = 0
+    while idx < len(lines):
+      (op_type, meta), = json.loads(lines[idx]).items()
+      source = json.loads(lines[idx + 1]) if op_type == 'index' else None
+      operations.append((op_type, meta, source))
+      idx += 2 if op_type == 'index' else 1
+
+    with self.lock:
+      self.stats['requests'] += 1
+      if self.rng.random() < self.request_reject_rate or \
+          (self.queue_capacity and self.in_flight_docs + len(operations) > self.queue_capacity):
+        self.stats['rejected_requests'] += 1
+        return 429, {'error': REJECTED_ERROR, 'status': 429}
+      self.in_flight_docs += len(operations)
+
+    try:
+      time.sleep(self.latency_ms / 1000 + self.latency_per_doc_us * len(operations) / 1000000)
+      items = []
+      with self.lock:
+        for op_type, meta, source in operations:
+          self.stats['items'] += 1
+          if self.rng.random() < self.item_reject_rate:
+            self.stats['rejected_items'] += 1
+            items.append({op_type: {'_index': meta['_index'], 'status': 429, 'error': REJECTED_ERROR}})
+          else:
+            items.append({op_type: self._apply(op_type, meta, source)})
+    finally:
+      with self.lock:
+        self.in_flight_docs -= len(operations)
+
+    errors = any(next(iter(item.values()))['status'] >= 300 for item in items)
+    return 200, {'took': self.latency_ms, 'errors': errors, 'items': items}
+
+
+class BulkStandInHandler(http.server.BaseHTTPRequestHandler):
+
+  #XXX: HTTP/1.1 keeps the connections of the pool alive like the OpenSearch endpoint does.
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    status, response = self.server.bulk(self.rfile.read(int(self.headers['Content-Length'])))
+    body = json.dumps(response).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def run(options, stand_in):
+  primary_keys = {'{}.{}'.format(options.database, options.table): ['trans_id']}
+  transport = BulkTransport(stand_in.endpoint, pool_size=options.concurrency)
+  writer = BulkWriter(transport, max_docs=options.max_docs, max_bytes=options.max_bytes, concurrency=options.concurrency)
+
+  totals = {}
+  expected = {}
+  batch = []
+  num_records = 0
+  started_at = time.monotonic()
+
+  def flush():
+    for key, value in writer.write(dms_bulk_actions(batch, options.index, primary_keys, options.delete_mode)).items():
+      totals[key] = totals.get(key, 0) + value if key not in ('batch_docs', 'batch_bytes') else value
+
+  for _, dms_record in CdcEventSource(options):
+    doc_id = dms_document_id(dms_record, primary_keys)
+    expected[doc_id] = (dms_document_version(dms_record), dms_record['metadata']['operation'])
+    batch.append(dms_record)
+    num_records += 1
+    if len(batch) >= options.records_per_write:
+      flush()
+      batch = []
+  if batch:
+    flush()
+  elapsed = time.monotonic() - started_at
+
+  #XXX: Every document should be at the version of its last change, and deleted rows should be gone or tombstones.
+  mismatches = 0
+  for doc_id, (version, operation) in expected.items():
+    current = stand_in.docs.get((options.index, doc_id))
+    if current is None:
+      mismatches += 0 if operation == 'delete' and options.delete_mode == 'delete' else 1
+      continue
+    deleted = current[1] is None or current[1].get('_deleted')
+    if current[0] != version or deleted != (operation == 'delete'):
+      mismatches += 1
+
+  return {
+    'records': num_records,
+    'documents': len(expected),
+    'elapsed_sec': elapsed,
+    'records_per_sec': num_records / elapsed if elapsed > 0 else 0,
+    'writer': totals,
+    'stand_in': stand_in.stats,
+    'mismatches': mismatches
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  add_event_source_arguments(parser)
+  parser.add_argument('--serve', action='store_true', help='Only serve `_bulk` requests on --port until interrupted')
+  parser.add_argument('--port', default=0, type=int, help='The port to serve on (default: any free port)')
+  parser.add_argument('--latency-ms', default=10, type=float, help='The latency of a request in milliseconds (default: 10)')
+  parser.add_argument('--latency-per-doc-us', default=20, type=float,
+    help='The latency per document of a request in microseconds (default: 20)')
+  parser.add_argument('--request-reject-rate', default=0, type=float,
+    help='The probability to reject a whole request with 429 (default: 0)')
+  parser.add_argument('--item-reject-rate', default=0, type=float,
+    help='The probability to reject an item with 429 (default: 0)')
+  parser.add_argument('--queue-capacity', default=0, type=int,
+    help='Reject requests with 429 while more documents than this are in flight, 0 for unlimited (default: 0)')
+  parser.add_argument('--index', default='retail-trans_current', help='index name (default: retail-trans_current)')
+  parser.add_argument('--delete-mode', choices=['tombstone', 'delete'], default='tombstone',
+    help='How deleted rows are written (default: tombstone)')
+  parser.add_argument('--records-per-write', default=500, type=int,
+    help='The number of DMS records per write, e.g. the batch size of a Lambda event source (default: 500)')
+  parser.add_argument('--max-docs', default=1000, type=int, help='The max documents per `_bulk` request (default: 1000)')
+  parser.add_argument('--max-bytes', default=5 * 1024 * 1024, type=int,
+    help='The max bytes per `_bulk` request (default: 5 MB)')
+  parser.add_argument('--concurrency', default=4, type=int, help='The max `_bulk` requests in flight (default: 4)')
+
+  options = parser.parse_args()
+
+  stand_in = BulkStandIn(options.port, options.latency_ms, options.latency_per_doc_us, options.request_reject_rate,
+    options.item_reject_rate, options.queue_capacity, options.seed)
+  if options.serve:
+    print('[INFO] Serving _bulk requests on {}'.format(stand_in.endpoint), file=sys.stderr)
+    try:
+      stand_in.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    return
+
+  threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+  result = run(options, stand_in)
+  stand_in.shutdown()
+  print(json.dumps(result, indent=2))
+  if result['mismatches']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+'''Micro-benchmarks of the Python components of the pipeline
+
+Times the CPU-bound steps that every record goes through, on DMS records of `retail_trans` changes
+(the same ones as `cdc_replay_harness.py`), with in-memory stand-ins where a service is involved:
+
+  - row_synthesis.*: rows per second of the load generator (gen_fake_mysql_data.py)
+  - dms_record.*: DMS `json-unformatted` records serialized and parsed with the json module
+  - firehose_transform: the Kinesis Data Firehose transformation Lambda function (src/main/python/FirehoseTransform)
+  - kinesis.*: PutRecords batch packing, and sending to a stand-in that throttles some entries (KinesisSender)
+  - firehose.buffer: buffering and flushing by intervalInSeconds/sizeInMBs (FirehoseStandIn)
+  - opensearch.*: `_bulk` actions and bodies of the OpenSearchBulkWriter layer
+  - rollup.apply_records: the aggregates of the rollup Lambda function (src/main/python/OpenSearchRollup)
+
+Each benchmark runs `--repeat` times (of at least `--min-time` seconds) after a warm-up, and the fastest run is reported,
+since slower runs are mostly noise of other processes. The results are printed as JSON,
+and with `--compare`, checked against the results of an earlier run (e.g. the committed baseline).
+Throughput depends on the machine, so compare only results of the same machine and Python version.
+
+Example:
+  $ python3 utils/pipeline_benchmarks.py --output results.json
+  $ python3 utils/pipeline_benchmarks.py --compare utils/pipeline_benchmarks_baseline.json
+'''
+
+import argparse
+import base64
+import collections
+import datetime
+import gc
+import importlib.util
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+from cdc_replay_harness import (
+  GENERATE_BLOCK_SIZE,
+  CdcEventSource,
+  FirehoseStandIn,
+  add_event_source_arguments,
+  parse_workload_mix
+)
+from gen_fake_mysql_data import (
+  DEFAULT_SEED,
+  FakerRecordGenerator,
+  KinesisSender,
+  VectorizedRecordGenerator,
+  np,
+  partition_key_of
+)
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/main/python')
+sys.path.insert(0, os.path.join(SRC_DIR, 'OpenSearchBulkWriter/python'))
+from opensearch_bulk_writer import bulk_body, dms_bulk_actions
+
+PRIMARY_KEYS = {'testdb.retail_trans': ['trans_id']}
+#XXX: The default batch size of the event sources of the Lambda functions
+LAMBDA_BATCH_SIZE = 500
+#XXX: Faker generates a row a few hundred times slower than NumPy, so it gets fewer rows.
+FAKER_ROWS_DIVISOR = 20
+#XXX: The stand-in for PutRecords throttles every Nth entry of a first attempt, like a shard over its limits.
+KINESIS_THROTTLE_EVERY = 20
+
+
+def load_lambda_module(name, environ=None):
+  '''Loads `src/main/python/<name>/index.py` as a module, with `environ` set while its settings are read.'''
+
+  saved = {key: os.environ.get(key) for key in (environ or {})}
+  os.environ.update(environ or {})
+  try:
+    spec = importlib.util.spec_from_file_location('{}_index'.format(name), os.path.join(SRC_DIR, name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+  finally:
+    for key, value in saved.items():
+      if value is None:
+        os.environ.pop(key, None)
+      else:
+        os.environ[key] = value
+
+
+class PutRecordsStandIn:
+  '''Answers PutRecords calls like Kinesis, failing every `throttle_every`th entry of the entries seen for the first time.'''
+
+  def __init__(self, throttle_every):
+    self.throttle_every = throttle_every
+    self.seen = set()
+    self.num_entries = 0
+
+  def put_records(self, StreamName, Records):
+    results, failed = [], 0
+    for entry in Records:
+      key = id(entry)
+      self.num_entries += 1
+      if key not in self.seen and self.num_entries % self.throttle_every == 0:
+        self.seen.add(key)
+        results.append({'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'Rate exceeded'})
+        failed += 1
+      else:
+        results.append({'SequenceNumber': str(self.num_entries), 'ShardId': 'shardId-000000000000'})
+    return {'FailedRecordCount': failed, 'Records': results}
+
+
+def bench_row_synthesis_numpy(dataset):
+  start_datetime = dataset['start_datetime']
+  num_rows = len(dataset['records'])
+
+  def run():
+    generator = VectorizedRecordGenerator(DEFAULT_SEED, start_datetime)
+    for offset in range(0, num_rows, GENERATE_BLOCK_SIZE):
+      generator.generate(min(GENERATE_BLOCK_SIZE, num_rows - offset))
+
+  return run, num_rows
+
+
+def bench_row_synthesis_faker(dataset):
+  start_datetime = dataset['start_datetime']
+  num_rows = max(1, len(dataset['records']) // FAKER_ROWS_DIVISOR)
+
+  def run():
+    FakerRecordGenerator(DEFAULT_SEED, start_datetime).generate(num_rows)
+
+  return run, num_rows
+
+
+def bench_dms_record_serialize(dataset):
+  records = dataset['records']
+
+  def run():
+    return {'bytes': sum(len(json.dumps(record, separators=(',', ':')).encode('utf-8')) for record in records)}
+
+  return run, len(records)
+
+
+def bench_dms_record_parse(dataset):
+  payloads = dataset['payloads']
+
+  def run():
+    for payload in payloads:
+      json.loads(payload)
+
+  return run, len(payloads)
+
+
+def bench_firehose_transform(dataset):
+  transform = load_lambda_module('FirehoseTransform')
+  #XXX: Firehose invokes the function with base64 encoded records in batches.
+  records = [{'recordId': str(idx), 'data': base64.b64encode(payload).decode('ascii')}
+    for idx, payload in enumerate(dataset['payloads'])]
+  batches = [records[offset:offset + LAMBDA_BATCH_SIZE] for offset in range(0, len(records), LAMBDA_BATCH_SIZE)]
+
+  def run():
+    results = collections.Counter()
+    for batch in batches:
+      results.update(record['result'] for record in transform.transform_records(batch))
+    return dict(results)
+
+  return run, len(records)
+
+
+def bench_kinesis_pack(dataset):
+  entries = dataset['entries']
+
+  def run():
+    return {'calls': len(KinesisSender.pack(entries))}
+
+  return run, len(entries)
+
+
+def bench_kinesis_send(dataset):
+  entries = dataset['entries']
+
+  def run():
+    sender = KinesisSender(PutRecordsStandIn(KINESIS_THROTTLE_EVERY), 'benchmark', num_senders=1, sleep=lambda sec: None)
+    return dict(sender.send(entries))
+
+  return run, len(entries)
+
+
+def bench_firehose_buffer(dataset):
+  options = dataset['options']
+  #XXX: (arrival time, size, event time) of each record, arriving at the commit time
+  arrivals = [(commit_time, len(payload), commit_time) for commit_time, payload in zip(dataset['commit_times'], dataset['payloads'])]
+
+  def run():
+    firehose = FirehoseStandIn(options.buffer_interval, options.buffer_size_mb)
+    for arrival in arrivals:
+      firehose.put(*arrival)
+    firehose.close()
+    return {'batches': len(firehose.batches)}
+
+  return run, len(arrivals)
+
+
+def lambda_batches(dataset):
+  #XXX: The actions add fields to `data` of the records in place, so they get records of their own.
+  records = [json.loads(payload) for payload in dataset['payloads']]
+  return [records[offset:offset + LAMBDA_BATCH_SIZE] for offset in range(0, len(records), LAMBDA_BATCH_SIZE)]
+
+
+def bench_opensearch_bulk_actions(dataset):
+  batches = lambda_batches(dataset)
+
+  def run():
+    return {'actions': sum(len(dms_bulk_actions(batch, 'retail-trans_current', PRIMARY_KEYS)) for batch in batches)}
+
+  return run, len(dataset['records'])
+
+
+def bench_opensearch_bulk_body(dataset):
+  action_batches = [dms_bulk_actions(batch, 'retail-trans_current', PRIMARY_KEYS) for batch in lambda_batches(dataset)]
+
+  def run():
+    return {'bytes': sum(len(bulk_body(actions)) for actions in action_batches)}
+
+  return run, sum(len(actions) for actions in action_batches)
+
+
+def bench_rollup_apply_records(dataset):
+  rollup = load_lambda_module('OpenSearchRollup', {'PRIMARY_KEYS': json.dumps(PRIMARY_KEYS)})
+  records = dataset['records']
+
+  def run():
+    groups = {}
+    stats = rollup.apply_records(groups, records)
+    return {'groups': len(groups), 'unmatched_updates': stats['unmatched_updates']}
+
+  return run, len(records)
+
+
+#XXX: (name, unit, benchmark, requirement) where a benchmark sets up its inputs and returns (a function to time, the number of units)
+BENCHMARKS = [
+  ('row_synthesis.numpy', 'rows', bench_row_synthesis_numpy, np is not None),
+  ('row_synthesis.faker', 'rows', bench_row_synthesis_faker, True),
+  ('dms_record.serialize', 'records', bench_dms_record_serialize, True),
+  ('dms_record.parse', 'records', bench_dms_record_parse, True),
+  ('firehose_transform', 'records', bench_firehose_transform, True),
+  ('kinesis.pack', 'records', bench_kinesis_pack, True),
+  ('kinesis.send', 'records', bench_kinesis_send, True),
+  ('firehose.buffer', 'records', bench_firehose_buffer, True),
+  ('opensearch.bulk_actions', 'records', bench_opensearch_bulk_actions, True),
+  ('opensearch.bulk_body', 'actions', bench_opensearch_bulk_body, True),
+  ('rollup.apply_records', 'records', bench_rollup_apply_records, True),
+]
+
+
+def build_dataset(options):
+  '''Generates the DMS records once, in the forms the benchmarks take as input.'''
+
+  event_source = CdcEventSource(options)
+  commit_times, records = [], []
+  for commit_time, record in event_source:
+    commit_times.append(commit_time)
+    records.append(record)
+  payloads = [json.dumps(record, separators=(',', ':')).encode('utf-8') for record in records]
+  return {
+    'options': options,
+    'start_datetime': event_source.start_datetime,
+    'records': records,
+    'commit_times': commit_times,
+    'payloads': payloads,
+    'entries': [{'Data': payload, 'PartitionKey': partition_key_of(record, 'primary-key')}
+      for record, payload in zip(records, payloads)]
+  }
+
+
+def time_benchmark(run, num_units, repeat, min_time_sec):
+  '''Times `repeat` runs with the garbage collector disabled, like timeit does.
+  A run calls the function enough times to take at least `min_time_sec`, so that short benchmarks are not lost in timer noise.'''
+
+  result = run() or {}
+  number = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(number):
+      run()
+    if time.perf_counter() - start >= min_time_sec:
+      break
+    number *= 2
+
+  elapsed = []
+  for _ in range(repeat):
+    gc.collect()
+    gc.disable()
+    try:
+      start = time.perf_counter()
+      for _ in range(number):
+        run()
+      elapsed.append((time.perf_counter() - start) / number)
+    finally:
+      gc.enable()
+  elapsed.sort()
+  return {
+    'units': num_units,
+    'loops': number,
+    'best_sec': elapsed[0],
+    'median_sec': elapsed[len(elapsed) // 2],
+    'units_per_sec': num_units / elapsed[0] if elapsed[0] > 0 else None,
+    'result': result
+  }
+
+
+def run_benchmarks(options):
+  dataset = build_dataset(options)
+  benchmarks = {}
+  for name, unit, benchmark, available in BENCHMARKS:
+    if options.filter and not re.search(options.filter, name):
+      continue
+    if not available:
+      print('[WARNING] {} is skipped, since its requirements are not installed'.format(name), file=sys.stderr)
+      continue
+    run, num_units = benchmark(dataset)
+    benchmarks[name] = dict(unit=unit, **time_benchmark(run, num_units, options.repeat, options.min_time))
+    print('[INFO] {}: {:,.0f} {}/sec'.format(name, benchmarks[name]['units_per_sec'], unit), file=sys.stderr)
+
+  return {
+    'environment': {
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+      'machine': platform.machine(),
+      'system': platform.system(),
+      'cpu_count': os.cpu_count(),
+      'numpy': np.__version__ if np is not None else None
+    },
+    'settings': {
+      'records': len(dataset['records']),
+      'mix': ','.join('{}={}'.format(op, weight) for op, weight in options.mix.items()),
+      'seed': options.seed,
+      'before_image': options.before_image,
+      'repeat': options.repeat,
+      'min_time_sec': options.min_time
+    },
+    'created_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    'benchmarks': benchmarks
+  }
+
+
+def compare(results, baseline, threshold):
+  '''Returns the change of throughput of each benchmark from the baseline,
+  with `regression` set if it is slower by more than `threshold` (e.g. 0.25 for 25%).'''
+
+  for section, key in [('environment', 'python'), ('environment', 'machine'), ('environment', 'cpu_count'),
+      ('settings', 'records'), ('settings', 'mix'), ('settings', 'before_image')]:
+    if results[section].get(key) != baseline[section].get(key):
+      print('[WARNING] {} of the baseline is {}, not {}'.format(key, baseline[section].get(key),
+        results[section].get(key)), file=sys.stderr)
+
+  comparison = {}
+  for name, result in results['benchmarks'].items():
+    base = baseline['benchmarks'].get(name)
+    if not base or not base.get('units_per_sec') or not result['units_per_sec']:
+      continue
+    change = result['units_per_sec'] / base['units_per_sec'] - 1
+    comparison[name] = {
+      'baseline_units_per_sec': base['units_per_sec'],
+      'units_per_sec': result['units_per_sec'],
+      'change': change,
+      'regression': change < -threshold
+    }
+  return comparison
+
+
+def main():
+  parser = argparse.ArgumentParser()
+
+  add_event_source_arguments(parser)
+  #XXX: Updates carry `before-image`, which the rollup function requires.
+  parser.set_defaults(rate=1000, duration=20, mix=parse_workload_mix('insert=70,update=25,delete=5'), before_image=True)
+  parser.add_argument('--buffer-interval', default=60, type=int,
+    help='Firehose buffering hints intervalInSeconds (default: 60)')
+  parser.add_argument('--buffer-size-mb', default=1, type=int,
+    help='Firehose buffering hints sizeInMBs (default: 1)')
+  parser.add_argument('--repeat', default=5, type=int, help='The number of timed runs of each benchmark (default: 5)')
+  parser.add_argument('--min-time', default=0.2, type=float,
+    help='The minimum seconds of a timed run, which calls a short benchmark as many times as needed (default: 0.2)')
+  parser.add_argument('--filter', action='store', metavar='REGEX', help='Run only the benchmarks whose names match REGEX')
+  parser.add_argument('--output', action='store', metavar='FILE', help='Write the results into FILE as well')
+  parser.add_argument('--compare', action='store', metavar='FILE',
+    help='Compare the results with the results in FILE, and exit with 1 if any benchmark regressed')
+  parser.add_argument('--threshold', default=0.25, type=float,
+    help='The drop of throughput from --compare to report as a regression (default: 0.25, i.e. 25%%)')
+
+  options = parser.parse_args()
+  assert options.repeat >= 1, '--repeat should be at least 1'
+
+  results = run_benchmarks(options)
+  if options.compare:
+    with open(options.compare) as baseline_file:
+      baseline = json.load(baseline_file)
+    results['comparison'] = compare(results, baseline, options.threshold)
+
+  if options.output:
+    with open(options.output, 'w') as output_file:
+      json.dump(results, output_file, indent=2)
+      output_file.write('\n')
+  print(json.dumps(results, indent=2))
+
+  regressions = [name for name, e in results.get('comparison', {}).items() if e['regression']]
+  for name in regressions:
+    e = results['comparison'][name]
+    print('[ERROR] {} regressed by {:.0%}: {:,.0f} -> {:,.0f} {}/sec'.format(name, -e['change'],
+      e['baseline_units_per_sec'], e['units_per_sec'], results['benchmarks'][name]['unit']), file=sys.stderr)
+  if regressions:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()